@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+""" End-to-end timing of prealign's own processing on synthetic runs.
+
+For every run layout, builds a synthetic run (benchmarks/synthetic_run.py) and times
+sample sheet parsing, fastq discovery, the lane merge, read counting and report building.
+External tools (fastqc, multiqc, bwa, samtools, java) are replaced by no-op stubs on PATH,
+so only prealign code is measured. Results are written as JSON with the git commit, so
+regressions can be tracked between commits:
+
+    python benchmarks/bench_pipeline.py --samples 8 --lanes 4 --reads 50000 -o bench_$(git rev-parse --short HEAD).json
+"""
+from __future__ import print_function
+import json
+import os
+import platform
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from optparse import OptionParser
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from ngs_utils.file_utils import safe_mkdir
+
+from prealign.dataset_structure import DatasetStructure
+from prealign.fastqc_archive import fastqc_extracted_dirpath
+from prealign.fs_cache import fs_cache
+from prealign.metrics_store import write_project_metrics
+from prealign.paged_report import write_paged_report, fingerprint, file_fingerprint
+from prealign.preflight import write_preflight_report, check_thresholds, default_thresholds
+from prealign.read_stats import ReadStats, read_fastq_stats
+
+from synthetic_run import make_run, RunShape, KINDS
+
+try:
+    from html import escape
+except ImportError:  # Python 2
+    from cgi import escape
+
+
+STUBBED_TOOLS = ('fastqc', 'multiqc', 'bwa', 'samtools', 'java')
+RUN_ID_FOR_METRICS = 'bench'
+
+
+class BenchProjInfo:
+    """ The subset of the prealign script's ProjInfo that DatasetStructure uses """
+    def __init__(self, output_dir):
+        self.ds_proj_name = ''
+        self.output_dir = output_dir
+        self.analysis_dir = None
+        self.project_name = None
+        self.jira = None
+        self.bed = None
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=dirname(abspath(__file__)),
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@contextmanager
+def stubbed_tools(tmp_dirpath):
+    bin_dirpath = join(tmp_dirpath, 'stub_bin')
+    os.mkdir(bin_dirpath)
+    for tool in STUBBED_TOOLS:
+        fpath = join(bin_dirpath, tool)
+        with open(fpath, 'w') as f:
+            f.write('#!/bin/sh\nexit 0\n')
+        os.chmod(fpath, os.stat(fpath).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    old_path = os.environ.get('PATH', '')
+    os.environ['PATH'] = bin_dirpath + os.pathsep + old_path
+    try:
+        yield bin_dirpath
+    finally:
+        os.environ['PATH'] = old_path
+
+
+@contextmanager
+def timed(stages, name):
+    t0 = time.time()
+    yield
+    stages[name] = round(time.time() - t0, 4)
+
+
+def write_fastqc_data(fastqc_dirpath, base_name, rs):
+    """ What the stubbed fastqc would leave: the fastqc_data.txt modules the metrics store reads """
+    dirpath = safe_mkdir(fastqc_extracted_dirpath(fastqc_dirpath, base_name))
+    with open(join(dirpath, 'fastqc_data.txt'), 'w') as f:
+        f.write('##FastQC\t0.11.5\n'
+                '>>Basic Statistics\tpass\n'
+                '#Measure\tValue\n'
+                'Total Sequences\t%d\n'
+                '%%GC\t%d\n'
+                '>>END_MODULE\n'
+                '>>Per sequence quality scores\tpass\n'
+                '#Quality\tCount\n'
+                '%d\t%.1f\n'
+                '>>END_MODULE\n'
+                '>>Sequence Duplication Levels\tpass\n'
+                '#Total Deduplicated Percentage\t100.0\n'
+                '>>END_MODULE\n' % (rs.reads, round(rs.gc_pct or 0), int(rs.mean_qual or 0), rs.reads))
+
+
+def bench_kind(tmp_dirpath, kind, shape):
+    stages = OrderedDict()
+    with timed(stages, 'generate'):
+        run_dirpath, fastqs_by_sample = make_run(join(tmp_dirpath, kind), kind, shape)
+    fs_cache.reset()
+
+    output_dir = join(tmp_dirpath, kind, 'output', '{ds_proj_name}')
+    with timed(stages, 'parse_sample_sheet'):
+        ds = DatasetStructure.create(run_dirpath, {'': BenchProjInfo(output_dir)})
+        for project in ds.project_by_name.values():
+            safe_mkdir(project.output_dir)  # as _prepare_analysis_dirs in scripts/prealign
+
+    samples = [s for p in ds.project_by_name.values() for s in p.sample_by_name.values()]
+    with timed(stages, 'discover_fastqs'):
+        found = sum(len(s.find_raw_fastq(ds.get_fastq_regexp_fn, suf)) for s in samples for suf in ['R1', 'R2'])
+    expected = sum(2 * len(pairs) for pairs in fastqs_by_sample.values())
+    if found != expected:
+        raise AssertionError(kind + ': found ' + str(found) + ' raw fastqs, expected ' + str(expected))
+
+    with timed(stages, 'concat_fastqs'):
+        for project in ds.project_by_name.values():
+            project.concat_fastqs(ds.get_fastq_regexp_fn)
+
+    stats_by_sample = OrderedDict()
+    stats_by_fastq = dict()
+    with timed(stages, 'count_reads'):
+        for s in samples:
+            rs = ReadStats()
+            for fpath in [s.l_fpath, s.r_fpath]:
+                stats_by_fastq[fpath] = read_fastq_stats(fpath)
+                rs.merge(stats_by_fastq[fpath])
+            stats_by_sample[s.name] = rs
+    total_reads = sum(rs.reads for rs in stats_by_sample.values())
+    if total_reads != expected * shape.reads:
+        raise AssertionError(kind + ': counted ' + str(total_reads) + ' reads, expected ' + str(expected * shape.reads))
+
+    for s in samples:  # not timed: replaces the stubbed fastqc
+        write_fastqc_data(s.fastqc_dirpath, s.l_fastqc_base_name, stats_by_fastq[s.l_fpath])
+        write_fastqc_data(s.fastqc_dirpath, s.r_fastqc_base_name, stats_by_fastq[s.r_fpath])
+    fs_cache.reset()
+
+    metric_names = ['Reads', 'Mean quality', '% GC']
+
+    def make_rows(sample_names):
+        return dict((sn, dict(zip(metric_names, [escape(str(v)) for v in [
+            stats_by_sample[sn].reads, stats_by_sample[sn].mean_qual, stats_by_sample[sn].gc_pct]])))
+            for sn in sample_names)
+
+    with timed(stages, 'build_reports'):
+        for project in ds.project_by_name.values():
+            write_preflight_report(OrderedDict(
+                (s.name, (stats_by_sample[s.name], check_thresholds(stats_by_sample[s.name], default_thresholds())))
+                for s in project.sample_by_name.values()), join(project.output_dir, 'preflight_mqc.tsv'))
+            if not write_project_metrics(RUN_ID_FOR_METRICS, project):
+                raise AssertionError(kind + ': no QC metrics saved for ' + project.name)
+            write_paged_report(join(project.output_dir, 'report.html'), project.name, metric_names,
+                               OrderedDict((s.name, fingerprint([file_fingerprint(s.l_fpath), file_fingerprint(s.r_fpath)]))
+                                           for s in project.sample_by_name.values()), make_rows)
+
+    stages['total'] = round(sum(v for k, v in stages.items() if k != 'generate'), 4)
+    return OrderedDict([('fastq_files', expected), ('reads', total_reads), ('seconds', stages)])
+
+
+def main():
+    parser = OptionParser(description='Time prealign steps on synthetic runs')
+    parser.add_option('--kinds', default=','.join(KINDS), help='Comma-separated run layouts, default all')
+    parser.add_option('--samples', type='int', default=4)
+    parser.add_option('--lanes', type='int', default=2)
+    parser.add_option('--reads', type='int', default=10000, help='Read pairs per sample per lane')
+    parser.add_option('--read-len', type='int', default=100)
+    parser.add_option('-o', '--output', help='JSON file with results (printed to stdout otherwise)')
+    parser.add_option('--keep', action='store_true', help='Keep the generated runs and print their location')
+    opts, _ = parser.parse_args()
+
+    shape = RunShape(opts.samples, opts.lanes, opts.reads, opts.read_len)
+    tmp_dirpath = tempfile.mkdtemp(prefix='prealign_bench_')
+    results = OrderedDict([
+        ('commit', git_commit()),
+        ('date', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', platform.python_version()),
+        ('host', platform.node()),
+        ('shape', shape.to_dict()),
+        ('runs', OrderedDict()),
+    ])
+    try:
+        with stubbed_tools(tmp_dirpath):
+            for kind in opts.kinds.split(','):
+                results['runs'][kind] = bench_kind(tmp_dirpath, kind, shape)
+    finally:
+        if opts.keep:
+            print('Generated runs are kept in ' + tmp_dirpath, file=sys.stderr)
+        else:
+            shutil.rmtree(tmp_dirpath)
+
+    text = json.dumps(results, indent=2)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+""" Microbenchmark of prealign.gzip_io codecs: MB/s of uncompressed data, wall-clock and per CPU core.
+
+    python benchmarks/gzip_io_bench.py [--fastq existing.fastq.gz] [--mb 200] [--threads 4] [--level 6]
+"""
+from __future__ import print_function
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from prealign import gzip_io
+
+
+def _cpu_seconds():
+    self_ru = resource.getrusage(resource.RUSAGE_SELF)
+    children_ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_ru.ru_utime + self_ru.ru_stime + children_ru.ru_utime + children_ru.ru_stime
+
+
+def make_fastq(fpath, mb, read_len=150, seed=42):
+    """ Random reads with realistic-ish redundancy, so the compression ratio resembles real data """
+    rnd = random.Random(seed)
+    genome = ''.join(rnd.choice('ACGT') for _ in range(1 << 20))
+    qual_alphabet = 'FFFFFFFFF:,#'
+    target = mb << 20
+    written = 0
+    with gzip_io.open_fastq(fpath, 'wb', method='gzip', level=1) as f:
+        i = 0
+        while written < target:
+            pos = rnd.randrange(len(genome) - read_len)
+            rec = '@SIM:1:FC:1:1:{0}:{1} 1:N:0:ACGTACGT\n{2}\n+\n{3}\n'.format(
+                i, pos, genome[pos:pos + read_len], ''.join(rnd.choice(qual_alphabet) for _ in range(read_len)))
+            f.write(rec.encode())
+            written += len(rec)
+            i += 1
+    return written
+
+
+def bench_read(fpath, method, threads, buffer_size):
+    t0, c0 = time.time(), _cpu_seconds()
+    n = 0
+    with gzip_io.open_fastq(fpath, threads=threads, buffer_size=buffer_size, method=method) as f:
+        for line in f:
+            n += len(line)
+    return n, time.time() - t0, _cpu_seconds() - c0
+
+
+def bench_write(data_fpath, out_fpath, method, threads, level, buffer_size):
+    with gzip_io.open_fastq(data_fpath) as f:
+        data = f.read()
+    t0, c0 = time.time(), _cpu_seconds()
+    with gzip_io.open_fastq(out_fpath, 'wb', threads=threads, level=level, buffer_size=buffer_size, method=method) as f:
+        for i in range(0, len(data), 1 << 16):
+            f.write(data[i:i + (1 << 16)])
+    return len(data), time.time() - t0, _cpu_seconds() - c0
+
+
+def _row(kind, method, n_bytes, wall, cpu):
+    mb = n_bytes / float(1 << 20)
+    return dict(kind=kind, method=method, mb=round(mb, 1), seconds=round(wall, 3),
+                mb_per_s=round(mb / wall, 1) if wall else None,
+                mb_per_cpu_s=round(mb / cpu, 1) if cpu else None)
+
+
+def main():
+    parser = OptionParser(description='Benchmark prealign.gzip_io readers and writers')
+    parser.add_option('--fastq', help='Use this fastq.gz instead of a generated one')
+    parser.add_option('--mb', type='int', default=200, help='Uncompressed size of the generated fastq, MB')
+    parser.add_option('-t', '--threads', type='int', default=4)
+    parser.add_option('--level', type='int', default=gzip_io.DEFAULT_LEVEL)
+    parser.add_option('--buffer-size', type='int', default=gzip_io.DEFAULT_BUFFER_SIZE)
+    parser.add_option('-o', '--output', help='Write results as JSON here')
+    opts, _ = parser.parse_args()
+
+    tmp_dirpath = tempfile.mkdtemp(prefix='gzip_io_bench_')
+    try:
+        fastq_fpath = opts.fastq
+        if not fastq_fpath:
+            fastq_fpath = join(tmp_dirpath, 'bench.fastq.gz')
+            print('Generating ' + str(opts.mb) + ' MB fastq ' + fastq_fpath)
+            make_fastq(fastq_fpath, opts.mb)
+
+        rows = []
+        for method in gzip_io.available_methods('rb'):
+            rows.append(_row('read', method, *bench_read(fastq_fpath, method, opts.threads, opts.buffer_size)))
+        for method in gzip_io.available_methods('wb'):
+            out_fpath = join(tmp_dirpath, 'out_' + method + '.fastq.gz')
+            res = bench_write(fastq_fpath, out_fpath, method, opts.threads, opts.level, opts.buffer_size)
+            row = _row('write', method, *res)
+            row['ratio'] = round(res[0] / float(os.path.getsize(out_fpath)), 2)
+            rows.append(row)
+
+        print('{0:6} {1:8} {2:>8} {3:>9} {4:>12}'.format('kind', 'method', 'MB', 'MB/s', 'MB/cpu-s'))
+        for r in rows:
+            print('{kind:6} {method:8} {mb:>8} {mb_per_s:>9} {mb_per_cpu_s:>12}'.format(**r))
+        if opts.output:
+            with open(opts.output, 'w') as f:
+                json.dump(dict(threads=opts.threads, level=opts.level, buffer_size=opts.buffer_size, results=rows),
+                          f, indent=2)
+    finally:
+        shutil.rmtree(tmp_dirpath)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+""" Builds synthetic Illumina run directories in the layouts DatasetStructure.create recognizes.
+
+    python benchmarks/synthetic_run.py /tmp/bench hiseq4000 --samples 8 --lanes 4 --reads 100000 --read-len 150
+
+Layouts (under <root>/datasets/<kind>/<run_id>/):
+  miseq       Unalign/<project>/<sample>_S<n>_L001_R1_001.fastq.gz, [Data] sample sheet without lanes
+  hiseq       Unalign/Project_<project>/Sample_<sample>/<sample>_<index>_L00<lane>_R1_001.fastq.gz,
+              FCID sample sheet, Unalign/Basecall_Stats_<FCID>/*.htm
+  hiseq4000   Unalign/<project>/<sample>_S<n>_L00<lane>_R1_001.fastq.gz, sample sheet with lanes
+  nextseq500  Unalign/<sample>_S<n>_L00<lane>_R1_001.fastq.gz
+"""
+from __future__ import print_function
+import json
+import random
+import sys
+from optparse import OptionParser
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from ngs_utils.file_utils import safe_mkdir
+
+from prealign.gzip_io import open_fastq
+
+
+KINDS = ('miseq', 'hiseq', 'hiseq4000', 'nextseq500')
+RUN_ID = '170101_SIM001_0001_ASIMFLOWCELL'
+FCID = 'SIMFLOWCELL'
+POOL_SIZE = 4096
+
+
+class RunShape:
+    def __init__(self, samples=4, lanes=2, reads=10000, read_len=100, project='Bench'):
+        self.samples = samples
+        self.lanes = lanes
+        self.reads = reads  # read pairs per sample per lane
+        self.read_len = read_len
+        self.project = project
+
+    def to_dict(self):
+        return dict(samples=self.samples, lanes=self.lanes, reads=self.reads, read_len=self.read_len,
+                    project=self.project)
+
+
+def _index(rnd, length=8):
+    return ''.join(rnd.choice('ACGT') for _ in range(length))
+
+
+def _sample_names(shape):
+    return ['Sim-' + str(i + 1) for i in range(shape.samples)]
+
+
+def write_fastq(fpath, n_reads, read_len, rnd, read_num, lane, barcode):
+    """ Reads are drawn from a pool of random sequences, so the files are fast to generate and have duplicates """
+    pool = [''.join(rnd.choice('ACGT') for _ in range(read_len)) for _ in range(min(POOL_SIZE, n_reads) or 1)]
+    qual = ''.join(rnd.choice('FFFFF:,') for _ in range(read_len))
+    with open_fastq(fpath, 'wb', method='gzip', level=1) as f:
+        for i in range(n_reads):
+            f.write('@SIM:1:{0}:{1}:1101:{2}:{3} {4}:N:0:{5}\n{6}\n+\n{7}\n'.format(
+                FCID, lane, i // 1000, i % 1000, read_num, barcode,
+                pool[rnd.randrange(len(pool))], qual).encode())
+    return fpath
+
+
+def _write_sample_sheet(fpath, kind, shape, indexes):
+    names = _sample_names(shape)
+    with open(fpath, 'w') as f:
+        if kind == 'hiseq':
+            f.write('FCID,Lane,SampleID,SampleRef,Index,Description,Control,Recipe,Operator,SampleProject\n')
+            for lane in range(1, shape.lanes + 1):
+                for sname, index in zip(names, indexes):
+                    f.write(','.join([FCID, str(lane), sname, sname, index, '', 'N', '', 'bench', shape.project]) + '\n')
+            return fpath
+        f.write('[Header]\nIEMFileVersion,4\nExperiment Name,' + RUN_ID + '\n\n[Reads]\n' +
+                str(shape.read_len) + '\n' + str(shape.read_len) + '\n\n[Data]\n')
+        if kind == 'hiseq4000':
+            f.write('Lane,Sample_ID,Sample_Name,Sample_Plate,Sample_Well,I7_Index_ID,index,Sample_Project,Description\n')
+            for lane in range(1, shape.lanes + 1):
+                for sname, index in zip(names, indexes):
+                    f.write(','.join([str(lane), sname, sname, '', '', '', index, shape.project, '']) + '\n')
+        else:
+            f.write('Sample_ID,Sample_Name,Sample_Plate,Sample_Well,I7_Index_ID,index,Sample_Project,Description\n')
+            for sname, index in zip(names, indexes):
+                f.write(','.join([sname, sname, '', '', '', index, shape.project, '']) + '\n')
+    return fpath
+
+
+def make_run(root_dirpath, kind, shape, seed=0):
+    """ Returns (run_dirpath, {sample_name: [(r1_fpath, r2_fpath) per lane]}) """
+    if kind not in KINDS:
+        raise ValueError('Unknown run kind ' + kind + ', expected one of ' + ', '.join(KINDS))
+    rnd = random.Random(seed)
+    run_dirpath = safe_mkdir(join(root_dirpath, 'datasets', kind, RUN_ID))
+    safe_mkdir(join(run_dirpath, 'Data', 'Intensities', 'BaseCalls'))
+    unalign_dirpath = safe_mkdir(join(run_dirpath, 'Unalign'))
+    lanes = [1] if kind == 'miseq' else list(range(1, shape.lanes + 1))
+    indexes = [_index(rnd) for _ in range(shape.samples)]
+    _write_sample_sheet(join(run_dirpath, 'SampleSheet.csv'), kind, shape, indexes)
+
+    if kind == 'hiseq':
+        stats_dirpath = safe_mkdir(join(unalign_dirpath, 'Basecall_Stats_' + FCID))
+        for fname in ['Demultiplex_Stats.htm', 'All.htm', 'IVC.htm']:
+            with open(join(stats_dirpath, fname), 'w') as f:
+                f.write('<html></html>\n')
+    else:
+        with open(join(safe_mkdir(join(unalign_dirpath, 'Reports', 'html')), 'index.html'), 'w') as f:
+            f.write('<html></html>\n')
+
+    fastqs_by_sample = dict()
+    for i, (sname, index) in enumerate(zip(_sample_names(shape), indexes)):
+        if kind == 'hiseq':
+            fastq_dirpath = safe_mkdir(join(unalign_dirpath, 'Project_' + shape.project, 'Sample_' + sname))
+        elif kind == 'nextseq500':
+            fastq_dirpath = unalign_dirpath
+        else:
+            fastq_dirpath = safe_mkdir(join(unalign_dirpath, shape.project))
+        fastqs_by_sample[sname] = []
+        for lane in lanes:
+            prefix = sname + ('_' + index if kind == 'hiseq' else '_S' + str(i + 1)) + '_L%03d' % lane
+            fastqs_by_sample[sname].append(tuple(
+                write_fastq(join(fastq_dirpath, prefix + '_' + read + '_001.fastq.gz'),
+                            shape.reads, shape.read_len, rnd, read_num, lane, index)
+                for read_num, read in [(1, 'R1'), (2, 'R2')]))
+    return run_dirpath, fastqs_by_sample
+
+
+def main():
+    parser = OptionParser(usage='%prog ROOT_DIR KIND [options], KIND is one of ' + ', '.join(KINDS))
+    parser.add_option('--samples', type='int', default=4)
+    parser.add_option('--lanes', type='int', default=2)
+    parser.add_option('--reads', type='int', default=10000, help='Read pairs per sample per lane')
+    parser.add_option('--read-len', type='int', default=100)
+    parser.add_option('--project', default='Bench')
+    parser.add_option('--seed', type='int', default=0)
+    opts, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error('ROOT_DIR and KIND are required')
+    shape = RunShape(opts.samples, opts.lanes, opts.reads, opts.read_len, opts.project)
+    run_dirpath, fastqs_by_sample = make_run(args[0], args[1], shape, seed=opts.seed)
+    print(run_dirpath)
+    print(json.dumps(fastqs_by_sample, indent=2))
+
+
+if __name__ == '__main__':
+    main()
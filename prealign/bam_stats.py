@@ -0,0 +1,307 @@
+""" Streaming BAM statistics in the samtools stats text format.
+
+One pass over a BAM computes the summary numbers (SN), the insert size histogram (IS)
+and mismatches per cycle and base quality (MPC, from the MD tag), which is what the
+MultiQC samtools module and the project reports use. BGZF is a multi-member gzip, so the
+BAM is read with the gzip module; the downsampled BAMs are small enough for this to take
+seconds per sample, without requiring samtools on the engines.
+"""
+import gzip
+import struct
+from collections import defaultdict
+
+from ngs_utils.file_utils import file_transaction
+
+
+MAX_INSERT_SIZE = 8000  # same default as samtools stats
+MAX_QUAL = 93
+
+FLAG_PAIRED = 0x1
+FLAG_PROPER_PAIR = 0x2
+FLAG_UNMAPPED = 0x4
+FLAG_MATE_UNMAPPED = 0x8
+FLAG_REVERSE = 0x10
+FLAG_MATE_REVERSE = 0x20
+FLAG_READ1 = 0x40
+FLAG_READ2 = 0x80
+FLAG_SECONDARY = 0x100
+FLAG_QCFAIL = 0x200
+FLAG_DUP = 0x400
+FLAG_SUPPLEMENTARY = 0x800
+
+_SEQ_N = 15
+_CIGAR_QUERY_OPS = (0, 1, 4, 7, 8)    # M I S = X
+_CIGAR_ALIGNED_OPS = (0, 7, 8)        # M = X
+_CIGAR_CIGAR_BASES_OPS = (0, 1, 7, 8) # M I = X, counted in "bases mapped (cigar)"
+
+_core = struct.Struct('<iiBBHHHiiii')
+_aux_sizes = {b'A': 1, b'c': 1, b'C': 1, b's': 2, b'S': 2, b'i': 4, b'I': 4, b'f': 4}
+_aux_int_formats = {b'c': '<b', b'C': '<B', b's': '<h', b'S': '<H', b'i': '<i', b'I': '<I'}
+
+
+class BamFormatError(Exception):
+    pass
+
+
+def _read_exact(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise BamFormatError('Truncated BAM file')
+    return data
+
+
+def _parse_aux(aux, wanted=(b'MD', b'NM')):
+    """ Returns {tag: value} for the wanted tags """
+    found = dict()
+    i = 0
+    n = len(aux)
+    while i + 3 <= n:
+        tag, typ = aux[i:i + 2], aux[i + 2:i + 3]
+        i += 3
+        if typ == b'Z' or typ == b'H':
+            end = aux.index(b'\0', i)
+            if tag in wanted:
+                found[tag] = aux[i:end].decode()
+            i = end + 1
+        elif typ == b'B':
+            subtyp = aux[i:i + 1]
+            count = struct.unpack_from('<i', aux, i + 1)[0]
+            i += 5 + count * _aux_sizes[subtyp]
+        else:
+            size = _aux_sizes[typ]
+            if tag in wanted and typ in _aux_int_formats:
+                found[tag] = struct.unpack_from(_aux_int_formats[typ], aux, i)[0]
+            i += size
+    return found
+
+
+def _aligned_query_positions(cigar):
+    """ Query offsets of M/=/X positions, in reference order, which is what MD refers to """
+    positions = []
+    qpos = 0
+    for op_len, op in cigar:
+        if op in _CIGAR_ALIGNED_OPS:
+            positions.extend(range(qpos, qpos + op_len))
+        if op in _CIGAR_QUERY_OPS:
+            qpos += op_len
+    return positions
+
+
+def _md_mismatch_offsets(md, aligned_positions):
+    """ Query offsets of the mismatching bases described by the MD tag """
+    offsets = []
+    i = 0
+    idx = 0
+    n = len(md)
+    while i < n:
+        c = md[i]
+        if c.isdigit():
+            j = i
+            while j < n and md[j].isdigit():
+                j += 1
+            idx += int(md[i:j])
+            i = j
+        elif c == '^':
+            i += 1
+            while i < n and md[i].isalpha():
+                i += 1
+        else:
+            if idx < len(aligned_positions):
+                offsets.append(aligned_positions[idx])
+            idx += 1
+            i += 1
+    return offsets
+
+
+class BamStats:
+    def __init__(self):
+        self.raw_total = 0
+        self.qc_failed = 0
+        self.non_primary = 0
+        self.paired = 0
+        self.mapped = 0
+        self.mapped_and_paired = 0
+        self.unmapped = 0
+        self.properly_paired = 0
+        self.duplicated = 0
+        self.mq0 = 0
+        self.read1 = 0
+        self.read2 = 0
+        self.total_length = 0
+        self.bases_mapped = 0
+        self.bases_mapped_cigar = 0
+        self.bases_duplicated = 0
+        self.mismatches = 0
+        self.qual_sum = 0
+        self.max_length = 0
+        self.diff_chrom_pairs = 0
+        self.insert_sizes = defaultdict(lambda: [0, 0, 0])  # size -> [inward, outward, other]
+        self.mismatches_by_cycle = defaultdict(lambda: [0] * (MAX_QUAL + 2))  # cycle -> [N, q0, q1, ...]
+
+    def add(self, flag, ref_id, pos, mapq, next_ref_id, next_pos, tlen, cigar, seq, qual, aux):
+        if flag & (FLAG_SECONDARY | FLAG_SUPPLEMENTARY):
+            self.non_primary += 1
+            return
+        l_seq = len(qual)
+        self.raw_total += 1
+        if flag & FLAG_QCFAIL:
+            self.qc_failed += 1
+        self.total_length += l_seq
+        self.max_length = max(self.max_length, l_seq)
+        if qual and qual[0] != 0xff:
+            self.qual_sum += sum(bytearray(qual))
+        if flag & FLAG_READ1:
+            self.read1 += 1
+        if flag & FLAG_READ2:
+            self.read2 += 1
+        if flag & FLAG_DUP:
+            self.duplicated += 1
+            self.bases_duplicated += l_seq
+        if flag & FLAG_PAIRED:
+            self.paired += 1
+
+        if flag & FLAG_UNMAPPED:
+            self.unmapped += 1
+            return
+        self.mapped += 1
+        self.bases_mapped += l_seq
+        self.bases_mapped_cigar += sum(op_len for op_len, op in cigar if op in _CIGAR_CIGAR_BASES_OPS)
+        if mapq == 0:
+            self.mq0 += 1
+
+        if flag & FLAG_PAIRED and not flag & FLAG_MATE_UNMAPPED:
+            self.mapped_and_paired += 1
+            if flag & FLAG_PROPER_PAIR:
+                self.properly_paired += 1
+            if ref_id != next_ref_id:
+                self.diff_chrom_pairs += 1
+            elif flag & FLAG_READ1 and tlen:
+                self._add_insert_size(flag, pos, next_pos, abs(tlen))
+
+        tags = _parse_aux(aux)
+        self.mismatches += tags.get(b'NM', 0)
+        md = tags.get(b'MD')
+        if md:
+            self._add_mismatches(flag, cigar, seq, qual, md)
+
+    def _add_insert_size(self, flag, pos, next_pos, isize):
+        isize = min(isize, MAX_INSERT_SIZE)
+        rev = bool(flag & FLAG_REVERSE)
+        mate_rev = bool(flag & FLAG_MATE_REVERSE)
+        if rev == mate_rev:
+            orientation = 2
+        elif pos <= next_pos:
+            orientation = 1 if rev else 0
+        else:
+            orientation = 0 if rev else 1
+        self.insert_sizes[isize][orientation] += 1
+
+    def _add_mismatches(self, flag, cigar, seq, qual, md):
+        l_seq = len(qual)
+        has_qual = qual and qual[0] != 0xff
+        reverse = flag & FLAG_REVERSE
+        for offset in _md_mismatch_offsets(md, _aligned_query_positions(cigar)):
+            cycle = (l_seq - offset if reverse else offset + 1)
+            base_code = (seq[offset // 2] >> 4) if offset % 2 == 0 else (seq[offset // 2] & 0xf)
+            row = self.mismatches_by_cycle[cycle]
+            if base_code == _SEQ_N:
+                row[0] += 1
+            else:
+                row[1 + (min(qual[offset], MAX_QUAL) if has_qual else 0)] += 1
+
+    def summary_numbers(self):
+        sizes = sorted(self.insert_sizes.items())
+        n_pairs = sum(sum(c) for _, c in sizes)
+        is_avg = sum(s * sum(c) for s, c in sizes) / float(n_pairs) if n_pairs else 0.0
+        is_sd = (sum(sum(c) * (s - is_avg) ** 2 for s, c in sizes) / n_pairs) ** 0.5 if n_pairs else 0.0
+        return [
+            ('raw total sequences', self.raw_total),
+            ('filtered sequences', 0),
+            ('sequences', self.raw_total),
+            ('is sorted', 0),
+            ('1st fragments', self.read1 if self.paired else self.raw_total),
+            ('last fragments', self.read2),
+            ('reads mapped', self.mapped),
+            ('reads mapped and paired', self.mapped_and_paired),
+            ('reads unmapped', self.unmapped),
+            ('reads properly paired', self.properly_paired),
+            ('reads paired', self.paired),
+            ('reads duplicated', self.duplicated),
+            ('reads MQ0', self.mq0),
+            ('reads QC failed', self.qc_failed),
+            ('non-primary alignments', self.non_primary),
+            ('total length', self.total_length),
+            ('bases mapped', self.bases_mapped),
+            ('bases mapped (cigar)', self.bases_mapped_cigar),
+            ('bases duplicated', self.bases_duplicated),
+            ('mismatches', self.mismatches),
+            ('error rate', float(self.mismatches) / self.bases_mapped_cigar if self.bases_mapped_cigar else 0.0),
+            ('average length', self.total_length // self.raw_total if self.raw_total else 0),
+            ('maximum length', self.max_length),
+            ('average quality', float(self.qual_sum) / self.total_length if self.total_length else 0.0),
+            ('insert size average', is_avg),
+            ('insert size standard deviation', is_sd),
+            ('pairs on different chromosomes', self.diff_chrom_pairs // 2),
+        ]
+
+    def write(self, output_fpath, bam_fpath):
+        with open(output_fpath, 'w') as f:
+            f.write('# This file was produced by samtools stats (prealign.bam_stats) and can be plotted using plot-bamstats\n')
+            f.write('# The command line was:  stats ' + bam_fpath + '\n')
+            f.write('# Summary Numbers. Use `grep ^SN | cut -f 2-` to extract this part.\n')
+            for name, value in self.summary_numbers():
+                f.write('SN\t' + name + ':\t' + (('%.6e' % value if name == 'error rate' else '%.1f' % value)
+                                                 if isinstance(value, float) else str(value)) + '\n')
+            f.write('# Insert sizes. Use `grep ^IS | cut -f 2-` to extract this part. '
+                    'The columns are: insert size, pairs total, inward oriented pairs, outward oriented pairs, other pairs\n')
+            for size, (inward, outward, other) in sorted(self.insert_sizes.items()):
+                f.write('\t'.join(str(v) for v in ['IS', size, inward + outward + other, inward, outward, other]) + '\n')
+            f.write('# Mismatches per cycle and quality. Use `grep ^MPC | cut -f 2-` to extract this part. '
+                    'The columns are: cycle, number of mismatches with N, then with base qualities 0, 1, 2, ...\n')
+            for cycle, row in sorted(self.mismatches_by_cycle.items()):
+                f.write('MPC\t' + str(cycle) + '\t' + '\t'.join(str(c) for c in row) + '\n')
+
+
+def iter_bam_records(bam_fpath):
+    """ Yields (flag, ref_id, pos, mapq, next_ref_id, next_pos, tlen, cigar, seq, qual, aux) """
+    with gzip.open(bam_fpath, 'rb') as f:
+        if _read_exact(f, 4) != b'BAM\1':
+            raise BamFormatError(bam_fpath + ' is not a BAM file')
+        l_text = struct.unpack('<i', _read_exact(f, 4))[0]
+        _read_exact(f, l_text)
+        n_ref = struct.unpack('<i', _read_exact(f, 4))[0]
+        for _ in range(n_ref):
+            l_name = struct.unpack('<i', _read_exact(f, 4))[0]
+            _read_exact(f, l_name + 4)
+
+        while True:
+            size_bytes = f.read(4)
+            if not size_bytes:
+                break
+            if len(size_bytes) != 4:
+                raise BamFormatError('Truncated BAM record in ' + bam_fpath)
+            block = _read_exact(f, struct.unpack('<i', size_bytes)[0])
+            ref_id, pos, l_read_name, mapq, _bin, n_cigar_op, flag, l_seq, next_ref_id, next_pos, tlen = \
+                _core.unpack_from(block, 0)
+            i = _core.size + l_read_name
+            cigar = [(c >> 4, c & 0xf) for c in struct.unpack_from('<' + 'I' * n_cigar_op, block, i)]
+            i += 4 * n_cigar_op
+            seq = bytearray(block[i:i + (l_seq + 1) // 2])
+            i += (l_seq + 1) // 2
+            qual = bytearray(block[i:i + l_seq])
+            i += l_seq
+            yield flag, ref_id, pos, mapq, next_ref_id, next_pos, tlen, cigar, seq, qual, block[i:]
+
+
+def bam_stats(bam_fpath):
+    stats = BamStats()
+    for rec in iter_bam_records(bam_fpath):
+        stats.add(*rec)
+    return stats
+
+
+def write_bam_stats(bam_fpath, output_fpath):
+    stats = bam_stats(bam_fpath)
+    with file_transaction(None, output_fpath) as tx:
+        stats.write(tx, bam_fpath)
+    return output_fpath
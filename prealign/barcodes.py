@@ -0,0 +1,109 @@
+""" Sample sheet barcode check: index collisions and minimum Hamming distances per lane.
+
+All pairwise distances of a lane are computed at once with NumPy: barcodes are encoded into a
+padded uint8 matrix with a validity mask, so i7/i5 of different lengths are compared over the
+positions both have, as bcl2fastq does when it trims indexes to a common length. The i7 and i5
+distances are added up for dual-indexed samples. Pairs at distance 0 cannot be demultiplexed;
+pairs closer than MIN_DISTANCE collide once bcl2fastq allows one mismatch per index.
+"""
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+from ngs_utils.logger import info, warn, err
+
+
+MIN_DISTANCE = 3
+BLOCK_ROWS = 256  # bounds the (rows, n, length) comparison array for large pooled sheets
+
+
+def split_index(index, index2=None):
+    """ "ACGT-TTGA" in the Index column of HiSeq sheets is i7-i5 """
+    index = (index or '').strip().upper()
+    index2 = (index2 or '').strip().upper()
+    if not index2 and '-' in index:
+        index, index2 = index.split('-', 1)
+    return index, index2
+
+
+def encode(barcodes):
+    """ Returns (codes, valid): an (n, max_len) uint8 matrix of the barcode letters and a mask of present positions """
+    max_len = max([len(b) for b in barcodes] or [0])
+    codes = np.zeros((len(barcodes), max_len), dtype=np.uint8)
+    valid = np.zeros((len(barcodes), max_len), dtype=bool)
+    for i, b in enumerate(barcodes):
+        if b:
+            codes[i, :len(b)] = np.frombuffer(b.encode(), dtype=np.uint8)
+            valid[i, :len(b)] = True
+    return codes, valid
+
+
+def pairwise_distances(barcodes):
+    """ (n, n) int matrix of Hamming distances over the positions present in both barcodes """
+    codes, valid = encode(barcodes)
+    n = len(barcodes)
+    dist = np.zeros((n, n), dtype=np.int32)
+    for start in range(0, n, BLOCK_ROWS):
+        block = slice(start, min(n, start + BLOCK_ROWS))
+        mismatch = (codes[block, None, :] != codes[None, :, :]) & valid[block, None, :] & valid[None, :, :]
+        dist[block] = mismatch.sum(axis=2)
+    return dist
+
+
+class LaneBarcodeCheck:
+    def __init__(self, lane, sample_names, distances):
+        self.lane = lane
+        self.sample_names = sample_names
+        self.distances = distances
+
+    def _pairs(self, max_distance):
+        iu = np.triu_indices(len(self.sample_names), k=1)
+        close = self.distances[iu] <= max_distance
+        return [(self.sample_names[i], self.sample_names[j], int(d))
+                for i, j, d in zip(iu[0][close], iu[1][close], self.distances[iu][close])]
+
+    @property
+    def min_distance(self):
+        if len(self.sample_names) < 2:
+            return None
+        return int(self.distances[np.triu_indices(len(self.sample_names), k=1)].min())
+
+    @property
+    def collisions(self):
+        return self._pairs(0)
+
+    def close_pairs(self, min_distance=MIN_DISTANCE):
+        return [p for p in self._pairs(min_distance - 1) if p[2] > 0]
+
+
+def check_lane(lane, indexes_by_sample):
+    """ indexes_by_sample: {sample_name: (i7, i5)} of one lane """
+    names = [sname for sname, (i7, _) in indexes_by_sample.items() if i7]
+    i7s = [indexes_by_sample[sname][0] for sname in names]
+    i5s = [indexes_by_sample[sname][1] for sname in names]
+    dist = pairwise_distances(i7s)
+    if any(i5s):
+        dist += pairwise_distances(i5s)
+    return LaneBarcodeCheck(lane, names, dist)
+
+
+def check_barcodes(project_by_name, min_distance=MIN_DISTANCE):
+    """ Checks all samples sharing a lane, across projects. Returns [LaneBarcodeCheck] """
+    indexes_by_lane = defaultdict(OrderedDict)
+    for project in project_by_name.values():
+        for s in project.sample_by_name.values():
+            i7, i5 = split_index(s.index, s.index2)
+            for lane in s.lane_numbers or [1]:
+                indexes_by_lane[str(lane)][s.name] = (i7, i5)
+
+    checks = [check_lane(lane, indexes_by_lane[lane]) for lane in sorted(indexes_by_lane)]
+    for c in checks:
+        if c.min_distance is None:
+            continue
+        info('  lane ' + c.lane + ': ' + str(len(c.sample_names)) + ' barcodes, minimum distance ' + str(c.min_distance))
+        for s1, s2, _ in c.collisions:
+            err('  lane ' + c.lane + ': samples ' + s1 + ' and ' + s2 + ' have identical barcodes')
+        for s1, s2, d in c.close_pairs(min_distance):
+            warn('  lane ' + c.lane + ': barcodes of ' + s1 + ' and ' + s2 + ' are ' + str(d) +
+                 ' mismatches apart, less than ' + str(min_distance))
+    return checks
@@ -0,0 +1,209 @@
+""" Structured parsing of bcl2fastq v2 demultiplexing statistics.
+
+Reads Stats/Stats.json, or Stats/ConversionStats.xml when the JSON is missing. The XML
+can be hundreds of MB on large flowcells, so it is parsed with iterparse, aggregating
+and discarding one <Tile> element at a time.
+"""
+import json
+import re
+from collections import OrderedDict
+from os.path import join
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+from ngs_utils.logger import info, debug, warn
+
+from prealign.fs_cache import fs_cache
+
+
+STATS_JSON_FNAME = 'Stats.json'
+CONVERSION_STATS_XML_FNAME = 'ConversionStats.xml'
+
+
+def _pct(a, b):
+    return 100.0 * a / b if b else None
+
+
+def normalize_sample_name(name):
+    """ Same normalization as DatasetSample names """
+    return re.sub(r'[\W_]', r'_', name or '')
+
+
+class LaneStats:
+    def __init__(self, lane):
+        self.lane = lane
+        self.clusters_raw = 0
+        self.clusters_pf = 0
+        self.yield_bases = 0
+        self.undetermined_reads = 0
+        self.undetermined_yield = 0
+
+    @property
+    def pf_pct(self):
+        return _pct(self.clusters_pf, self.clusters_raw)
+
+    @property
+    def undetermined_pct(self):
+        return _pct(self.undetermined_reads, self.clusters_pf)
+
+
+class SampleDemuxStats:
+    def __init__(self, sample_id, sample_name):
+        self.sample_id = sample_id
+        self.sample_name = sample_name
+        self.lanes = []
+        self.reads = 0
+        self.yield_bases = 0
+        self.yield_q30 = 0
+        self.index_reads = 0          # reads counted in IndexMetrics (Stats.json only)
+        self.perfect_index_reads = 0
+        self.one_mismatch_index_reads = 0
+
+    @property
+    def q30_pct(self):
+        return _pct(self.yield_q30, self.yield_bases)
+
+    @property
+    def perfect_index_pct(self):
+        return _pct(self.perfect_index_reads, self.index_reads)
+
+    @property
+    def one_mismatch_index_pct(self):
+        return _pct(self.one_mismatch_index_reads, self.index_reads)
+
+
+class Bcl2fastqStats:
+    def __init__(self, source_fpath):
+        self.source_fpath = source_fpath
+        self.flowcell = None
+        self.lane_by_number = OrderedDict()
+        self.sample_by_id = OrderedDict()
+        self.unknown_barcodes_by_lane = OrderedDict()  # lane -> [(barcode, count)], Stats.json only
+
+    def get_lane(self, lane):
+        if lane not in self.lane_by_number:
+            self.lane_by_number[lane] = LaneStats(lane)
+        return self.lane_by_number[lane]
+
+    def get_sample(self, sample_id, sample_name):
+        if sample_id not in self.sample_by_id:
+            self.sample_by_id[sample_id] = SampleDemuxStats(sample_id, sample_name)
+        return self.sample_by_id[sample_id]
+
+    def find_sample(self, name):
+        """ Finds sample stats by a DatasetSample name """
+        name = normalize_sample_name(name)
+        for s in self.sample_by_id.values():
+            if normalize_sample_name(s.sample_name) == name or normalize_sample_name(s.sample_id) == name:
+                return s
+        return None
+
+    def log_summary(self):
+        for l in self.lane_by_number.values():
+            info('  Lane ' + str(l.lane) + ': ' + str(l.clusters_raw) + ' clusters, ' +
+                 ('%.1f' % l.pf_pct if l.pf_pct is not None else '-') + '% PF, ' +
+                 ('%.1f' % l.undetermined_pct if l.undetermined_pct is not None else '-') + '% undetermined')
+
+
+def parse_stats_json(fpath):
+    with open(fpath) as f:
+        data = json.load(f)
+    stats = Bcl2fastqStats(fpath)
+    stats.flowcell = data.get('Flowcell')
+
+    for conv in data.get('ConversionResults', []):
+        lane = stats.get_lane(int(conv['LaneNumber']))
+        lane.clusters_raw += conv.get('TotalClustersRaw', 0)
+        lane.clusters_pf += conv.get('TotalClustersPF', 0)
+        lane.yield_bases += conv.get('Yield', 0)
+        for dr in conv.get('DemuxResults', []):
+            s = stats.get_sample(dr.get('SampleId'), dr.get('SampleName'))
+            s.lanes.append(lane.lane)
+            s.reads += dr.get('NumberReads', 0)
+            s.yield_bases += dr.get('Yield', 0)
+            s.yield_q30 += sum(rm.get('YieldQ30', 0) for rm in dr.get('ReadMetrics', []))
+            for im in dr.get('IndexMetrics', []):
+                counts = im.get('MismatchCounts', dict())
+                s.index_reads += sum(counts.values())
+                s.perfect_index_reads += counts.get('0', 0)
+                s.one_mismatch_index_reads += counts.get('1', 0)
+        und = conv.get('Undetermined') or dict()
+        lane.undetermined_reads += und.get('NumberReads', 0)
+        lane.undetermined_yield += und.get('Yield', 0)
+
+    for ub in data.get('UnknownBarcodes', []):
+        barcodes = sorted(ub.get('Barcodes', dict()).items(), key=lambda kv: -kv[1])
+        stats.unknown_barcodes_by_lane[int(ub['Lane'])] = barcodes
+    return stats
+
+
+def parse_conversion_stats_xml(fpath):
+    """ Streams ConversionStats.xml. Per-lane totals come from the Project="all" aggregate,
+        per-sample numbers from the real projects, undetermined reads from Sample="Undetermined".
+    """
+    stats = Bcl2fastqStats(fpath)
+    project = sample = barcode = lane = None
+    tile = None
+
+    for event, elem in ElementTree.iterparse(fpath, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            if tag == 'Flowcell':
+                stats.flowcell = elem.get('flowcell-id')
+            elif tag == 'Project':
+                project = elem.get('name')
+            elif tag == 'Sample':
+                sample = elem.get('name')
+            elif tag == 'Barcode':
+                barcode = elem.get('name')
+            elif tag == 'Lane':
+                lane = int(elem.get('number'))
+            continue
+
+        if tag == 'Tile':
+            raw_clusters = int(elem.findtext('Raw/ClusterCount') or 0)
+            pf_clusters = int(elem.findtext('Pf/ClusterCount') or 0)
+            pf_yield = sum(int(r.findtext('Yield') or 0) for r in elem.findall('Pf/Read'))
+            pf_yield_q30 = sum(int(r.findtext('YieldQ30') or 0) for r in elem.findall('Pf/Read'))
+            if project == 'all':
+                if sample == 'all' and barcode == 'all':
+                    l = stats.get_lane(lane)
+                    l.clusters_raw += raw_clusters
+                    l.clusters_pf += pf_clusters
+                    l.yield_bases += pf_yield
+            elif sample == 'Undetermined':
+                l = stats.get_lane(lane)
+                l.undetermined_reads += pf_clusters
+                l.undetermined_yield += pf_yield
+            elif sample != 'all' and barcode != 'all':
+                s = stats.get_sample(sample, sample)
+                if not s.lanes or s.lanes[-1] != lane:
+                    s.lanes.append(lane)
+                s.reads += pf_clusters
+                s.yield_bases += pf_yield
+                s.yield_q30 += pf_yield_q30
+            elem.clear()
+        elif tag in ('Lane', 'Barcode', 'Sample', 'Project'):
+            elem.clear()
+    return stats
+
+
+def load_bcl2fastq_stats(stats_dirpath):
+    """ Returns Bcl2fastqStats parsed from stats_dirpath (bcl2fastq's Stats/ dir), or None """
+    if not stats_dirpath or not fs_cache.isdir(stats_dirpath):
+        return None
+    json_fpath = join(stats_dirpath, STATS_JSON_FNAME)
+    xml_fpath = join(stats_dirpath, CONVERSION_STATS_XML_FNAME)
+    try:
+        if fs_cache.isfile(json_fpath):
+            debug('Parsing ' + json_fpath)
+            return parse_stats_json(json_fpath)
+        if fs_cache.isfile(xml_fpath):
+            debug('Parsing ' + xml_fpath)
+            return parse_conversion_stats_xml(xml_fpath)
+    except (ValueError, KeyError, ElementTree.ParseError) as e:
+        warn('Cannot parse bcl2fastq stats in ' + stats_dirpath + ': ' + str(e))
+    return None
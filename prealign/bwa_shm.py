@@ -0,0 +1,289 @@
+""" Keeps the BWA index resident in shared memory (bwa shm) while prealign aligns downsampled reads.
+
+Loading a multi-GB hg19/hg38 index from shared storage takes longer than aligning 500k pairs,
+so every node used by a run loads the index once with "bwa shm", and "bwa mem" then picks it
+up from /dev/shm by the index basename. A run pins the index on a node with a pin file in a
+node-local directory, under a lock, once the index is resident there, so concurrent runs and
+engines share one copy. pin_index() returns the host names, and the pins are released by jobs
+sent to exactly those hosts (see host_parallel_cfg). "bwa shm -d" can only drop all staged
+indices of a node, so the index is dropped only when the last pin is released, a prealign run
+staged it, and no other index is resident. Pins older than MAX_PIN_AGE are treated as left
+over from killed runs.
+
+    python -m prealign.bwa_shm --list
+    python -m prealign.bwa_shm --release RUN_ID   # release a pin of a run that could not release it
+    python -m prealign.bwa_shm --drop             # drop all bwa shm indices on this node
+"""
+import copy
+import fcntl
+import os
+import socket
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from os.path import join, basename, isfile, getsize, getmtime
+
+from ngs_utils.logger import info, warn, debug
+from ngs_utils.file_utils import which, safe_mkdir
+from ngs_utils.parallel import parallel_view
+
+
+INDEX_EXTS = ['.amb', '.ann', '.bwt', '.pac', '.sa']
+SHM_DIRPATH = '/dev/shm'
+MAX_PIN_AGE = 2 * 24 * 3600
+STAGED_EXT = '.staged'
+
+# Scheduler resources that send a job to one host, appended to ParallelCfg.resources
+HOST_RESOURCE_BY_SCHEDULER = {
+    'sge':    'hostname={host}',
+    'lsf':    'select[hname=={host}]',
+    'torque': 'nodes={host}',
+    'pbspro': 'host={host}',
+    'slurm':  'nodelist={host}',
+}
+
+
+def _pins_dirpath():
+    return join(tempfile.gettempdir(), 'prealign_bwa_shm')
+
+
+@contextmanager
+def _node_lock():
+    dirpath = safe_mkdir(_pins_dirpath())
+    with open(join(dirpath, '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield dirpath
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _bwa():
+    bwa = which('bwa')
+    if not bwa:
+        raise OSError('bwa is not found in PATH')
+    return bwa
+
+
+def index_size(bwa_prefix):
+    return sum(getsize(bwa_prefix + ext) for ext in INDEX_EXTS if isfile(bwa_prefix + ext))
+
+
+def loaded_indices():
+    """ Returns {index basename: size} from "bwa shm -l" """
+    try:
+        out = subprocess.check_output([_bwa(), 'shm', '-l'], stderr=subprocess.STDOUT).decode()
+    except subprocess.CalledProcessError:  # nothing is staged yet
+        return dict()
+    loaded = dict()
+    for line in out.splitlines():
+        fs = line.split('\t')
+        if len(fs) == 2 and fs[1].isdigit():
+            loaded[fs[0]] = int(fs[1])
+    return loaded
+
+
+def is_loaded(bwa_prefix):
+    return basename(bwa_prefix) in loaded_indices()
+
+
+def _live_pins(dirpath):
+    now = time.time()
+    pins = []
+    for fname in os.listdir(dirpath):
+        if not fname.endswith('.pin'):
+            continue
+        fpath = join(dirpath, fname)
+        if now - getmtime(fpath) > MAX_PIN_AGE:
+            debug('Removing stale bwa shm pin ' + fpath)
+            os.remove(fpath)
+        else:
+            pins.append(fname[:-len('.pin')])
+    return pins
+
+
+def _same_host(a, b):
+    return a.split('.')[0] == b.split('.')[0]
+
+
+def _staged_marker(dirpath, bwa_prefix):
+    """ Marks an index loaded by a prealign run, so that prealign never drops an index someone else staged """
+    return join(dirpath, basename(bwa_prefix) + STAGED_EXT)
+
+
+def pin_index(bwa_prefix, run_id):
+    """ Runs on an engine. Loads the index into shared memory on this node unless it is there already,
+        and pins it for run_id once it is resident. Returns (hostname, seconds spent loading, whether it is pinned).
+    """
+    import os
+    import socket
+    import subprocess
+    import time
+    from os.path import join
+    from ngs_utils.logger import warn
+    from prealign.bwa_shm import _node_lock, _staged_marker, is_loaded, index_size, _bwa, SHM_DIRPATH
+    host = socket.gethostname()
+    with _node_lock() as dirpath:
+        sec = 0.0
+        if not is_loaded(bwa_prefix):
+            st = os.statvfs(SHM_DIRPATH)
+            if st.f_bavail * st.f_frsize < index_size(bwa_prefix):
+                warn(host + ': not enough space in ' + SHM_DIRPATH + ' for the BWA index ' + bwa_prefix +
+                     ', aligning with the index from disk')
+                return host, 0.0, False
+            t0 = time.time()
+            if subprocess.call([_bwa(), 'shm', bwa_prefix]) != 0 or not is_loaded(bwa_prefix):
+                warn(host + ': "bwa shm ' + bwa_prefix + '" failed, aligning with the index from disk')
+                return host, 0.0, False
+            sec = time.time() - t0
+            with open(_staged_marker(dirpath, bwa_prefix), 'w') as f:
+                f.write(run_id + '\n')
+        with open(join(dirpath, run_id + '.pin'), 'w') as f:
+            f.write(bwa_prefix + '\n')
+        return host, sec, True
+
+
+def unpin_index(run_id, host):
+    """ Runs on an engine sent to host. Releases the pin of run_id and drops the index if no other run holds
+        a pin (see drop_staged_index). Returns (hostname, whether the index was dropped), or (hostname, None)
+        if the engine landed on another node, which is left untouched.
+    """
+    import os
+    import socket
+    from os.path import join, isfile
+    from prealign.bwa_shm import _node_lock, _live_pins, _same_host, drop_staged_index
+    this_host = socket.gethostname()
+    if not _same_host(this_host, host):
+        return this_host, None
+    with _node_lock() as dirpath:
+        pin_fpath = join(dirpath, run_id + '.pin')
+        if not isfile(pin_fpath):
+            return this_host, False
+        with open(pin_fpath) as f:
+            bwa_prefix = f.read().strip()
+        os.remove(pin_fpath)
+        if _live_pins(dirpath):
+            return this_host, False
+        return this_host, drop_staged_index(dirpath, bwa_prefix)
+
+
+def drop_staged_index(dirpath, bwa_prefix):
+    """ Called under the node lock when no pins are left. "bwa shm -d" drops all staged indices of the node,
+        so the index is dropped only if a prealign run staged it and no other index is resident.
+    """
+    marker_fpath = _staged_marker(dirpath, bwa_prefix)
+    if not isfile(marker_fpath):
+        debug('The BWA index ' + bwa_prefix + ' was not staged by prealign, leaving it in shared memory')
+        return False
+    loaded = loaded_indices()
+    name = basename(bwa_prefix)
+    if name not in loaded:
+        os.remove(marker_fpath)
+        return False
+    others = sorted(n for n in loaded if n != name)
+    if others:
+        warn(socket.gethostname() + ': leaving the BWA index ' + name + ' in shared memory, dropping it would '
+             'also drop ' + ', '.join(others))
+        return False
+    drop_indices()
+    os.remove(marker_fpath)
+    return True
+
+
+def drop_indices():
+    """ "bwa shm -d" drops all staged indices on the node, there is no way to drop a single one """
+    subprocess.call([_bwa(), 'shm', '-d'])
+
+
+def host_parallel_cfg(parallel_cfg, host):
+    """ A copy of parallel_cfg whose jobs run on host, or None if the scheduler cannot be asked for a host.
+        Without a scheduler, engines run on this node.
+    """
+    if not parallel_cfg.scheduler:
+        return parallel_cfg
+    fmt = HOST_RESOURCE_BY_SCHEDULER.get(parallel_cfg.scheduler.lower())
+    if not fmt:
+        return None
+    cfg = copy.copy(parallel_cfg)
+    cfg.resources = ';'.join(r for r in [parallel_cfg.resources, fmt.format(host=host)] if r)
+    return cfg
+
+
+def pin_on_nodes(view, n_tasks, bwa_prefix, run_id):
+    """ Pins the index on every node the view's engines run on. Without node affinity in the scheduler,
+        one task per alignment job is submitted; the node lock makes repeated tasks on one node cheap.
+        Returns {hostname: seconds spent loading} of the nodes where the index got pinned.
+    """
+    res = view.run(pin_index, [[bwa_prefix, run_id] for _ in range(n_tasks)])
+    load_sec_by_host = dict()
+    for host, sec, pinned in res:
+        if pinned:
+            load_sec_by_host[host] = max(load_sec_by_host.get(host, 0.0), sec)
+    for host, sec in sorted(load_sec_by_host.items()):
+        if sec:
+            info('  ' + host + ': loaded the BWA index into shared memory in ' + '%.1f' % sec + 's')
+        else:
+            info('  ' + host + ': the BWA index is already in shared memory')
+    return load_sec_by_host
+
+
+def _unpin_on_host(host, run_id, parallel_cfg, work_dirpath):
+    cfg = host_parallel_cfg(parallel_cfg, host)
+    if cfg is None:
+        return host, None
+    try:
+        with parallel_view(1, cfg, join(work_dirpath, host)) as view:
+            return view.run(unpin_index, [[run_id, host]])[0]
+    except Exception as e:  # the run is over, a failed release must not hide its result
+        warn('  ' + host + ': ' + str(e))
+        return host, None
+
+
+def unpin_on_nodes(parallel_cfg, work_dirpath, pinned_hosts, run_id):
+    """ Releases the pins of run_id with one job sent to each of pinned_hosts, the hosts pin_on_nodes returned """
+    pinned_hosts = sorted(pinned_hosts)
+    if not pinned_hosts:
+        return
+    pool = ThreadPool(min(len(pinned_hosts), 8))
+    try:
+        res = pool.map(lambda h: _unpin_on_host(h, run_id, parallel_cfg, work_dirpath), pinned_hosts)
+    finally:
+        pool.close()
+    for host, (_, dropped) in zip(pinned_hosts, res):
+        if dropped is None:
+            warn('  ' + host + ': could not send a job to release the BWA index pin, it expires in ' +
+                 str(MAX_PIN_AGE // 3600) + 'h; release it now with "python -m prealign.bwa_shm --release ' +
+                 run_id + '" on ' + host)
+        elif dropped:
+            info('  ' + host + ': dropped the BWA index from shared memory')
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage='python -m prealign.bwa_shm [--list | --release RUN_ID | --drop]')
+    parser.add_option('--list', action='store_true', default=False, help='List staged indices and prealign pins')
+    parser.add_option('--release', dest='release', help='Release the pin of a prealign run on this node')
+    parser.add_option('--drop', action='store_true', default=False, help='Drop all staged indices and pins')
+    opts, _ = parser.parse_args()
+    if opts.release:
+        host, dropped = unpin_index(opts.release, socket.gethostname())
+        if dropped:
+            info(host + ': dropped the BWA index from shared memory')
+    elif opts.drop:
+        with _node_lock() as dirpath:
+            for fname in os.listdir(dirpath):
+                if fname.endswith('.pin') or fname.endswith(STAGED_EXT):
+                    os.remove(join(dirpath, fname))
+            drop_indices()
+    else:
+        for name, size in sorted(loaded_indices().items()):
+            info(name + '\t' + str(size))
+        with _node_lock() as dirpath:
+            for run_id in _live_pins(dirpath):
+                info('pinned by ' + run_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+""" Library complexity and duplication estimated from read-pair sketches.
+
+Every read pair is hashed (the first KEY_LEN bases of R1 and R2) and the hashes are fed
+into a HyperLogLog sketch (distinct count) and a KMV sketch (the K smallest hashes, an
+independent distinct estimate). Both take bounded memory and merge exactly: sketches of
+separate lanes or chunks combine into the sample sketch without re-reading the fastqs,
+so the lanes are processed as independent parallel tasks.
+
+From the total number of pairs N and the distinct estimate C the library size X is
+solved from the Lander-Waterman equation C = X * (1 - exp(-N / X)), as Picard does,
+which gives the expected number of distinct pairs at deeper sequencing.
+"""
+import json
+import math
+from collections import OrderedDict
+from itertools import islice
+
+import numpy as np
+
+from ngs_utils.logger import info
+from ngs_utils.file_utils import file_transaction
+
+from prealign.fs_cache import fs_cache
+from prealign.gzip_io import open_fastq
+
+
+HLL_P = 14
+KMV_K = 4096
+KEY_LEN = 100
+BATCH_PAIRS = 50000
+SATURATION_FOLDS = (0.25, 0.5, 1, 2, 4, 8, 16)
+
+COMPLEXITY_JSON_FNAME = 'complexity.json'
+MQC_TABLE_FNAME = 'complexity_mqc.tsv'
+
+
+class HyperLogLog:
+    def __init__(self, p=HLL_P, registers=None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = np.zeros(self.m, dtype=np.uint8) if registers is None else registers
+
+    def update(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if not len(hashes):
+            return
+        idx = (hashes >> np.uint64(64 - self.p)).astype(np.int64)
+        rest = hashes & np.uint64((1 << (64 - self.p)) - 1)
+        # rest < 2^53 is exact as a float, so frexp gives its bit length
+        bit_len = np.frexp(rest.astype(np.float64))[1]
+        ranks = (64 - self.p + 1 - bit_len).astype(np.uint8)
+        np.maximum.at(self.registers, idx, ranks)
+
+    def merge(self, other):
+        self.registers = np.maximum(self.registers, other.registers)
+
+    def estimate(self):
+        m = float(self.m)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        est = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if est <= 2.5 * m and zeros:
+            est = m * math.log(m / zeros)
+        return float(est)
+
+
+class KMinValues:
+    def __init__(self, k=KMV_K, values=None):
+        self.k = k
+        self.values = np.zeros(0, dtype=np.uint64) if values is None else values
+
+    def update(self, hashes):
+        self.values = np.unique(np.concatenate([self.values, np.asarray(hashes, dtype=np.uint64)]))[:self.k]
+
+    def merge(self, other):
+        self.update(other.values)
+
+    def estimate(self):
+        if len(self.values) < self.k:
+            return float(len(self.values))
+        return (self.k - 1) / (float(self.values[-1]) / 2.0 ** 64)
+
+
+class ComplexitySketch:
+    def __init__(self, hll=None, kmv=None, pairs=0):
+        self.hll = hll or HyperLogLog()
+        self.kmv = kmv or KMinValues()
+        self.pairs = pairs
+
+    def update(self, hashes):
+        self.hll.update(hashes)
+        self.kmv.update(hashes)
+        self.pairs += len(hashes)
+
+    def merge(self, other):
+        self.hll.merge(other.hll)
+        self.kmv.merge(other.kmv)
+        self.pairs += other.pairs
+
+    def to_dict(self):
+        return dict(hll=self.hll.registers, kmv=self.kmv.values, pairs=self.pairs)
+
+    @staticmethod
+    def from_dict(d):
+        return ComplexitySketch(HyperLogLog(registers=np.asarray(d['hll'], dtype=np.uint8)),
+                                KMinValues(values=np.asarray(d['kmv'], dtype=np.uint64)), d['pairs'])
+
+
+def _iter_seqs(fastq_fpath):
+    with open_fastq(fastq_fpath) as f:
+        for line in islice(f, 1, None, 4):
+            yield line.rstrip()[:KEY_LEN]
+
+
+def sketch_fastq_pair(l_fpath, r_fpath):
+    """ Runs on an engine: sketches read pairs of one lane (or any chunk). Returns ComplexitySketch.to_dict() """
+    from itertools import islice
+    import numpy as np
+    from prealign.complexity import ComplexitySketch, _iter_seqs, BATCH_PAIRS, KEY_LEN
+    from prealign.hashing import encode_seqs, hash_rows
+
+    sketch = ComplexitySketch()
+    l_seqs = _iter_seqs(l_fpath)
+    r_seqs = _iter_seqs(r_fpath) if r_fpath else None
+    while True:
+        l_batch = list(islice(l_seqs, BATCH_PAIRS))
+        if not l_batch:
+            break
+        codes = encode_seqs(l_batch, KEY_LEN)
+        if r_seqs is not None:
+            codes = np.hstack([codes, encode_seqs(list(islice(r_seqs, len(l_batch))), KEY_LEN)])
+        sketch.update(hash_rows(codes))
+    return sketch.to_dict()
+
+
+def estimate_library_size(pairs, distinct):
+    """ Solves distinct = X * (1 - exp(-pairs / X)) for X by bisection, None when there are no duplicates """
+    if not pairs or not distinct or distinct >= pairs:
+        return None
+    f = lambda x: x * (1 - math.exp(-pairs / x)) - distinct
+    lo, hi = float(distinct), float(distinct) * 2
+    while f(hi) < 0:
+        hi *= 2
+    for _ in range(100):
+        mid = (lo + hi) / 2
+        if f(mid) < 0:
+            lo = mid
+        else:
+            hi = mid
+    return (lo + hi) / 2
+
+
+def summarize(sketch):
+    pairs = sketch.pairs
+    distinct = min(sketch.hll.estimate(), pairs)
+    library_size = estimate_library_size(pairs, distinct)
+    saturation = OrderedDict()
+    for fold in SATURATION_FOLDS:
+        n = pairs * fold
+        saturation[str(fold)] = library_size * (1 - math.exp(-n / library_size)) if library_size else n
+    return OrderedDict([
+        ('read_pairs', pairs),
+        ('distinct_pairs', int(round(distinct))),
+        ('distinct_pairs_kmv', int(round(min(sketch.kmv.estimate(), pairs)))),
+        ('distinct_pct', 100.0 * distinct / pairs if pairs else None),
+        ('duplicate_pct', 100.0 * (1 - distinct / pairs) if pairs else None),
+        ('library_size', int(round(library_size)) if library_size else None),
+        ('saturation', saturation),
+    ])
+
+
+def run_complexity(pairs_by_sample, view):
+    """ pairs_by_sample: {sample_name: [(l_fpath, r_fpath), ...]} with one pair per lane.
+        Returns {sample_name: summary}
+    """
+    tasks = [(sname, l, r) for sname, pairs in pairs_by_sample.items() for l, r in pairs]
+    results = view.run(sketch_fastq_pair, [[l, r] for _, l, r in tasks])
+    sketch_by_sample = OrderedDict()
+    for (sname, _, _), res in zip(tasks, results):
+        sketch = ComplexitySketch.from_dict(res)
+        if sname in sketch_by_sample:
+            sketch_by_sample[sname].merge(sketch)
+        else:
+            sketch_by_sample[sname] = sketch
+    return OrderedDict((sname, summarize(sketch)) for sname, sketch in sketch_by_sample.items())
+
+
+def write_complexity_reports(summary_by_sample, json_fpath, mqc_fpath):
+    with file_transaction(None, json_fpath) as tx:
+        with open(tx, 'w') as f:
+            json.dump(summary_by_sample, f, indent=2)
+
+    folds = [fold for fold in SATURATION_FOLDS if fold > 1]
+    with file_transaction(None, mqc_fpath) as tx:
+        with open(tx, 'w') as f:
+            f.write("# id: 'library_complexity'\n"
+                    "# section_name: 'Library complexity'\n"
+                    "# description: 'Distinct read pairs estimated with HyperLogLog over all merged reads, and the "
+                    "Lander-Waterman library size with expected distinct pairs at deeper sequencing'\n"
+                    "# plot_type: 'table'\n")
+            f.write('\t'.join(['Sample', 'Read pairs', 'Distinct pairs', '% distinct', '% duplicate', 'Library size'] +
+                              ['Distinct at ' + str(fold) + 'x' for fold in folds]) + '\n')
+            for sname, s in summary_by_sample.items():
+                vals = [s['read_pairs'], s['distinct_pairs'], s['distinct_pct'], s['duplicate_pct'], s['library_size']] + \
+                       [s['saturation'][str(fold)] for fold in folds]
+                f.write(sname + '\t' + '\t'.join(
+                    '' if v is None else ('%.2f' % v if isinstance(v, float) else str(v)) for v in vals) + '\n')
+    fs_cache.invalidate(json_fpath)
+    fs_cache.invalidate(mqc_fpath)
+
+    for sname, s in summary_by_sample.items():
+        info('  ' + sname + ': ' + str(s['read_pairs']) + ' pairs, ' +
+             ('%.1f' % s['distinct_pct'] if s['distinct_pct'] is not None else '-') + '% distinct, library size ' +
+             str(s['library_size'] or '-'))
+    return json_fpath, mqc_fpath
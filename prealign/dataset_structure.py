@@ -2,16 +2,27 @@ from collections import OrderedDict, defaultdict
 from itertools import dropwhile
 import re
 import os
-from os.path import join, isfile, isdir, basename, exists, dirname, realpath
+from os.path import join, isfile, isdir, basename, exists, dirname, realpath, getsize
+from functools import partial
 import shutil
 import traceback
 
 from ngs_utils.logger import critical, err, info, warn, debug
 from ngs_utils.file_utils import verify_dir, verify_file, splitext_plus, safe_mkdir, file_transaction, can_reuse
 
+from prealign.fs_cache import fs_cache
+from prealign.bcl2fastq_stats import load_bcl2fastq_stats
+from prealign.virtual_merge import manifest_fpath_for, write_manifest
+from prealign.barcodes import check_barcodes
+from prealign.status import status
+from prealign import fastq_store
+
+
+COPY_BUFFER_SIZE = 16 << 20
+
 
 def _sample_name_special_chars(sn):
-    fixed_sn = re.sub(r'[\W_]+', r'[\W_]+', sn)
+    fixed_sn = re.sub(r'[\W_]+', lambda m: r'[\W_]+', sn)  # a function, as Python 3.7+ rejects \W in a template
     if fixed_sn.endswith('+'):
         fixed_sn = fixed_sn[:-1] + '*'
     return fixed_sn
@@ -26,7 +37,7 @@ def get_hiseq_regexp(sample, suf):
 
 def get_nextseq500_regexp(sample, suf):
     # sn = ''.join(c for c in sample.name if c.isalnum() or c in ['-', '_', '.', '/'])
-    return _sample_name_special_chars(sample.name) + '_S\d+_' + suf + '.*\.fastq\.gz'
+    return _sample_name_special_chars(sample.name) + '_S\d+_(L\d\d\d_)?' + suf + '.*\.fastq\.gz'
 
 
 class DatasetStructure:
@@ -70,12 +81,16 @@ class DatasetStructure:
         self.basecalls_reports_dirpath = None
         self.bcl2fastq_dirpath = None
         self.source_fastq_dirpath = None
+        self.bcl2fastq_stats_dirpath = join(self.unaligned_dirpath, 'Stats') if self.unaligned_dirpath else None
+        self._bcl2fastq_stats = None
 
         if samplesheet:
             self.samplesheet_fpath = samplesheet
         else:
             self.samplesheet_fpath = self.__find_sample_sheet()
         self.project_by_name = self._parse_sample_sheet(self.samplesheet_fpath)
+        info('Checking sample barcodes')
+        self.barcode_checks = check_barcodes(self.project_by_name)
 
         if illumina_project_name:  # we want only a specific project
             if illumina_project_name not in self.project_by_name:
@@ -84,6 +99,12 @@ class DatasetStructure:
             else:
                 self.project_by_name = {illumina_project_name: self.project_by_name[illumina_project_name]}
 
+    def get_bcl2fastq_stats(self):
+        """ Parsed bcl2fastq Stats.json/ConversionStats.xml (None for HiSeq runs processed with bcl2fastq 1.x) """
+        if self._bcl2fastq_stats is None:
+            self._bcl2fastq_stats = load_bcl2fastq_stats(self.bcl2fastq_stats_dirpath) or False
+        return self._bcl2fastq_stats or None
+
     def __find_unaligned_dir(self):
         unaligned_dirpath = join(self.illumina_dir, 'Unalign')
         if verify_dir(unaligned_dirpath, description='"Unalign" directory', silent=True):
@@ -140,7 +161,8 @@ class DatasetStructure:
                 s = project.sample_by_name[sname]
                 s.lane_numbers.add(info_d.get('Lane', 1))  # lanes are in HiSeq and HiSeq4000 (not in MiSeq!)
             else:
-                s = DatasetSample(sname, index=info_d.get('index', info_d.get('Index')))
+                s = DatasetSample(sname, index=info_d.get('index', info_d.get('Index')),
+                                  index2=info_d.get('index2', info_d.get('Index2')))
                 info('  ' + proj_name + ': ' + s.name)
                 s.lane_numbers.add(info_d.get('Lane', 1))  # lanes are in HiSeq and HiSeq4000 (not in MiSeq!)
                 if 'FCID' in info_d:
@@ -227,7 +249,7 @@ class HiSeqStructure(DatasetStructure):
             self.basecalls_reports_dirpath = join(self.unaligned_dirpath, basecall_stats_dirnames[0])
             basecall_reports = [verify_file(join(self.basecalls_reports_dirpath, html_fname)) for html_fname in
                                 ['Demultiplex_Stats.htm', 'All.htm', 'IVC.htm']]
-            return filter(None, basecall_reports)
+            return [fpath for fpath in basecall_reports if fpath]
 
 
 class MiSeqStructure(DatasetStructure):
@@ -354,9 +376,12 @@ class DatasetProject:
         self.fastq_dirpath = None
         self.fastqc_dirpath = None
         self.downsample_metamapping_dirpath = None
+        self.samtools_stats_dirpath = None
         self.downsample_targqc_dirpath = None
         self.downsample_targqc_report_fpath = None
         self.multiqc_report_html_fpath = None
+        self.multiqc_metadata_fpath = None
+        self.preflight_failed_sample_names = set()
         self.mergred_dir_found = False
 
     def set_dirpath(self, ds_dir, analysis_dir, output_dir, az_project_name):
@@ -383,10 +408,11 @@ class DatasetProject:
         self.multiqc_report_html_fpath = join(self.output_dir, 'multiqc_report.html')
 
         self.downsample_metamapping_dirpath = join(self.output_dir, 'Downsample_MetaMapping')
+        self.samtools_stats_dirpath = join(self.output_dir, 'SamtoolsStats')
         self.downsample_targqc_dirpath = join(self.output_dir, 'Downsample_TargQC')
         self.downsample_targqc_report_fpath = join(self.downsample_targqc_dirpath, 'summary.html')
 
-    def concat_fastqs(self, get_fastq_regexp):
+    def concat_fastqs(self, get_fastq_regexp, virtual=False, store_dirpath=None):
         info('Preparing fastq files for the project named ' + self.name or self.az_project_name)
         if self.mergred_dir_found:
             info('  found already merged fastq dir, skipping.')
@@ -398,6 +424,7 @@ class DatasetProject:
             if not isdir(self.fastq_dirpath):
                 safe_mkdir(self.fastq_dirpath)
                 open(join(self.fastq_dirpath, 'folder_created_by_prealign'), 'a').close()
+                fs_cache.invalidate(self.fastq_dirpath)
         except OSError as e:
             err('Error: cannot write to ' + self.fastq_dirpath + '(' + str(e) + '). ' +
                 'Writing fastq to ' + join(self.output_dir, 'fastq') + ' instead')
@@ -407,18 +434,25 @@ class DatasetProject:
             fastqc_symlink = join(self.fastq_dirpath, 'FastQC')
             if not exists(fastqc_symlink):
                 os.symlink(self.fastqc_dirpath, fastqc_symlink)
+                fs_cache.invalidate(fastqc_symlink)
         except OSError:
             pass
 
         for s in self.sample_by_name.values():
-            _concat_fastq(s.find_raw_fastq(get_fastq_regexp, 'R1'), s.l_fpath)
-            _concat_fastq(s.find_raw_fastq(get_fastq_regexp, 'R2'), s.r_fpath)
+            l_fastq_fpaths = s.find_raw_fastq(get_fastq_regexp, 'R1')
+            r_fastq_fpaths = s.find_raw_fastq(get_fastq_regexp, 'R2')
+            status.sample_step(self.name, s.name, 'merge', sum(getsize(f) for f in l_fastq_fpaths + r_fastq_fpaths))
+            on_copied = partial(status.add_bytes, self.name, s.name)
+            s.l_fpath = _concat_fastq(l_fastq_fpaths, s.l_fpath, virtual, on_copied, store_dirpath)
+            s.r_fpath = _concat_fastq(r_fastq_fpaths, s.r_fpath, virtual, on_copied, store_dirpath)
+            status.finish_sample_step(self.name, s.name)
         info()
 
 class DatasetSample:
-    def __init__(self, name, index=None, source_fastq_dirpath=None):
+    def __init__(self, name, index=None, index2=None, source_fastq_dirpath=None):
         self.name = re.sub(r'[\W_]', r'_', name)
         self.index = index
+        self.index2 = index2
 
         self.fastq_dirpath = None
         self.source_fastq_dirpath = source_fastq_dirpath
@@ -436,6 +470,8 @@ class DatasetSample:
 
         self.targqc_sample = None
         self.downsample_targqc_dirpath = None
+        self.downsampled_l_fpath = None  # set when prealign downsamples the reads itself for the alignment
+        self.downsampled_r_fpath = None
 
     def set_up_out_dirs(self, fastq_dirpath, fastqc_dirpath, downsample_targqc_dirpath):
         self.fastq_dirpath = fastq_dirpath
@@ -461,7 +497,7 @@ class DatasetSample:
     def find_raw_fastq(self, get_regexp, suf='R1'):
         fastq_fpaths = [
             join(self.source_fastq_dirpath, fname)
-                for fname in os.listdir(self.source_fastq_dirpath)
+                for fname in fs_cache.listdir(self.source_fastq_dirpath)
                 if re.match(get_regexp(self, suf), fname)]
         fastq_fpaths = sorted(fastq_fpaths)
         if not fastq_fpaths:
@@ -471,7 +507,8 @@ class DatasetSample:
         return fastq_fpaths
 
 
-def _concat_fastq(fastq_fpaths, output_fpath):
+def _concat_fastq(fastq_fpaths, output_fpath, virtual=False, on_copied=None, store_dirpath=None):
+    """ Returns the path to use for the merged fastq: output_fpath, or its manifest in the virtual mode """
     if len(fastq_fpaths) == 1:
         if not isfile(output_fpath):
             info('  no need to merge - symlinking ' + fastq_fpaths[0] + ' -> ' + output_fpath)
@@ -479,7 +516,14 @@ def _concat_fastq(fastq_fpaths, output_fpath):
                 safe_mkdir(output_fpath)
                 critical('Dir for the symlink ' + dirname(output_fpath) + ' does not exist')
             os.symlink(fastq_fpaths[0], output_fpath)
-            return output_fpath
+            fs_cache.invalidate(output_fpath)
+        return output_fpath
+    elif virtual and not isfile(output_fpath):
+        manifest_fpath = manifest_fpath_for(output_fpath)
+        info('  virtual merge of ' + ', '.join(fastq_fpaths) + ' -> ' + manifest_fpath)
+        return write_manifest(fastq_fpaths, manifest_fpath)
+    elif store_dirpath:
+        return fastq_store.put(store_dirpath, fastq_fpaths, output_fpath, on_copied)
     else:
         info('  merging ' + ', '.join(fastq_fpaths))
         if can_reuse(output_fpath, fastq_fpaths):
@@ -489,5 +533,12 @@ def _concat_fastq(fastq_fpaths, output_fpath):
                 with open(tx, 'wb') as out:
                     for fq_fpath in fastq_fpaths:
                         with open(fq_fpath, 'rb') as inp:
-                            shutil.copyfileobj(inp, out)
+                            while True:
+                                buf = inp.read(COPY_BUFFER_SIZE)
+                                if not buf:
+                                    break
+                                out.write(buf)
+                                if on_copied:
+                                    on_copied(len(buf))
+            fs_cache.invalidate(output_fpath)
         return output_fpath
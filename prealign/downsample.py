@@ -0,0 +1,214 @@
+""" Downsampling of read pairs for the alignment QC.
+
+Two methods:
+  lockstep  R1 and R2 are read together and every pair is kept with the same probability from a
+            seeded generator, so reruns give the same subset. Used for virtual merge manifests,
+            which targqc cannot read.
+  hash      A read is kept when a 64-bit hash of its normalized name (without /1, /2 and the
+            comment) is below fraction * 2^64. R1 and R2 agree without being read together, so every
+            lane file is a separate task, and the union of the lanes is exactly what a pass over the
+            merged file would keep; the same reads are chosen across reruns and re-merges.
+The alignment step gets the small downsampled files.
+"""
+import copy
+import shutil
+from collections import OrderedDict, defaultdict
+from os.path import join
+
+from ngs_utils.logger import info
+from ngs_utils.file_utils import safe_mkdir, can_reuse, file_transaction
+
+from prealign.fs_cache import fs_cache
+from prealign.virtual_merge import is_manifest, read_manifest
+
+
+DEFAULT_SEED = 42
+BATCH_PAIRS = 100000
+COPY_BUFFER_SIZE = 16 << 20
+METHODS = ['targqc', 'hash']
+
+
+def _iter_records(f):
+    """ Yields 4-line fastq records as single byte strings """
+    while True:
+        rec = f.readline()
+        if not rec:
+            return
+        yield rec + f.readline() + f.readline() + f.readline()
+
+
+def count_pairs(fastq_fpath):
+    from prealign.gzip_io import open_fastq
+    with open_fastq(fastq_fpath) as f:
+        return sum(1 for _ in f) // 4
+
+
+def downsample_pair(l_fpath, r_fpath, l_out_fpath, r_out_fpath, downsample_to, seed=DEFAULT_SEED):
+    """ Runs on an engine. downsample_to <= 1 is the fraction of pairs to keep, otherwise the approximate
+        number of pairs. Returns the number of pairs written.
+    """
+    from itertools import islice
+    import numpy as np
+    from ngs_utils.file_utils import file_transaction
+    from prealign.gzip_io import open_fastq
+    from prealign.downsample import _iter_records, count_pairs, BATCH_PAIRS
+
+    fraction = float(downsample_to)
+    if fraction > 1:
+        fraction = min(1.0, fraction / max(1, count_pairs(l_fpath)))
+    rnd = np.random.RandomState(seed)
+    kept = 0
+    with file_transaction(None, l_out_fpath) as l_tx, file_transaction(None, r_out_fpath) as r_tx:
+        with open_fastq(l_fpath) as l_in, open_fastq(r_fpath) as r_in, \
+                open_fastq(l_tx, 'wb', level=1) as l_out, open_fastq(r_tx, 'wb', level=1) as r_out:
+            l_recs, r_recs = _iter_records(l_in), _iter_records(r_in)
+            while True:
+                l_batch = list(islice(l_recs, BATCH_PAIRS))
+                if not l_batch:
+                    break
+                r_batch = list(islice(r_recs, len(l_batch)))
+                if len(r_batch) != len(l_batch):
+                    raise ValueError(r_fpath + ' has fewer reads than ' + l_fpath)
+                keep_idx = np.flatnonzero(rnd.random_sample(len(l_batch)) < fraction)
+                for i in keep_idx:
+                    l_out.write(l_batch[i])
+                    r_out.write(r_batch[i])
+                kept += len(keep_idx)
+    return kept
+
+
+def downsampled_samples(samples, view, output_dirpath, downsample_to, seed=DEFAULT_SEED):
+    """ Downsamples every sample in parallel and returns shallow copies of the samples pointing
+        to the downsampled fastqs, to be passed to targqc.proc_fastq with downsample_to=None
+    """
+    safe_mkdir(output_dirpath)
+    proxies = []
+    tasks = []
+    for s in samples:
+        proxy = copy.copy(s)
+        proxy.l_fpath = join(output_dirpath, s.name + '_R1.fastq.gz')
+        proxy.r_fpath = join(output_dirpath, s.name + '_R2.fastq.gz')
+        proxies.append(proxy)
+        if not can_reuse(proxy.l_fpath, s.l_fpath) or not can_reuse(proxy.r_fpath, s.r_fpath):
+            tasks.append([s.l_fpath, s.r_fpath, proxy.l_fpath, proxy.r_fpath, downsample_to, seed])
+    if tasks:
+        info('Downsampling ' + str(len(tasks)) + ' samples to ' + str(downsample_to))
+        view.run(downsample_pair, tasks)
+    fs_cache.invalidate(output_dirpath)
+    return proxies
+
+
+def read_name(header):
+    """ b"@A00123:8:HXX:1:1101:1000:2000/1 1:N:0:ACGT" -> b"A00123:8:HXX:1:1101:1000:2000" """
+    name = header.split(None, 1)[0].lstrip(b'@')
+    if name[-2:] in (b'/1', b'/2'):
+        name = name[:-2]
+    return name
+
+
+def hash_threshold(fraction):
+    """ Names with a hash below this are kept; None keeps everything """
+    if fraction >= 1:
+        return None
+    return int(fraction * 2 ** 64)
+
+
+def hash_downsample_fastq(fastq_fpath, output_fpath, fraction):
+    """ Runs on an engine. Writes the reads of one fastq whose name hash is below fraction * 2^64.
+        Returns the number of reads written.
+    """
+    from itertools import islice
+    import numpy as np
+    from ngs_utils.file_utils import file_transaction
+    from prealign.gzip_io import open_fastq
+    from prealign.hashing import hash_byte_strings
+    from prealign.downsample import _iter_records, read_name, hash_threshold, BATCH_PAIRS
+
+    threshold = hash_threshold(fraction)
+    kept = 0
+    with file_transaction(None, output_fpath) as tx:
+        with open_fastq(fastq_fpath) as inp, open_fastq(tx, 'wb', level=1) as out:
+            recs = _iter_records(inp)
+            while True:
+                batch = list(islice(recs, BATCH_PAIRS))
+                if not batch:
+                    break
+                if threshold is None:
+                    keep_idx = range(len(batch))
+                else:
+                    hashes = hash_byte_strings([read_name(rec) for rec in batch])
+                    keep_idx = np.flatnonzero(hashes < np.uint64(threshold))
+                for i in keep_idx:
+                    out.write(batch[i])
+                kept += len(keep_idx)
+    return kept
+
+
+def _split_parts(fpath, lane_fpaths):
+    if lane_fpaths:
+        return lane_fpaths
+    if is_manifest(fpath):
+        return read_manifest(fpath)
+    return [fpath]
+
+
+def hash_downsampled_samples(samples, view, output_dirpath, downsample_to, lane_fpaths_by_sample=None):
+    """ Downsamples every lane file of every sample as a separate task and returns shallow copies of
+        the samples pointing to the downsampled fastqs, to be passed to targqc.proc_fastq with downsample_to=None.
+        lane_fpaths_by_sample: {sample_name: (R1 lane fastqs, R2 lane fastqs)}, the merged files are used otherwise.
+    """
+    safe_mkdir(output_dirpath)
+    parts_dirpath = safe_mkdir(join(output_dirpath, 'lanes'))
+    lane_fpaths_by_sample = lane_fpaths_by_sample or dict()
+
+    parts_by_sample = OrderedDict()
+    for s in samples:
+        lane_fpaths = lane_fpaths_by_sample.get(s.name, (None, None))
+        parts_by_sample[s.name] = [_split_parts(fpath, lane_fpaths[read_i]) if fpath else []
+                                   for read_i, fpath in enumerate([s.l_fpath, s.r_fpath])]
+
+    fraction_by_sample = OrderedDict((sname, float(downsample_to)) for sname in parts_by_sample)
+    if float(downsample_to) > 1:  # a number of pairs per sample: the fractions need the totals
+        r1_tasks = [(sname, f) for sname, (r1_parts, _) in parts_by_sample.items() for f in r1_parts]
+        pairs_by_sample = defaultdict(int)
+        for (sname, _), n in zip(r1_tasks, view.run(count_pairs, [[f] for _, f in r1_tasks])):
+            pairs_by_sample[sname] += n
+        for sname in fraction_by_sample:
+            fraction_by_sample[sname] = min(1.0, float(downsample_to) / max(1, pairs_by_sample[sname]))
+
+    proxies = []
+    tasks = []
+    parts_by_output = []
+    rebuilt_parts = set()
+    for s in samples:
+        proxy = copy.copy(s)
+        fraction = fraction_by_sample[s.name]
+        for read_i, attr in enumerate(['l_fpath', 'r_fpath']):
+            out_fpath = join(output_dirpath, s.name + '_R' + str(read_i + 1) + '.fastq.gz')
+            setattr(proxy, attr, out_fpath)
+            part_fpaths = []
+            for part_i, in_fpath in enumerate(parts_by_sample[s.name][read_i]):
+                # the fraction is in the name, so a rerun with another target does not reuse old parts
+                part_fpath = join(parts_dirpath, '%s_R%d_%03d_%.6f.fastq.gz' % (s.name, read_i + 1, part_i, fraction))
+                part_fpaths.append(part_fpath)
+                if not can_reuse(part_fpath, in_fpath):
+                    tasks.append([in_fpath, part_fpath, fraction])
+                    rebuilt_parts.add(part_fpath)
+            if part_fpaths:
+                parts_by_output.append((out_fpath, part_fpaths))
+        proxies.append(proxy)
+
+    if tasks:
+        info('Hash-downsampling ' + str(len(tasks)) + ' fastqs of ' + str(len(samples)) + ' samples to ' +
+             str(downsample_to))
+        view.run(hash_downsample_fastq, tasks)
+    for out_fpath, part_fpaths in parts_by_output:  # gzip members concatenate into a valid gzip file
+        if can_reuse(out_fpath, part_fpaths) and not rebuilt_parts.intersection(part_fpaths):
+            continue
+        with file_transaction(None, out_fpath) as tx:
+            with open(tx, 'wb') as out:
+                for part_fpath in part_fpaths:
+                    with open(part_fpath, 'rb') as inp:
+                        shutil.copyfileobj(inp, out, COPY_BUFFER_SIZE)
+    fs_cache.invalidate(output_dirpath)
+    return proxies
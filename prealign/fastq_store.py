@@ -0,0 +1,212 @@
+""" Content-addressed store of merged fastqs, shared between analyses of the same run.
+
+A merged fastq is keyed by the sha1 of the ordered fingerprints (real path, size, mtime) of
+its lane files and kept once as <store>/objects/ab/abcdef....fastq.gz. Every analysis gets a
+hardlink to the object (a symlink when the store is on another filesystem) instead of a copy,
+and the link is recorded as a ref in <store>/refs/<key>/. Re-running a flowcell with another
+-o, or processing sub-projects separately, then reuses the merged files.
+
+gc() drops refs whose link is gone or no longer points to the object, and removes objects
+without refs. The report counts bytes deduplicated: what the links would take as copies,
+minus what the store holds.
+
+    python -m prealign.fastq_store <store> [--gc]
+"""
+import fcntl
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
+from os.path import join, isfile, isdir, islink, realpath, getsize, dirname, exists
+
+from ngs_utils.logger import info, debug
+from ngs_utils.file_utils import safe_mkdir
+
+from prealign.fs_cache import fs_cache
+
+
+OBJECTS_DIRNAME = 'objects'
+REFS_DIRNAME = 'refs'
+REPORT_FNAME = 'fastq_store_report.json'
+OBJECT_EXT = '.fastq.gz'
+COPY_BUFFER_SIZE = 16 << 20
+
+
+@contextmanager
+def _locked(store_dirpath):
+    safe_mkdir(store_dirpath)
+    with open(join(store_dirpath, '.lock'), 'a') as lock_f:
+        fcntl.flock(lock_f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+
+def _sha1(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def key_for(lane_fpaths):
+    """ sha1 of the ordered (real path, size, mtime) of the lane files """
+    lines = []
+    for fpath in lane_fpaths:
+        st = os.stat(fpath)
+        lines.append('\t'.join([realpath(fpath), str(st.st_size), str(int(st.st_mtime))]))
+    return _sha1('\n'.join(lines))
+
+
+def object_fpath(store_dirpath, key):
+    return join(store_dirpath, OBJECTS_DIRNAME, key[:2], key + OBJECT_EXT)
+
+
+def _refs_dirpath(store_dirpath, key):
+    return join(store_dirpath, REFS_DIRNAME, key)
+
+
+def _links_to(link_fpath, obj_fpath):
+    if islink(link_fpath):
+        return realpath(link_fpath) == realpath(obj_fpath)
+    return exists(link_fpath) and exists(obj_fpath) and os.path.samefile(link_fpath, obj_fpath)
+
+
+def _write_object(lane_fpaths, obj_fpath, on_copied=None):
+    safe_mkdir(dirname(obj_fpath))
+    tmp_fpath = obj_fpath + '.tmp.' + str(os.getpid())
+    with open(tmp_fpath, 'wb') as out:
+        for fpath in lane_fpaths:
+            with open(fpath, 'rb') as inp:
+                while True:
+                    buf = inp.read(COPY_BUFFER_SIZE)
+                    if not buf:
+                        break
+                    out.write(buf)
+                    if on_copied:
+                        on_copied(len(buf))
+    os.rename(tmp_fpath, obj_fpath)
+
+
+def _link(obj_fpath, link_fpath):
+    if exists(link_fpath) or islink(link_fpath):
+        os.remove(link_fpath)
+    try:
+        os.link(obj_fpath, link_fpath)
+    except OSError:  # another filesystem
+        os.symlink(obj_fpath, link_fpath)
+
+
+def put(store_dirpath, lane_fpaths, link_fpath, on_copied=None):
+    """ Makes link_fpath the concatenation of lane_fpaths, merging them into the store only if no analysis
+        has merged them before. An existing up-to-date merged file at link_fpath is adopted into the store.
+    """
+    key = key_for(lane_fpaths)
+    obj_fpath = object_fpath(store_dirpath, key)
+    with _locked(store_dirpath):
+        if isfile(obj_fpath):
+            info('  ' + link_fpath + ': reusing merged fastq ' + obj_fpath + ' from the store')
+        elif isfile(link_fpath) and not islink(link_fpath) and \
+                getsize(link_fpath) == sum(getsize(f) for f in lane_fpaths) and \
+                all(os.stat(link_fpath).st_mtime >= os.stat(f).st_mtime for f in lane_fpaths):
+            info('  adding the existing ' + link_fpath + ' to the store')
+            safe_mkdir(dirname(obj_fpath))
+            try:
+                os.link(link_fpath, obj_fpath)
+            except OSError:
+                _write_object(lane_fpaths, obj_fpath, on_copied)
+        else:
+            info('  merging ' + ', '.join(lane_fpaths) + ' into the store as ' + obj_fpath)
+            _write_object(lane_fpaths, obj_fpath, on_copied)
+        if not _links_to(link_fpath, obj_fpath):
+            _link(obj_fpath, link_fpath)
+        refs_dirpath = safe_mkdir(_refs_dirpath(store_dirpath, key))
+        with open(join(refs_dirpath, _sha1(realpath(dirname(link_fpath)) + '/' + os.path.basename(link_fpath))), 'w') as f:
+            f.write(link_fpath + '\n')
+    fs_cache.invalidate(link_fpath)
+    return link_fpath
+
+
+def _iter_refs(store_dirpath):
+    """ Yields (key, ref_fpath, link_fpath) """
+    refs_root = join(store_dirpath, REFS_DIRNAME)
+    for key in sorted(os.listdir(refs_root)) if isdir(refs_root) else []:
+        for ref_fname in sorted(os.listdir(join(refs_root, key))):
+            ref_fpath = join(refs_root, key, ref_fname)
+            with open(ref_fpath) as f:
+                yield key, ref_fpath, f.read().strip()
+
+
+def _iter_objects(store_dirpath):
+    """ Yields (key, object_fpath) """
+    objects_root = join(store_dirpath, OBJECTS_DIRNAME)
+    for prefix in sorted(os.listdir(objects_root)) if isdir(objects_root) else []:
+        for fname in sorted(os.listdir(join(objects_root, prefix))):
+            if fname.endswith(OBJECT_EXT):
+                yield fname[:-len(OBJECT_EXT)], join(objects_root, prefix, fname)
+
+
+def gc(store_dirpath):
+    """ Removes refs to deleted or replaced links and the objects nothing refers to. Returns the bytes freed. """
+    freed = 0
+    with _locked(store_dirpath):
+        for key, ref_fpath, link_fpath in list(_iter_refs(store_dirpath)):
+            if not _links_to(link_fpath, object_fpath(store_dirpath, key)):
+                debug('Dropping the store ref of ' + link_fpath)
+                os.remove(ref_fpath)
+        for key, obj_fpath in list(_iter_objects(store_dirpath)):
+            refs_dirpath = _refs_dirpath(store_dirpath, key)
+            if isdir(refs_dirpath) and os.listdir(refs_dirpath):
+                continue
+            freed += getsize(obj_fpath)
+            info('Removing unreferenced ' + obj_fpath)
+            os.remove(obj_fpath)
+            if isdir(refs_dirpath):
+                os.rmdir(refs_dirpath)
+    info('Fastq store GC freed ' + '%.2f' % (freed / 1e9) + ' GB')
+    return freed
+
+
+def report(store_dirpath):
+    """ Writes and returns the store summary with the bytes deduplicated """
+    refs_by_key = OrderedDict()
+    for key, _, link_fpath in _iter_refs(store_dirpath):
+        refs_by_key.setdefault(key, []).append(link_fpath)
+    objects = 0
+    stored_bytes = 0
+    linked_bytes = 0
+    for key, obj_fpath in _iter_objects(store_dirpath):
+        size = getsize(obj_fpath)
+        objects += 1
+        stored_bytes += size
+        linked_bytes += size * len(refs_by_key.get(key, []))
+    summary = OrderedDict([
+        ('objects', objects),
+        ('links', sum(len(v) for v in refs_by_key.values())),
+        ('stored_bytes', stored_bytes),
+        ('linked_bytes', linked_bytes),
+        ('deduplicated_bytes', max(0, linked_bytes - stored_bytes)),
+    ])
+    tmp_fpath = join(store_dirpath, REPORT_FNAME + '.tmp')
+    with open(tmp_fpath, 'w') as f:
+        json.dump(summary, f, indent=2)
+    os.rename(tmp_fpath, join(store_dirpath, REPORT_FNAME))
+    info('Fastq store ' + store_dirpath + ': ' + str(objects) + ' merged fastqs, ' + str(summary['links']) +
+         ' links, ' + '%.2f' % (stored_bytes / 1e9) + ' GB stored, ' +
+         '%.2f' % (summary['deduplicated_bytes'] / 1e9) + ' GB deduplicated')
+    return summary
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage='python -m prealign.fastq_store <store_dir> [--gc]')
+    parser.add_option('--gc', action='store_true', default=False, help='Remove merged fastqs no analysis links to')
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('provide the store directory')
+    if opts.gc:
+        gc(args[0])
+    report(args[0])
+
+
+if __name__ == '__main__':
+    main()
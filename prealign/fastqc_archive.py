@@ -0,0 +1,73 @@
+""" FastQC results kept as single archives instead of extracted directories.
+
+In the "zip" storage mode every fastq leaves two files in the FastQC dir: the standalone
+<name>_fastqc.html report and the <name>_fastqc.zip archive, which is indexed so that
+fastqc_data.txt and other members are read straight out of it. MultiQC reads the zips too.
+"""
+import os
+import shutil
+import zipfile
+from os.path import join, isdir, isfile, relpath
+
+from ngs_utils.logger import info, err
+
+from prealign.fs_cache import fs_cache
+
+
+DIR_STORAGE = 'dir'
+ZIP_STORAGE = 'zip'
+STORAGE_MODES = (DIR_STORAGE, ZIP_STORAGE)
+
+_stored_exts = ('.png', '.svg', '.zip', '.gz')  # already compressed, no point deflating again
+
+
+def fastqc_extracted_dirpath(fastqc_dirpath, name):
+    return join(fastqc_dirpath, name + '_fastqc')
+
+
+def fastqc_zip_fpath(fastqc_dirpath, name):
+    return join(fastqc_dirpath, name + '_fastqc.zip')
+
+
+def read_zip_member(zip_fpath, member_fname):
+    """ Returns the contents of the member whose basename is member_fname """
+    with zipfile.ZipFile(zip_fpath) as zf:
+        member = next((n for n in zf.namelist() if n == member_fname or n.endswith('/' + member_fname)), None)
+        if member is None:
+            raise KeyError(member_fname + ' not found in ' + zip_fpath)
+        return zf.read(member)
+
+
+def read_fastqc_data_lines(fastqc_data_fpath):
+    """ fastqc_data_fpath is either an extracted fastqc_data.txt or a <name>_fastqc.zip archive """
+    if fastqc_data_fpath.endswith('.zip'):
+        return read_zip_member(fastqc_data_fpath, 'fastqc_data.txt').decode('utf-8').splitlines()
+    with open(fastqc_data_fpath) as f:
+        return f.read().splitlines()
+
+
+def pack_fastqc_dir(fastqc_dirpath, name):
+    """ Converts an extracted FastQC directory into <name>_fastqc.zip and removes the directory.
+        Returns the zip path, or None if there is nothing to pack.
+    """
+    extracted_dirpath = fastqc_extracted_dirpath(fastqc_dirpath, name)
+    zip_fpath = fastqc_zip_fpath(fastqc_dirpath, name)
+    if not isdir(extracted_dirpath):
+        return zip_fpath if isfile(zip_fpath) else None
+    if not isfile(zip_fpath):
+        info('Packing ' + extracted_dirpath + ' into ' + zip_fpath)
+        tx_fpath = zip_fpath + '.tx'
+        with zipfile.ZipFile(tx_fpath, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for rootpath, dirnames, fnames in os.walk(extracted_dirpath):
+                for fname in sorted(fnames):
+                    fpath = join(rootpath, fname)
+                    compress_type = zipfile.ZIP_STORED if fname.endswith(_stored_exts) else zipfile.ZIP_DEFLATED
+                    zf.write(fpath, relpath(fpath, fastqc_dirpath), compress_type=compress_type)
+        os.rename(tx_fpath, zip_fpath)
+    try:
+        shutil.rmtree(extracted_dirpath)
+    except OSError as e:
+        err('Cannot remove ' + extracted_dirpath + ' after packing: ' + str(e))
+    fs_cache.invalidate(extracted_dirpath)
+    fs_cache.invalidate(zip_fpath)
+    return zip_fpath
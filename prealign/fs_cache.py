@@ -0,0 +1,177 @@
+""" Per-run cache of filesystem metadata.
+
+Every directory is listed once with os.scandir, and existence/size/mtime questions
+are answered from memory afterwards. On GPFS each isfile/stat is a metadata round-trip,
+so the report builders make thousands of them; the cache turns them into one listing
+per directory. Whenever prealign writes into a directory it must call invalidate().
+"""
+import os
+import threading
+from os.path import join, dirname, basename, abspath, normpath
+
+from ngs_utils.logger import info, err, critical
+
+try:
+    from os import scandir
+except ImportError:  # Python 2
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+class _ListdirEntry:
+    """ Minimal os.DirEntry replacement for Pythons without scandir """
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = join(dirpath, name)
+        self._stat = None
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def is_file(self):
+        return os.path.isfile(self.path)
+
+
+def _list_dir(dirpath):
+    if scandir is not None:
+        return dict((e.name, e) for e in scandir(dirpath))
+    return dict((name, _ListdirEntry(dirpath, name)) for name in os.listdir(dirpath))
+
+
+class FsCache:
+    def __init__(self):
+        self._entries_by_dir = dict()
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.listings = 0
+        self.invalidations = 0
+
+    def reset(self):
+        with self._lock:
+            self._entries_by_dir = dict()
+            self.lookups = self.hits = self.listings = self.invalidations = 0
+
+    def _dir_entries(self, dirpath):
+        """ Returns a dict of DirEntry by name, or None if dirpath is not a readable directory """
+        with self._lock:
+            self.lookups += 1
+            if dirpath in self._entries_by_dir:
+                self.hits += 1
+                return self._entries_by_dir[dirpath]
+        try:
+            entries = _list_dir(dirpath)
+        except OSError:
+            entries = None
+        with self._lock:
+            self.listings += 1
+            self._entries_by_dir[dirpath] = entries
+        return entries
+
+    def _entry(self, path):
+        path = normpath(abspath(path))
+        entries = self._dir_entries(dirname(path))
+        if not entries:
+            return None
+        return entries.get(basename(path))
+
+    def listdir(self, dirpath):
+        entries = self._dir_entries(normpath(abspath(dirpath)))
+        return sorted(entries) if entries is not None else []
+
+    def exists(self, path):
+        e = self._entry(path)
+        if e is None:
+            return False
+        try:
+            e.stat()  # follows symlinks, so broken links do not exist - like os.path.exists
+        except OSError:
+            return False
+        return True
+
+    def isfile(self, path):
+        e = self._entry(path)
+        try:
+            return e is not None and e.is_file()
+        except OSError:
+            return False
+
+    def isdir(self, path):
+        e = self._entry(path)
+        try:
+            return e is not None and e.is_dir()
+        except OSError:
+            return False
+
+    def getsize(self, path):
+        e = self._entry(path)
+        if e is None:
+            raise OSError('No such file: ' + path)
+        return e.stat().st_size
+
+    def getmtime(self, path):
+        e = self._entry(path)
+        if e is None:
+            raise OSError('No such file: ' + path)
+        return e.stat().st_mtime
+
+    def verify_file(self, fpath, description='', is_critical=False, silent=False):
+        """ Same contract as ngs_utils.file_utils.verify_file, answered from the cache """
+        if not fpath:
+            return None
+        error = None
+        if not self.exists(fpath):
+            error = (description + ': ' if description else '') + fpath + ' does not exist'
+        elif not self.isfile(fpath):
+            error = (description + ': ' if description else '') + fpath + ' is not a file'
+        elif self.getsize(fpath) <= 0:
+            error = (description + ': ' if description else '') + fpath + ' is empty'
+        if error:
+            if is_critical:
+                critical(error)
+            if not silent:
+                err(error)
+            return None
+        return fpath
+
+    def verify_dir(self, dirpath, description='', is_critical=False, silent=False):
+        if not dirpath:
+            return None
+        if not self.isdir(dirpath):
+            error = (description + ': ' if description else '') + dirpath + ' does not exist or is not a directory'
+            if is_critical:
+                critical(error)
+            if not silent:
+                err(error)
+            return None
+        return dirpath
+
+    def invalidate(self, path):
+        """ Forget the listing of the parent directory of path, and of path itself if it is a directory.
+            Call after creating, removing or rewriting path.
+        """
+        path = normpath(abspath(path))
+        with self._lock:
+            self.invalidations += 1
+            self._entries_by_dir.pop(dirname(path), None)
+            for dirpath in list(self._entries_by_dir):
+                if dirpath == path or dirpath.startswith(path + os.sep):
+                    del self._entries_by_dir[dirpath]
+
+    def hit_rate(self):
+        return float(self.hits) / self.lookups if self.lookups else 0.0
+
+    def report(self, title='Filesystem metadata cache'):
+        info(title + ': ' + str(self.lookups) + ' lookups answered with ' + str(self.listings) +
+             ' directory listings (hit rate ' + '{:.1%}'.format(self.hit_rate()) + ', ' +
+             str(self.invalidations) + ' invalidations)')
+
+
+fs_cache = FsCache()
@@ -0,0 +1,321 @@
+""" Multi-threaded gzip reading and writing for fastq files.
+
+open_fastq() returns a binary file object and picks the fastest codec available:
+
+  reading: "isal"   - python-isal (threaded when the version supports it)
+           "pigz"   - a pigz -d subprocess, inflating in a separate process
+           "thread" - stdlib gzip inflating in a background thread, pipelined with the
+                      consumer through a queue of buffer_size blocks (zlib releases the GIL)
+           "gzip"   - plain stdlib gzip
+  writing: "isal", "pigz", "block" - input is cut into block_size blocks compressed as
+           independent gzip members on a thread pool and written in order (concatenated
+           members are a valid gzip file), or "gzip".
+
+Plain (not .gz) files are opened directly, and virtual merge manifests (see virtual_merge.py)
+are read as the concatenation of their lane files. See benchmarks/gzip_io_bench.py for the numbers.
+"""
+import gzip
+import io
+import subprocess
+import threading
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+try:
+    from queue import Queue, Empty, Full
+except ImportError:
+    from Queue import Queue, Empty, Full
+
+from ngs_utils.file_utils import which
+
+from prealign.virtual_merge import is_manifest, read_manifest
+
+
+DEFAULT_THREADS = 2
+DEFAULT_LEVEL = 6
+DEFAULT_BUFFER_SIZE = 1 << 20
+DEFAULT_BLOCK_SIZE = 4 << 20
+READ_METHODS = ('isal', 'pigz', 'thread', 'gzip')
+WRITE_METHODS = ('isal', 'pigz', 'block', 'gzip')
+
+
+def _isal_modules():
+    try:
+        from isal import igzip
+    except ImportError:
+        return None, None
+    try:
+        from isal import igzip_threaded
+    except ImportError:
+        igzip_threaded = None
+    return igzip, igzip_threaded
+
+
+def available_methods(mode='rb'):
+    methods = []
+    if _isal_modules()[0]:
+        methods.append('isal')
+    if which('pigz'):
+        methods.append('pigz')
+    methods.append('thread' if 'r' in mode else 'block')
+    methods.append('gzip')
+    return methods
+
+
+class _PipelinedGzipReader(io.RawIOBase):
+    """ Inflates in a background thread, handing over buffer_size blocks through a bounded queue """
+    def __init__(self, fpath, buffer_size=DEFAULT_BUFFER_SIZE, queue_size=4):
+        io.RawIOBase.__init__(self)
+        self.name = fpath
+        self._buffer_size = buffer_size
+        self._queue = Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._block = b''
+        self._pos = 0
+        self._eof = False
+        self._thread = threading.Thread(target=self._inflate, args=(fpath,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _inflate(self, fpath):
+        try:
+            with gzip.open(fpath, 'rb') as f:
+                while not self._stop.is_set():
+                    block = f.read(self._buffer_size)
+                    if not self._put(block) or not block:
+                        return
+        except Exception as e:
+            self._put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._pos >= len(self._block):
+            if self._eof:
+                return 0
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                self._eof = True
+                return 0
+            self._block, self._pos = item, 0
+        n = min(len(b), len(self._block) - self._pos)
+        b[:n] = self._block[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            try:
+                while True:
+                    self._queue.get_nowait()
+            except Empty:
+                pass
+            self._thread.join()
+        io.RawIOBase.close(self)
+
+
+class _ProcessReader(io.RawIOBase):
+    """ Reads the stdout of a decompressing process, checking its exit code when fully read """
+    def __init__(self, cmd, fpath, buffer_size=DEFAULT_BUFFER_SIZE):
+        io.RawIOBase.__init__(self)
+        self.name = fpath
+        self._cmd = cmd
+        self._proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=buffer_size)
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._proc.stdout.readinto(b)
+        if not n:
+            self._eof = True
+        return n
+
+    def close(self):
+        if not self.closed:
+            if not self._eof:
+                self._proc.terminate()
+            self._proc.stdout.close()
+            ret = self._proc.wait()
+            io.RawIOBase.close(self)
+            if self._eof and ret != 0:
+                raise IOError(' '.join(self._cmd) + ' exited with code ' + str(ret))
+        else:
+            io.RawIOBase.close(self)
+
+
+class BlockGzipWriter(io.RawIOBase):
+    """ Compresses block_size blocks as independent gzip members on a thread pool, writing them in order """
+    def __init__(self, fpath, level=DEFAULT_LEVEL, threads=DEFAULT_THREADS, block_size=DEFAULT_BLOCK_SIZE):
+        io.RawIOBase.__init__(self)
+        self.name = fpath
+        self._level = level
+        self._block_size = block_size
+        self._max_pending = 2 * threads
+        self._out = open(fpath, 'wb')
+        self._pool = ThreadPool(threads)
+        self._pending = deque()
+        self._chunks = []
+        self._chunks_len = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._chunks_len += len(data)
+        if self._chunks_len >= self._block_size:
+            self._submit()
+        return len(data)
+
+    def _submit(self):
+        if not self._chunks_len:
+            return
+        block = b''.join(self._chunks)
+        self._chunks, self._chunks_len = [], 0
+        self._pending.append(self._pool.apply_async(_compress_member, (block, self._level)))
+        while len(self._pending) > self._max_pending:
+            self._out.write(self._pending.popleft().get())
+
+    def flush(self):
+        if not self._out.closed:
+            self._submit()
+            while self._pending:
+                self._out.write(self._pending.popleft().get())
+            self._out.flush()
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.flush()
+            finally:
+                self._pool.close()
+                self._pool.join()
+                self._out.close()
+        io.RawIOBase.close(self)
+
+
+def _compress_member(block, level):
+    c = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return c.compress(block) + c.flush()
+
+
+class _ChainedReader(io.RawIOBase):
+    """ Reads several files one after another as a single stream """
+    def __init__(self, fpaths, open_fn):
+        io.RawIOBase.__init__(self)
+        self._fpaths = list(fpaths)
+        self._open_fn = open_fn
+        self._cur = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while True:
+            if self._cur is None:
+                if not self._fpaths:
+                    return 0
+                self._cur = self._open_fn(self._fpaths.pop(0))
+            n = self._cur.readinto(b)
+            if n:
+                return n
+            self._cur.close()
+            self._cur = None
+
+    def close(self):
+        if self._cur is not None:
+            self._cur.close()
+            self._cur = None
+        io.RawIOBase.close(self)
+
+
+class _ProcessWriter(io.RawIOBase):
+    def __init__(self, cmd, fpath):
+        io.RawIOBase.__init__(self)
+        self.name = fpath
+        self._cmd = cmd
+        self._out = open(fpath, 'wb')
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=self._out)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._proc.stdin.write(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._proc.stdin.close()
+            ret = self._proc.wait()
+            self._out.close()
+            io.RawIOBase.close(self)
+            if ret != 0:
+                raise IOError(' '.join(self._cmd) + ' exited with code ' + str(ret))
+
+
+def _open_read(fpath, threads, buffer_size, method):
+    if method == 'isal':
+        igzip, igzip_threaded = _isal_modules()
+        if igzip_threaded and threads > 1:
+            return igzip_threaded.open(fpath, 'rb', threads=threads)
+        return io.BufferedReader(igzip.open(fpath, 'rb'), buffer_size)
+    if method == 'pigz':
+        return io.BufferedReader(_ProcessReader([which('pigz'), '-dc', '-p', str(threads), fpath], fpath, buffer_size),
+                                 buffer_size)
+    if method == 'thread':
+        return io.BufferedReader(_PipelinedGzipReader(fpath, buffer_size), buffer_size)
+    return io.BufferedReader(gzip.open(fpath, 'rb'), buffer_size)
+
+
+def _open_write(fpath, threads, level, buffer_size, method):
+    if method == 'isal':
+        igzip, igzip_threaded = _isal_modules()
+        if igzip_threaded and threads > 1:
+            return igzip_threaded.open(fpath, 'wb', compresslevel=min(level, 3), threads=threads)
+        return io.BufferedWriter(igzip.open(fpath, 'wb', compresslevel=min(level, 3)), buffer_size)
+    if method == 'pigz':
+        return io.BufferedWriter(_ProcessWriter([which('pigz'), '-c', '-' + str(level), '-p', str(threads)], fpath),
+                                 buffer_size)
+    if method == 'block':
+        return io.BufferedWriter(BlockGzipWriter(fpath, level, threads), buffer_size)
+    return io.BufferedWriter(gzip.open(fpath, 'wb', compresslevel=level), buffer_size)
+
+
+def open_fastq(fpath, mode='rb', threads=DEFAULT_THREADS, level=DEFAULT_LEVEL, buffer_size=DEFAULT_BUFFER_SIZE,
+               method=None):
+    """ Opens a fastq (gzipped if it ends with .gz) for binary reading or writing.
+        method is one of READ_METHODS or WRITE_METHODS; the fastest available one is used by default.
+    """
+    if mode not in ('rb', 'wb'):
+        raise ValueError('open_fastq supports only "rb" and "wb" modes, got "' + mode + '"')
+    if is_manifest(fpath):
+        if mode != 'rb':
+            raise ValueError('Virtual merge manifests are read-only: ' + fpath)
+        return io.BufferedReader(_ChainedReader(read_manifest(fpath), lambda part_fpath: open_fastq(
+            part_fpath, threads=threads, buffer_size=buffer_size, method=method)), buffer_size)
+    if not fpath.endswith('.gz'):
+        return open(fpath, mode, buffering=buffer_size)
+    if method is None:
+        method = available_methods(mode)[0]
+        if threads <= 1 and method in ('thread', 'block'):
+            method = 'gzip'
+    if mode == 'rb':
+        return _open_read(fpath, threads, buffer_size, method)
+    return _open_write(fpath, threads, level, buffer_size, method)
@@ -0,0 +1,83 @@
+""" Vectorized sequence encoding and 64-bit hashing helpers shared by the sketching steps. """
+import numpy as np
+
+
+N_CODE = 4
+
+_codes = np.full(256, N_CODE, dtype=np.uint8)
+for _i, _b in enumerate('ACGT'):
+    _codes[ord(_b)] = _i
+    _codes[ord(_b.lower())] = _i
+
+
+def encode_seqs(seqs, width=None):
+    """ Encodes a list of byte strings as an (n, width) uint8 array of 2-bit codes,
+        padding short sequences and replacing non-ACGT bases with N_CODE.
+    """
+    if not seqs:
+        return np.zeros((0, width or 0), dtype=np.uint8)
+    lens = [len(s) for s in seqs]
+    width = width or max(lens)
+    if all(l == width for l in lens):
+        raw = np.frombuffer(b''.join(seqs), dtype=np.uint8).reshape(len(seqs), width)
+    else:
+        raw = np.full((len(seqs), width), ord('N'), dtype=np.uint8)
+        for i, s in enumerate(seqs):
+            s = s[:width]
+            raw[i, :len(s)] = np.frombuffer(s, dtype=np.uint8)
+    return _codes[raw]
+
+
+def mix64(x):
+    """ splitmix64 finalizer: a fast, well-distributed bijection on uint64 arrays """
+    x = np.asarray(x, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        x = x ^ (x >> np.uint64(31))
+    return x
+
+
+def canonical_kmer_hashes(codes, k):
+    """ Hashes of canonical (min of forward and reverse-complement) k-mers of every row of codes,
+        skipping k-mers that contain N. k must be <= 32.
+    """
+    n, width = codes.shape
+    m = width - k + 1
+    if m <= 0 or n == 0:
+        return np.zeros(0, dtype=np.uint64)
+    fw = np.zeros((n, m), dtype=np.uint64)
+    rc = np.zeros((n, m), dtype=np.uint64)
+    invalid = np.zeros((n, m), dtype=bool)
+    for j in range(k):
+        c = codes[:, j:j + m]
+        invalid |= c == N_CODE
+        c = (c & 3).astype(np.uint64)
+        fw = (fw << np.uint64(2)) | c
+        rc |= (np.uint64(3) - c) << np.uint64(2 * j)
+    return mix64(np.minimum(fw, rc)[~invalid])
+
+
+_FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+_FNV_PRIME = np.uint64(0x100000001b3)
+
+
+def hash_rows(codes, lengths=None):
+    """ One well-mixed 64-bit hash per row of a 2D uint8 array (FNV-1a over columns, then mix64).
+        With lengths, only the first lengths[i] columns of row i are hashed, so the hash does not depend on padding.
+    """
+    h = np.full(codes.shape[0], _FNV_OFFSET, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for j in range(codes.shape[1]):
+            updated = (h ^ codes[:, j].astype(np.uint64)) * _FNV_PRIME
+            h = updated if lengths is None else np.where(lengths > j, updated, h)
+    return mix64(h)
+
+
+def hash_byte_strings(strings):
+    """ Stable 64-bit hashes of a list of byte strings """
+    lengths = np.array([len(s) for s in strings], dtype=np.int64)
+    raw = np.zeros((len(strings), int(lengths.max()) if len(strings) else 0), dtype=np.uint8)
+    for i, s in enumerate(strings):
+        raw[i, :len(s)] = np.frombuffer(s, dtype=np.uint8)
+    return hash_rows(raw, lengths)
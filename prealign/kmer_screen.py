@@ -0,0 +1,221 @@
+""" In-process k-mer contamination screen for the metamapping step.
+
+Instead of aligning reads to several reference genomes, the downsampled reads (the
+first reads of every lane when targqc downsampled internally) are sketched with FracMinHash (canonical k-mers whose hash is below 2^64/scaled) and the
+sketch is looked up in a prebuilt database of reference sketches. The database is a
+directory with a sorted uint64 array of hashes and a parallel array of species ids,
+loaded memory-mapped, so all samples on a node share the pages.
+
+Build a database:
+    python -m prealign.kmer_screen -o /ngs/reference_data/kmer_screen Human=hg19.fa Mouse=mm10.fa ...
+"""
+import json
+from collections import OrderedDict
+from itertools import islice
+from os.path import join
+
+import numpy as np
+
+from ngs_utils.logger import info, debug
+from ngs_utils.file_utils import safe_mkdir, file_transaction
+
+from prealign.gzip_io import open_fastq
+from prealign.hashing import encode_seqs, canonical_kmer_hashes
+from prealign.virtual_merge import is_manifest, read_manifest
+
+
+DEFAULT_K = 21
+DEFAULT_SCALED = 1000
+DEFAULT_MAX_PAIRS = 500000
+BATCH_READS = 10000
+UNCLASSIFIED = 'Unclassified'
+
+HASHES_FNAME = 'hashes.npy'
+SPECIES_IDS_FNAME = 'species_ids.npy'
+META_FNAME = 'species.json'
+MQC_TABLE_FNAME = 'kmer_screen_mqc.tsv'
+
+
+def _max_hash(scaled):
+    return np.uint64((1 << 64) // scaled - 1)
+
+
+def _sketch_seqs(seqs, k, max_hash):
+    hashes = canonical_kmer_hashes(encode_seqs(seqs), k)
+    return hashes[hashes <= max_hash]
+
+
+def _iter_fasta_chunks(fasta_fpath, chunk_size, overlap):
+    """ Yields sequence chunks of at most chunk_size bases, consecutive chunks of a contig overlapping by `overlap` """
+    with open_fastq(fasta_fpath) as f:
+        buf = bytearray()  # appending to bytes would copy the whole chunk for every line
+        for line in f:
+            if line.startswith(b'>'):
+                if len(buf) > overlap:
+                    yield bytes(buf)
+                del buf[:]
+                continue
+            buf += line.strip()
+            if len(buf) >= chunk_size:
+                start = 0
+                while len(buf) - start >= chunk_size:
+                    yield bytes(buf[start:start + chunk_size])
+                    start += chunk_size - overlap
+                del buf[:start]
+        if len(buf) > overlap:
+            yield bytes(buf)
+
+
+def build_db(fasta_fpath_by_species, db_dirpath, k=DEFAULT_K, scaled=DEFAULT_SCALED, chunk_size=1000000):
+    max_hash = _max_hash(scaled)
+    safe_mkdir(db_dirpath)
+    all_hashes = []
+    all_ids = []
+    names = list(fasta_fpath_by_species.keys())
+    for species_id, name in enumerate(names):
+        info('Sketching ' + name + ' from ' + fasta_fpath_by_species[name])
+        hashes = np.unique(np.concatenate([np.zeros(0, dtype=np.uint64)] + [
+            _sketch_seqs([chunk], k, max_hash)
+            for chunk in _iter_fasta_chunks(fasta_fpath_by_species[name], chunk_size, k - 1)]))
+        info('  ' + str(len(hashes)) + ' hashes')
+        all_hashes.append(hashes)
+        all_ids.append(np.full(len(hashes), species_id, dtype=np.uint16))
+    hashes = np.concatenate(all_hashes)
+    ids = np.concatenate(all_ids)
+    order = np.argsort(hashes, kind='mergesort')
+    np.save(join(db_dirpath, HASHES_FNAME), hashes[order])
+    np.save(join(db_dirpath, SPECIES_IDS_FNAME), ids[order])
+    with open(join(db_dirpath, META_FNAME), 'w') as f:
+        json.dump(dict(species=names, k=k, scaled=scaled), f, indent=2)
+    info('Saved k-mer screen database to ' + db_dirpath)
+    return db_dirpath
+
+
+class SketchDb:
+    def __init__(self, db_dirpath):
+        with open(join(db_dirpath, META_FNAME)) as f:
+            meta = json.load(f)
+        self.species = meta['species']
+        self.k = meta['k']
+        self.scaled = meta['scaled']
+        self.max_hash = _max_hash(self.scaled)
+        self.hashes = np.load(join(db_dirpath, HASHES_FNAME), mmap_mode='r')
+        self.species_ids = np.load(join(db_dirpath, SPECIES_IDS_FNAME), mmap_mode='r')
+
+    def classify(self, hashes, counts):
+        """ Percentage of sampled k-mer occurrences contained in each species' sketch.
+            A k-mer shared by several species counts towards each of them.
+        """
+        left = np.searchsorted(self.hashes, hashes, side='left')
+        right = np.searchsorted(self.hashes, hashes, side='right')
+        hits = right - left
+        total = float(counts.sum())
+        pct_by_species = OrderedDict((name, 0.0) for name in self.species)
+        if total:
+            found = hits > 0
+            db_idx = np.repeat(left[found], hits[found])
+            db_idx += np.arange(len(db_idx)) - np.repeat(np.cumsum(hits[found]) - hits[found], hits[found])
+            weights = np.repeat(counts[found], hits[found])
+            per_species = np.bincount(np.asarray(self.species_ids[db_idx], dtype=np.int64),
+                                      weights=weights, minlength=len(self.species))
+            for name, w in zip(self.species, per_species):
+                pct_by_species[name] = float(100.0 * w / total)
+            pct_by_species[UNCLASSIFIED] = float(100.0 * counts[~found].sum() / total)
+        else:
+            pct_by_species[UNCLASSIFIED] = 0.0
+        return pct_by_species
+
+
+def _read_fastq_seqs(fastq_fpath, max_reads):
+    with open_fastq(fastq_fpath) as f:
+        for line in islice(f, 1, max_reads * 4 if max_reads else None, 4):
+            yield line.rstrip()
+
+
+def screen_sample(sample_name, l_fpaths, r_fpaths, db_dirpath, output_fpath, max_pairs=DEFAULT_MAX_PAIRS):
+    """ Runs on an engine. Sketches up to max_pairs pairs, taken evenly from the first reads of the fastqs
+        (the lanes of a sample, or its downsampled fastqs). Returns (sample_name, {species: pct})
+        and writes it to output_fpath.
+    """
+    from itertools import islice
+    import numpy as np
+    from ngs_utils.file_utils import file_transaction
+    from prealign.kmer_screen import SketchDb, _read_fastq_seqs, _sketch_seqs, BATCH_READS
+
+    db = SketchDb(db_dirpath)
+    sketches = []
+    max_reads_per_fastq = -(-max_pairs // max(1, len(l_fpaths))) if max_pairs else None
+    for fpath in list(l_fpaths) + list(r_fpaths):
+        if not fpath:
+            continue
+        seqs = _read_fastq_seqs(fpath, max_reads_per_fastq)
+        while True:
+            batch = list(islice(seqs, BATCH_READS))
+            if not batch:
+                break
+            sketches.append(_sketch_seqs(batch, db.k, db.max_hash))
+    hashes, counts = np.unique(np.concatenate(sketches or [np.zeros(0, dtype=np.uint64)]), return_counts=True)
+    pct_by_species = db.classify(hashes, counts)
+
+    with file_transaction(None, output_fpath) as tx:
+        with open(tx, 'w') as f:
+            f.write('species\tpct_of_sampled_kmers\n')
+            for name, pct in pct_by_species.items():
+                f.write(name + '\t' + '%.3f' % pct + '\n')
+    return sample_name, pct_by_species
+
+
+def write_mqc_table(pct_by_species_by_sample, output_fpath):
+    """ MultiQC custom content bar graph, one row per sample """
+    species = []
+    for pct_by_species in pct_by_species_by_sample.values():
+        species.extend(n for n in pct_by_species if n not in species)
+    with file_transaction(None, output_fpath) as tx:
+        with open(tx, 'w') as f:
+            f.write("# id: 'kmer_screen'\n"
+                    "# section_name: 'Contamination screen'\n"
+                    "# description: 'Percentage of sampled k-mers of the screened reads found in each reference sketch'\n"
+                    "# plot_type: 'bargraph'\n"
+                    "# pconfig:\n"
+                    "#     id: 'kmer_screen_plot'\n"
+                    "#     title: 'k-mer contamination screen'\n"
+                    "#     ylab: '% of sampled k-mers'\n")
+            f.write('Sample\t' + '\t'.join(species) + '\n')
+            for sname, pct_by_species in pct_by_species_by_sample.items():
+                f.write(sname + '\t' + '\t'.join('%.3f' % pct_by_species.get(n, 0.0) for n in species) + '\n')
+    return output_fpath
+
+
+def _expand_manifests(fpaths):
+    return [f for fpath in fpaths for f in (read_manifest(fpath) if fpath and is_manifest(fpath) else [fpath])]
+
+
+def run_kmer_screen(project, fastqs_by_sample, view, db_dirpath, max_pairs=DEFAULT_MAX_PAIRS):
+    """ fastqs_by_sample: {sample_name: (R1 fastqs, R2 fastqs)} """
+    safe_mkdir(project.downsample_metamapping_dirpath)
+    results = view.run(screen_sample, [
+        [sname, _expand_manifests(l_fpaths), _expand_manifests(r_fpaths), db_dirpath,
+         join(project.downsample_metamapping_dirpath, sname + '.kmer_screen.tsv'), max_pairs]
+        for sname, (l_fpaths, r_fpaths) in fastqs_by_sample.items()])
+    pct_by_species_by_sample = OrderedDict(results)
+    for sname, pct_by_species in pct_by_species_by_sample.items():
+        debug(sname + ': ' + ', '.join(n + ' ' + '%.1f' % p + '%' for n, p in pct_by_species.items()))
+    return write_mqc_table(pct_by_species_by_sample, join(project.downsample_metamapping_dirpath, MQC_TABLE_FNAME))
+
+
+def main():
+    from optparse import OptionParser
+    parser = OptionParser(usage='python -m prealign.kmer_screen -o DB_DIR NAME=FASTA [NAME=FASTA ...]',
+                          description='Build a k-mer screen database for prealign --metamapping')
+    parser.add_option('-o', dest='db_dirpath', help='Output database directory')
+    parser.add_option('-k', dest='k', type='int', default=DEFAULT_K, help='k-mer size (<= 32), default %default')
+    parser.add_option('--scaled', dest='scaled', type='int', default=DEFAULT_SCALED,
+                      help='Keep 1/SCALED of k-mers, default %default')
+    opts, args = parser.parse_args()
+    if not opts.db_dirpath or not args or any('=' not in a for a in args):
+        parser.error('provide -o and NAME=FASTA arguments')
+    build_db(OrderedDict(a.split('=', 1) for a in args), opts.db_dirpath, k=opts.k, scaled=opts.scaled)
+
+
+if __name__ == '__main__':
+    main()
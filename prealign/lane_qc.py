@@ -0,0 +1,130 @@
+""" Lane-resolved read QC on the raw lane fastqs.
+
+One task per (sample, lane, read) runs directly on the files found by find_raw_fastq,
+so it does not wait for the lane merge, and problems of a single lane are not averaged
+away. ReadStats are sums, so the per-sample numbers are the exact merge of the lane
+numbers, without a second pass over the merged files. A lane is flagged as an outlier
+when a metric differs from the median of the other lanes of the same sample and read
+by more than a tolerance.
+"""
+import json
+import re
+from collections import OrderedDict
+from os.path import basename
+
+from ngs_utils.logger import info, warn
+from ngs_utils.file_utils import file_transaction
+
+from prealign.fs_cache import fs_cache
+from prealign.read_stats import ReadStats
+
+
+LANE_QC_JSON_FNAME = 'lane_qc.json'
+MQC_TABLE_FNAME = 'lane_qc_mqc.tsv'
+
+# ReadStats property -> largest allowed absolute difference from the median of the other lanes
+TOLERANCES = OrderedDict([
+    ('q30_pct',     5.0),
+    ('mean_qual',   2.0),
+    ('gc_pct',      3.0),
+    ('n_pct',       1.0),
+    ('adapter_pct', 5.0),
+])
+MIN_YIELD_RATIO = 0.5  # reads of a lane relative to the median of the other lanes
+
+
+def lane_of(fastq_fpath, default=None):
+    m = re.search(r'_L(\d\d\d)_', basename(fastq_fpath))
+    return int(m.group(1)) if m else default
+
+
+def lane_fastq_stats(fastq_fpath):
+    """ Runs on an engine. Returns ReadStats.to_dict() of all reads of one lane fastq """
+    from prealign.read_stats import read_fastq_stats
+    return read_fastq_stats(fastq_fpath).to_dict()
+
+
+def run_lane_qc(fastqs_by_sample, view):
+    """ fastqs_by_sample: {sample_name: [(lane, read, fpath), ...]}, read is 'R1' or 'R2'.
+        Returns ({sample_name: {(lane, read): ReadStats}}, {sample_name: ReadStats}).
+    """
+    tasks = [(sname, lane, read, fpath) for sname, fastqs in fastqs_by_sample.items() for lane, read, fpath in fastqs]
+    results = view.run(lane_fastq_stats, [[fpath] for _, _, _, fpath in tasks])
+    lane_stats_by_sample = OrderedDict((sname, OrderedDict()) for sname in fastqs_by_sample)
+    for (sname, lane, read, _), res in zip(tasks, results):
+        lane_stats_by_sample[sname][(lane, read)] = ReadStats.from_dict(res)
+    sample_stats = OrderedDict()
+    for sname, stats_by_lane in lane_stats_by_sample.items():
+        rs = ReadStats()
+        for lane_rs in stats_by_lane.values():
+            rs.merge(lane_rs)
+        sample_stats[sname] = rs
+    return lane_stats_by_sample, sample_stats
+
+
+def _median(values):
+    values = sorted(values)
+    n = len(values)
+    if not n:
+        return None
+    return values[n // 2] if n % 2 else (values[n // 2 - 1] + values[n // 2]) / 2.0
+
+
+def find_lane_outliers(lane_stats_by_sample):
+    """ Returns {(sample_name, lane, read): [descriptions]} for lanes that disagree with the other lanes """
+    outliers = OrderedDict()
+    for sname, stats_by_lane in lane_stats_by_sample.items():
+        for (lane, read), rs in stats_by_lane.items():
+            others = [o for (l, r), o in stats_by_lane.items() if r == read and l != lane]
+            if not others:
+                continue
+            reasons = []
+            median_reads = _median([o.reads for o in others])
+            if median_reads and rs.reads < MIN_YIELD_RATIO * median_reads:
+                reasons.append('reads ' + str(rs.reads) + ' vs ' + str(int(median_reads)) + ' in other lanes')
+            for prop, tolerance in TOLERANCES.items():
+                value = getattr(rs, prop)
+                median = _median([getattr(o, prop) for o in others if getattr(o, prop) is not None])
+                if value is not None and median is not None and abs(value - median) > tolerance:
+                    reasons.append(prop + ' %.2f vs %.2f in other lanes' % (value, median))
+            if reasons:
+                outliers[(sname, lane, read)] = reasons
+    return outliers
+
+
+def write_lane_qc_reports(lane_stats_by_sample, sample_stats, outliers, json_fpath, mqc_fpath):
+    with file_transaction(None, json_fpath) as tx:
+        with open(tx, 'w') as f:
+            json.dump(OrderedDict([
+                ('samples', OrderedDict((sname, rs.to_dict()) for sname, rs in sample_stats.items())),
+                ('lanes', [OrderedDict([('sample', sname), ('lane', lane), ('read', read)] +
+                                       list(rs.to_dict().items()) +
+                                       [('outlier', outliers.get((sname, lane, read), []))])
+                           for sname, stats_by_lane in lane_stats_by_sample.items()
+                           for (lane, read), rs in stats_by_lane.items()]),
+            ]), f, indent=2)
+    fs_cache.invalidate(json_fpath)
+
+    columns = [('Reads', 'reads'), ('Mean quality', 'mean_qual'), ('% Q30 bases', 'q30_pct'), ('% GC', 'gc_pct'),
+               ('% N', 'n_pct'), ('% reads with adapter', 'adapter_pct')]
+    with file_transaction(None, mqc_fpath) as tx:
+        with open(tx, 'w') as f:
+            f.write("# id: 'lane_qc'\n"
+                    "# section_name: 'Lane QC'\n"
+                    "# description: 'Read quality of every lane of every sample, computed on the raw lane fastqs'\n"
+                    "# plot_type: 'table'\n")
+            f.write('Sample\t' + '\t'.join(title for title, _ in columns) + '\tStatus\n')
+            for sname, stats_by_lane in lane_stats_by_sample.items():
+                for (lane, read), rs in stats_by_lane.items():
+                    vals = [getattr(rs, prop) for _, prop in columns]
+                    reasons = outliers.get((sname, lane, read))
+                    f.write(sname + ' L' + str(lane) + ' ' + read + '\t' + '\t'.join(
+                        '' if v is None else ('%.2f' % v if isinstance(v, float) else str(v)) for v in vals) +
+                            '\t' + ('OUTLIER: ' + '; '.join(reasons) if reasons else 'OK') + '\n')
+    fs_cache.invalidate(mqc_fpath)
+
+    info('Lane QC: ' + str(sum(len(v) for v in lane_stats_by_sample.values())) + ' lane fastqs, ' +
+         str(len(outliers)) + ' outliers')
+    for (sname, lane, read), reasons in outliers.items():
+        warn('  ' + sname + ' lane ' + str(lane) + ' ' + read + ': ' + '; '.join(reasons))
+    return json_fpath, mqc_fpath
@@ -0,0 +1,264 @@
+""" Columnar store of per-sample QC metrics.
+
+Every project gets a qc_metrics.npz table next to its reports, and rows can be appended
+to a global store shared between runs. Both are plain NumPy .npz files with one typed
+array per column, so comparing thousands of historical samples is a vectorized query:
+
+    m = load_metrics('/ngs/qc/prealign_metrics.npz')
+    low = m['sample'][(m['q30_pct'] < 75) & (m['read_pairs'] > 1e6)]
+
+Rows are keyed by (run_id, project, sample). Appending a row with an existing key merges it
+column by column: values missing in the new row (e.g. FastQC did not run in a partial rerun)
+keep what the store had.
+"""
+import fcntl
+import os
+from collections import OrderedDict
+from os.path import join, isfile, dirname
+
+import numpy as np
+
+from ngs_utils.logger import info, warn, debug
+from ngs_utils.file_utils import safe_mkdir
+
+from prealign.fastqc_archive import read_fastqc_data_lines, fastqc_extracted_dirpath, fastqc_zip_fpath
+from prealign.fs_cache import fs_cache
+from prealign.targqc_json import read_record_values
+
+
+KEY_COLUMNS = ('run_id', 'project', 'sample')
+
+COLUMNS = OrderedDict([
+    ('run_id',       'U'),
+    ('project',      'U'),
+    ('sample',       'U'),
+    ('read_pairs',   np.int64),
+    ('q30_pct',      np.float64),
+    ('gc_pct',       np.float64),
+    ('dup_pct',      np.float64),
+    ('ontarget_pct', np.float64),
+    ('demux_reads',       np.int64),
+    ('demux_yield',       np.int64),
+    ('demux_q30_pct',     np.float64),
+    ('perfect_index_pct', np.float64),
+])
+
+PROJECT_METRICS_FNAME = 'qc_metrics.npz'
+
+# Names TargQC has used for the on-target rate; the value may be a fraction or a percentage
+ONTARGET_METRIC_NAMES = (
+    'Percentage of reads mapped on target',
+    'Percentage of mapped reads on target',
+    'Part of reads mapped on target',
+    'Reads mapped on target',
+)
+
+
+def _missing_value(dtype):
+    if dtype == 'U':
+        return ''
+    if np.dtype(dtype).kind == 'f':
+        return np.nan
+    return -1
+
+
+def _missing_mask(arr):
+    if arr.dtype.kind == 'U':
+        return arr == ''
+    if arr.dtype.kind == 'f':
+        return np.isnan(arr)
+    return arr == -1
+
+
+def parse_fastqc_data(fastqc_data_fpath):
+    """ Returns dict(total_sequences, gc_pct, dedup_pct, q_counts) from fastqc_data.txt or a FastQC zip """
+    res = dict(total_sequences=None, gc_pct=None, dedup_pct=None, q_counts=dict())
+    module = None
+    for line in read_fastqc_data_lines(fastqc_data_fpath):
+        if line.startswith('>>'):
+            module = None if line.startswith('>>END_MODULE') else line[2:].split('\t')[0]
+            continue
+        fs = line.rstrip('\n').split('\t')
+        if module == 'Basic Statistics':
+            if fs[0] == 'Total Sequences':
+                res['total_sequences'] = int(fs[1])
+            elif fs[0] == '%GC':
+                res['gc_pct'] = float(fs[1])
+        elif module == 'Per sequence quality scores' and not line.startswith('#'):
+            res['q_counts'][int(float(fs[0]))] = float(fs[1])
+        elif module == 'Sequence Duplication Levels' and fs[0] == '#Total Deduplicated Percentage':
+            res['dedup_pct'] = float(fs[1])
+    return res
+
+
+def _fastqc_metrics(fastqc_data_fpaths):
+    """ Combines R1 and R2 FastQC results into read_pairs, q30_pct, gc_pct, dup_pct.
+        q30_pct is the percentage of reads with mean quality >= 30 (FastQC per-sequence quality).
+    """
+    parsed = [parse_fastqc_data(fpath) for fpath in fastqc_data_fpaths if fpath]
+    if not parsed:
+        return dict()
+    q_total = sum(sum(p['q_counts'].values()) for p in parsed)
+    q30 = sum(c for p in parsed for q, c in p['q_counts'].items() if q >= 30)
+    gcs = [p['gc_pct'] for p in parsed if p['gc_pct'] is not None]
+    dups = [100.0 - p['dedup_pct'] for p in parsed if p['dedup_pct'] is not None]
+    return dict(
+        read_pairs=parsed[0]['total_sequences'],
+        q30_pct=100.0 * q30 / q_total if q_total else None,
+        gc_pct=sum(gcs) / len(gcs) if gcs else None,
+        dup_pct=sum(dups) / len(dups) if dups else None)
+
+
+def _ontarget_pct(targqc_sample_dirpath):
+    if not targqc_sample_dirpath or not fs_cache.isdir(targqc_sample_dirpath):
+        return None
+    for fname in fs_cache.listdir(targqc_sample_dirpath):
+        if not fname.endswith('.json'):
+            continue
+        try:
+            values = read_record_values(join(targqc_sample_dirpath, fname), ONTARGET_METRIC_NAMES)
+        except ValueError:
+            continue
+        for name in ONTARGET_METRIC_NAMES:
+            v = values.get(name)
+            if isinstance(v, (int, float)) and 0 <= v <= 100:  # skip read counts
+                return v * 100.0 if v <= 1 else float(v)
+    return None
+
+
+def _fastqc_data_fpath(fastqc_dirpath, fqc_sample, base_name):
+    """ FastQC data of this invocation, or what an earlier run left in fastqc_dirpath (extracted or zipped) """
+    if fqc_sample and fqc_sample.fastqc_data_fpath:
+        return fqc_sample.fastqc_data_fpath
+    if not fastqc_dirpath or not base_name:
+        return None
+    for fpath in [join(fastqc_extracted_dirpath(fastqc_dirpath, base_name), 'fastqc_data.txt'),
+                  fastqc_zip_fpath(fastqc_dirpath, base_name)]:
+        if fs_cache.isfile(fpath):
+            return fpath
+    return None
+
+
+def collect_project_rows(run_id, project, bcl2fastq_stats=None):
+    """ One row dict per sample, from FastQC data, downsampled TargQC outputs and bcl2fastq stats.
+        Samples without any metrics are left out.
+    """
+    rows = []
+    for s in project.sample_by_name.values():
+        row = dict(run_id=run_id, project=project.name, sample=s.name)
+        row.update(_fastqc_metrics([
+            _fastqc_data_fpath(project.fastqc_dirpath, s.l_fqc_sample, s.l_fastqc_base_name),
+            _fastqc_data_fpath(project.fastqc_dirpath, s.r_fqc_sample, s.r_fastqc_base_name)]))
+        if project.downsample_targqc_dirpath:
+            row['ontarget_pct'] = _ontarget_pct(join(project.downsample_targqc_dirpath, s.name))
+        demux = bcl2fastq_stats.find_sample(s.name) if bcl2fastq_stats else None
+        if demux:
+            row.update(demux_reads=demux.reads, demux_yield=demux.yield_bases,
+                       demux_q30_pct=demux.q30_pct, perfect_index_pct=demux.perfect_index_pct)
+        if all(v is None for k, v in row.items() if k not in KEY_COLUMNS):
+            debug('No QC metrics found for ' + s.name + ', not saving a row')
+            continue
+        rows.append(row)
+    return rows
+
+
+def rows_to_columns(rows):
+    cols = OrderedDict()
+    for name, dtype in COLUMNS.items():
+        vals = [r.get(name) for r in rows]
+        vals = [_missing_value(dtype) if v is None else v for v in vals]
+        cols[name] = np.array(vals, dtype=dtype) if vals else np.zeros(0, dtype=('U1' if dtype == 'U' else dtype))
+    return cols
+
+
+def load_metrics(fpath):
+    """ Returns an OrderedDict of column arrays; columns absent from older files are filled with missing values """
+    cols = OrderedDict()
+    with np.load(fpath, allow_pickle=False) as data:
+        n = len(data['sample'])
+        for name, dtype in COLUMNS.items():
+            if name in data.files:
+                cols[name] = data[name]
+            else:
+                cols[name] = np.full(n, _missing_value(dtype), dtype=('U1' if dtype == 'U' else dtype))
+        for name in data.files:
+            if name not in cols:
+                cols[name] = data[name]
+    return cols
+
+
+def _save(fpath, cols):
+    safe_mkdir(dirname(fpath))
+    tx_fpath = fpath + '.tx'
+    with open(tx_fpath, 'wb') as f:
+        np.savez_compressed(f, **cols)
+    os.rename(tx_fpath, fpath)
+    fs_cache.invalidate(fpath)
+
+
+def _fill_missing(new_cols, old):
+    """ Fills the missing values of new rows whose key is in old with the old values """
+    old_i_by_key = dict((k, i) for i, k in enumerate(zip(*[old[k] for k in KEY_COLUMNS])))
+    pairs = [(new_i, old_i_by_key[k]) for new_i, k in enumerate(zip(*[new_cols[k] for k in KEY_COLUMNS]))
+             if k in old_i_by_key]
+    if not pairs:
+        return new_cols
+    new_i, old_i = np.array(pairs, dtype=np.int64).T
+    cols = OrderedDict()
+    for name, col in new_cols.items():
+        if name in KEY_COLUMNS or name not in old:
+            cols[name] = col
+            continue
+        col = col.astype(np.result_type(col, old[name]))
+        missing = _missing_mask(col[new_i]) & ~_missing_mask(old[name][old_i])
+        col[new_i[missing]] = old[name][old_i[missing]]
+        cols[name] = col
+    return cols
+
+
+def append_metrics(fpath, new_cols):
+    """ Appends rows to the store at fpath. Rows with an existing (run_id, project, sample) replace the old ones,
+        keeping the old values of the columns the new row is missing.
+    """
+    lock_fpath = fpath + '.lock'
+    safe_mkdir(dirname(fpath))
+    with open(lock_fpath, 'a') as lock_f:
+        fcntl.flock(lock_f, fcntl.LOCK_EX)
+        try:
+            if isfile(fpath):
+                old = load_metrics(fpath)
+                new_cols = _fill_missing(new_cols, old)
+                new_keys = set(zip(*[new_cols[k] for k in KEY_COLUMNS]))
+                keep = np.array([k not in new_keys for k in zip(*[old[k] for k in KEY_COLUMNS])], dtype=bool)
+                cols = OrderedDict()
+                for name in old:
+                    if name in new_cols:
+                        cols[name] = np.concatenate([old[name][keep], new_cols[name]])
+                    else:
+                        warn('Column ' + name + ' is not produced anymore, dropping it from ' + fpath)
+                for name in new_cols:
+                    if name not in cols:
+                        dtype = COLUMNS.get(name, new_cols[name].dtype)
+                        cols[name] = np.concatenate([
+                            np.full(int(keep.sum()), _missing_value(dtype), dtype=new_cols[name].dtype), new_cols[name]])
+            else:
+                cols = new_cols
+            _save(fpath, cols)
+        finally:
+            fcntl.flock(lock_f, fcntl.LOCK_UN)
+    debug('Metrics store ' + fpath + ' now has ' + str(len(cols['sample'])) + ' rows')
+    return fpath
+
+
+def write_project_metrics(run_id, project, global_store_fpath=None, bcl2fastq_stats=None):
+    rows = collect_project_rows(run_id, project, bcl2fastq_stats)
+    if not rows:
+        return None
+    cols = rows_to_columns(rows)
+    project_fpath = join(project.output_dir, PROJECT_METRICS_FNAME)
+    append_metrics(project_fpath, cols)  # a partial rerun keeps the metrics of the previous one
+    info('Saved QC metrics for ' + str(len(rows)) + ' samples to ' + project_fpath)
+    if global_store_fpath:
+        append_metrics(global_store_fpath, cols)
+        info('Appended them to the metrics store ' + global_store_fpath)
+    return project_fpath
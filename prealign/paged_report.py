@@ -0,0 +1,261 @@
+""" Paginated project-level report backed by a data sidecar.
+
+The report is a small HTML page next to a <report>_data directory of compact pages of
+sample rows. The page loads them on demand as <script> files (JSONP), so it also works
+when opened from shared storage over file://, and filters them with a client-side search.
+
+Every row is keyed by a fingerprint of its inputs (the files it links to or reads, with
+sizes and mtimes), computed before the row itself. On rerun, rows are built only for
+samples whose fingerprint changed, and only the pages containing them are rewritten,
+so regeneration tracks the number of changed samples instead of the project size.
+"""
+import hashlib
+import json
+import os
+from os.path import join, basename, splitext, isfile
+
+from ngs_utils.logger import info, debug
+from ngs_utils.file_utils import safe_mkdir, file_transaction
+
+from prealign.fs_cache import fs_cache
+
+try:
+    from html import escape
+except ImportError:  # Python 2
+    from cgi import escape
+
+
+PAGE_SIZE = 100
+INDEX_FNAME = 'index.js'
+INDEX_CALLBACK = 'prealignReportIndex'
+PAGE_CALLBACK = 'prealignReportPage'
+
+
+def data_dirpath_for(html_fpath):
+    return splitext(html_fpath)[0] + '_data'
+
+
+def _dumps(obj):
+    return json.dumps(obj, separators=(',', ':'), sort_keys=True)
+
+
+def fingerprint(obj):
+    return hashlib.md5(_dumps(obj).encode('utf-8')).hexdigest()
+
+
+def file_fingerprint(fpath):
+    """ [path, size, mtime] from the fs cache, [path] if it does not exist """
+    if not fpath or not fs_cache.exists(fpath):
+        return [fpath]
+    return [fpath, fs_cache.getsize(fpath), int(fs_cache.getmtime(fpath))]
+
+
+def _write_jsonp(fpath, callback, args):
+    with file_transaction(None, fpath) as tx:
+        with open(tx, 'w') as f:
+            f.write(callback + '(' + ','.join(_dumps(a) for a in args) + ');\n')
+    fs_cache.invalidate(fpath)
+
+
+def _read_jsonp(fpath, callback):
+    """ Returns the arguments of the callback call in a file written by _write_jsonp, or None """
+    if not isfile(fpath):
+        return None
+    with open(fpath) as f:
+        text = f.read().strip()
+    prefix = callback + '('
+    if not text.startswith(prefix) or not text.endswith(');'):
+        return None
+    try:
+        return json.loads('[' + text[len(prefix):-len(');')] + ']')
+    except ValueError:
+        return None
+
+
+def write_paged_report(html_fpath, project_name, metric_names, input_fp_by_sample, make_rows,
+                       header_html='', page_size=PAGE_SIZE):
+    """ input_fp_by_sample: OrderedDict {sample_name: fingerprint of the row inputs} in report order.
+        make_rows(sample_names) -> {sample_name: {metric_name: cell_html}} is called only for
+        the samples whose fingerprint changed since the previous run. Cells must be escaped html.
+        Writes html_fpath and its data directory, returns html_fpath.
+    """
+    data_dirpath = safe_mkdir(data_dirpath_for(html_fpath))
+    index_fpath = join(data_dirpath, INDEX_FNAME)
+
+    old_index = (_read_jsonp(index_fpath, INDEX_CALLBACK) or [dict()])[0]
+    old_pages = old_index.get('pages', [])
+    old_page_by_sample = dict()
+    old_fp_by_sample = dict()
+    for p in old_pages:
+        for sname, fp in zip(p['samples'], p['input_fingerprints']):
+            old_page_by_sample[sname] = p
+            old_fp_by_sample[sname] = fp
+
+    sample_names = list(input_fp_by_sample)
+    changed = [sn for sn in sample_names if old_fp_by_sample.get(sn) != input_fp_by_sample[sn]]
+    cells_by_sample = make_rows(changed) if changed else dict()
+
+    old_rows_by_file = dict()
+    def _old_cells(sname):
+        page_file = old_page_by_sample[sname]['file']
+        if page_file not in old_rows_by_file:
+            args = _read_jsonp(join(data_dirpath, page_file), PAGE_CALLBACK)
+            old_rows_by_file[page_file] = dict((r[0], r[1]) for r in args[1]) if args else dict()
+        return old_rows_by_file[page_file].get(sname)
+
+    pages = []
+    rewritten_pages = 0
+    for page_i, start in enumerate(range(0, len(sample_names), page_size)):
+        page_samples = sample_names[start:start + page_size]
+        page = dict(
+            file='page_%04d.js' % page_i,
+            samples=page_samples,
+            input_fingerprints=[input_fp_by_sample[sn] for sn in page_samples])
+        page['fingerprint'] = fingerprint([page['samples'], page['input_fingerprints']])
+        old_page = old_pages[page_i] if page_i < len(old_pages) else None
+        page_fpath = join(data_dirpath, page['file'])
+        if old_page and old_page['fingerprint'] == page['fingerprint'] and isfile(page_fpath):
+            page['metrics'] = old_page['metrics']
+        else:
+            rows = []
+            for sn in page_samples:
+                cells = cells_by_sample.get(sn)
+                if cells is None:
+                    cells = _old_cells(sn)
+                if cells is None:  # the old page is gone
+                    cells = make_rows([sn]).get(sn, dict())
+                rows.append([sn, cells])
+            page['metrics'] = sorted(set(m for _, cells in rows for m in cells))
+            _write_jsonp(page_fpath, PAGE_CALLBACK, [page_i, rows])
+            rewritten_pages += 1
+        pages.append(page)
+
+    page_files = set(p['file'] for p in pages)
+    for fname in os.listdir(data_dirpath):
+        if fname != INDEX_FNAME and fname not in page_files:  # also the .json pages of older versions
+            os.remove(join(data_dirpath, fname))
+            fs_cache.invalidate(join(data_dirpath, fname))
+
+    metrics_with_values = set(m for p in pages for m in p['metrics'])
+    index = dict(project_name=project_name, metric_names=[m for m in metric_names if m in metrics_with_values],
+                 page_size=page_size, total=len(sample_names), pages=pages)
+    if index != old_index:
+        _write_jsonp(index_fpath, INDEX_CALLBACK, [index])
+
+    with file_transaction(None, html_fpath) as tx:
+        with open(tx, 'w') as f:
+            f.write(_html_template
+                    .replace('{{title}}', escape(project_name or ''))
+                    .replace('{{header}}', header_html)
+                    .replace('{{data_dir}}', escape(basename(data_dirpath))))
+    fs_cache.invalidate(html_fpath)
+
+    info('Paginated report: ' + str(len(changed)) + ' of ' + str(len(sample_names)) + ' rows rebuilt, ' +
+         str(rewritten_pages) + ' of ' + str(len(pages)) + ' data pages rewritten')
+    debug('Paginated report saved to ' + html_fpath)
+    return html_fpath
+
+
+_html_template = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{{title}}</title>
+<style>
+  body { font-family: Helvetica, Arial, sans-serif; font-size: 13px; margin: 20px; }
+  table { border-collapse: collapse; }
+  th, td { border-bottom: 1px solid #ddd; padding: 4px 10px; text-align: left; white-space: nowrap; }
+  th { background: #f5f5f5; }
+  #header div { margin: 3px 0; }
+  #controls { margin: 10px 0; }
+  #controls button { margin: 0 4px; }
+</style>
+</head>
+<body>
+<h3>{{title}}</h3>
+<div id="header">{{header}}</div>
+<div id="controls">
+  <input id="search" type="search" placeholder="Search samples" size="30">
+  <button id="prev">&larr;</button><span id="status"></span><button id="next">&rarr;</button>
+</div>
+<table><thead id="head"></thead><tbody id="body"></tbody></table>
+<script type="text/javascript">
+(function() {
+  var dataDir = '{{data_dir}}/';
+  var index = null, matches = [], view = 0, pages = {}, pending = {};
+
+  function esc(s) {
+    return String(s).replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;')
+                    .replace(/"/g, '&quot;').replace(/'/g, '&#39;');
+  }
+  function loadScript(file) {
+    var el = document.createElement('script');
+    el.src = dataDir + file;
+    document.head.appendChild(el);
+  }
+  window.{{page_callback}} = function(i, rows) {
+    pages[i] = rows;
+    (pending[i] || []).forEach(function(cb) { cb(); });
+    delete pending[i];
+  };
+  function withPage(i, cb) {
+    if (pages[i]) return cb();
+    if (!pending[i]) { pending[i] = []; loadScript(index.pages[i].file); }
+    pending[i].push(cb);
+  }
+  function filter(query) {
+    query = query.toLowerCase();
+    matches = [];
+    index.pages.forEach(function(page, pi) {
+      page.samples.forEach(function(name, ri) {
+        if (!query || name.toLowerCase().indexOf(query) !== -1) matches.push([pi, ri]);
+      });
+    });
+    view = 0;
+    render();
+  }
+  function render() {
+    var n = index.page_size, shown = matches.slice(view * n, (view + 1) * n), current = view;
+    var numViews = Math.max(1, Math.ceil(matches.length / n));
+    document.getElementById('status').textContent =
+      ' ' + (view + 1) + ' / ' + numViews + ' (' + matches.length + ' of ' + index.total + ' samples) ';
+    var needed = {};
+    shown.forEach(function(m) { needed[m[0]] = true; });
+    var pageIds = Object.keys(needed), left = pageIds.length;
+    function draw() {
+      if (current !== view) return;
+      document.getElementById('body').innerHTML = shown.map(function(m) {
+        var row = pages[m[0]][m[1]];
+        return '<tr id="' + esc(row[0]) + '"><td>' + esc(row[0]) + '</td>' + index.metric_names.map(function(name) {
+          return '<td>' + (row[1][name] || '') + '</td>';  // cells are escaped html
+        }).join('') + '</tr>';
+      }).join('');
+    }
+    if (!left) return draw();
+    pageIds.forEach(function(pi) { withPage(pi, function() { if (--left === 0) draw(); }); });
+  }
+  function filterByHash() {
+    var query = decodeURIComponent(window.location.hash.slice(1));
+    document.getElementById('search').value = query;
+    filter(query);
+  }
+  document.getElementById('search').oninput = function(e) { filter(e.target.value); };
+  document.getElementById('prev').onclick = function() { if (view > 0) { view--; render(); } };
+  document.getElementById('next').onclick = function() {
+    if ((view + 1) * index.page_size < matches.length) { view++; render(); }
+  };
+  window.onhashchange = filterByHash;  // links to other samples, e.g. the normal match
+  window.{{index_callback}} = function(idx) {
+    index = idx;
+    document.getElementById('head').innerHTML = '<tr><th>Sample</th>' + idx.metric_names.map(function(name) {
+      return '<th>' + esc(name) + '</th>';
+    }).join('') + '</tr>';
+    filterByHash();
+  };
+  loadScript('{{index_fname}}');
+})();
+</script>
+</body>
+</html>
+""".replace('{{page_callback}}', PAGE_CALLBACK).replace('{{index_callback}}', INDEX_CALLBACK) \
+   .replace('{{index_fname}}', INDEX_FNAME)
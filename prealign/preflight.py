@@ -0,0 +1,107 @@
+""" Quick QC on the first reads of every sample, before FastQC and alignment.
+
+Reads the first N reads of the first lane R1/R2 fastqs of every sample, before anything
+else runs, summarizes quality, GC, N and adapter content, and flags samples that fail
+thresholds. Results go to a MultiQC table, so an early report is available minutes
+after the start of a run, before the lanes are merged. The flagged samples can
+then be skipped in the heavy steps, or moved to the end of the queue.
+"""
+from collections import OrderedDict
+
+from ngs_utils.logger import info, warn
+from ngs_utils.file_utils import file_transaction
+
+from prealign.fs_cache import fs_cache
+from prealign.read_stats import ReadStats
+
+
+DEFAULT_MAX_READS = 2000000
+MQC_TABLE_FNAME = 'preflight_mqc.tsv'
+
+# name -> (ReadStats property, 'min' or 'max', default value)
+THRESHOLDS = OrderedDict([
+    ('min_reads',       ('reads',       'min', 1000)),
+    ('min_q30_pct',     ('q30_pct',     'min', 70.0)),
+    ('min_mean_qual',   ('mean_qual',   'min', 25.0)),
+    ('max_n_pct',       ('n_pct',       'max', 5.0)),
+    ('max_adapter_pct', ('adapter_pct', 'max', 20.0)),
+    ('min_gc_pct',      ('gc_pct',      'min', 20.0)),
+    ('max_gc_pct',      ('gc_pct',      'max', 70.0)),
+])
+
+
+def default_thresholds():
+    return OrderedDict((name, default) for name, (_, _, default) in THRESHOLDS.items())
+
+
+def parse_thresholds(text):
+    """ "min_q30_pct=80,max_n_pct=1" -> default thresholds updated with these values """
+    thresholds = default_thresholds()
+    for item in (text or '').split(','):
+        if not item.strip():
+            continue
+        name, _, value = item.partition('=')
+        name = name.strip()
+        if name not in THRESHOLDS or not value:
+            raise ValueError('Unknown preflight threshold "' + item + '", expected NAME=VALUE with NAME one of ' +
+                             ', '.join(THRESHOLDS))
+        thresholds[name] = float(value)
+    return thresholds
+
+
+def check_thresholds(rs, thresholds):
+    """ Returns descriptions of failed thresholds """
+    failures = []
+    for name, (prop, kind, _) in THRESHOLDS.items():
+        limit = thresholds.get(name)
+        value = getattr(rs, prop)
+        if limit is None or value is None:
+            continue
+        if (kind == 'min' and value < limit) or (kind == 'max' and value > limit):
+            failures.append(prop + ' ' + ('%.2f' % value if isinstance(value, float) else str(value)) +
+                            (' < ' if kind == 'min' else ' > ') + str(limit))
+    return failures
+
+
+def preflight_fastq(fastq_fpath, max_reads):
+    """ Runs on an engine. Returns ReadStats.to_dict() of the first max_reads reads """
+    from prealign.read_stats import read_fastq_stats
+    return read_fastq_stats(fastq_fpath, max_reads).to_dict()
+
+
+def run_preflight(fastqs_by_sample, view, max_reads=DEFAULT_MAX_READS, thresholds=None):
+    """ fastqs_by_sample: {sample_name: (R1 fastq, R2 fastq)}.
+        Returns {sample_name: (ReadStats, [failures])}, R1 and R2 combined
+    """
+    thresholds = thresholds or default_thresholds()
+    tasks = [(sname, fpath) for sname, fpaths in fastqs_by_sample.items() for fpath in fpaths if fpath]
+    results = view.run(preflight_fastq, [[fpath, max_reads] for _, fpath in tasks])
+    stats_by_sample = OrderedDict((sname, ReadStats()) for sname in fastqs_by_sample)
+    for (sname, _), res in zip(tasks, results):
+        stats_by_sample[sname].merge(ReadStats.from_dict(res))
+    return OrderedDict((sname, (rs, check_thresholds(rs, thresholds))) for sname, rs in stats_by_sample.items())
+
+
+def write_preflight_report(result_by_sample, output_fpath):
+    columns = [('Reads', 'reads'), ('Mean quality', 'mean_qual'), ('% Q30 bases', 'q30_pct'), ('% GC', 'gc_pct'),
+               ('% N', 'n_pct'), ('% reads with adapter', 'adapter_pct')]
+    with file_transaction(None, output_fpath) as tx:
+        with open(tx, 'w') as f:
+            f.write("# id: 'preflight'\n"
+                    "# section_name: 'Preflight QC'\n"
+                    "# description: 'Summary of the first reads of every sample, checked before the full QC'\n"
+                    "# plot_type: 'table'\n")
+            f.write('Sample\t' + '\t'.join(title for title, _ in columns) + '\tStatus\n')
+            for sname, (rs, failures) in result_by_sample.items():
+                vals = [getattr(rs, prop) for _, prop in columns]
+                f.write(sname + '\t' + '\t'.join(
+                    '' if v is None else ('%.2f' % v if isinstance(v, float) else str(v)) for v in vals) +
+                        '\t' + ('FAIL: ' + '; '.join(failures) if failures else 'PASS') + '\n')
+    fs_cache.invalidate(output_fpath)
+
+    failed = [sname for sname, (_, failures) in result_by_sample.items() if failures]
+    info('Preflight QC: ' + str(len(result_by_sample) - len(failed)) + ' samples passed, ' +
+         str(len(failed)) + ' failed')
+    for sname in failed:
+        warn('  ' + sname + ': ' + '; '.join(result_by_sample[sname][1]))
+    return output_fpath
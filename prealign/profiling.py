@@ -0,0 +1,177 @@
+""" Opt-in sampling profiler for the driver and the remote tasks (--profile).
+
+A background thread samples the Python stacks with sys._current_frames() every few
+milliseconds and counts them as folded stacks ("root;caller;callee count" lines), so
+the overhead does not depend on how many calls the code makes. The driver is sampled
+for the whole run with the current pipeline step as the root frame; views wrapped with
+profiled_view() run every task through profiled_call(), which writes one .folded file
+per task. merge_profiles() combines them into one file for flamegraph.pl or speedscope,
+and a top-N hotspot summary per step:
+
+    <log_dir>/profiles/merged.folded
+    <log_dir>/profiles/hotspots.txt
+"""
+import os
+import shutil
+import sys
+import threading
+import time
+from collections import defaultdict, Counter
+from os.path import join, basename, isdir
+
+from ngs_utils.logger import info
+from ngs_utils.file_utils import safe_mkdir
+
+
+DEFAULT_INTERVAL = 0.005
+TOP_N = 20
+DRIVER_FNAME = 'driver.folded'
+TASKS_DIRNAME = 'tasks'
+MERGED_FNAME = 'merged.folded'
+HOTSPOTS_FNAME = 'hotspots.txt'
+SKIP_THREAD_PREFIX = 'prealign-'  # the profiler itself and the status writer
+
+
+def _frame_name(code):
+    return code.co_name + ' (' + basename(code.co_filename) + ':' + str(code.co_firstlineno) + ')'
+
+
+class SamplingProfiler:
+    """ Counts folded stacks of the given threads (all but prealign's own helper threads if None) until stop() """
+    def __init__(self, interval=DEFAULT_INTERVAL, thread_ids=None, label_fn=None):
+        self.interval = interval
+        self.thread_ids = thread_ids
+        self.label_fn = label_fn
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample_loop, name='prealign-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        return self
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            label = self.label_fn() if self.label_fn else None
+            skip_ids = set(t.ident for t in threading.enumerate() if t.name.startswith(SKIP_THREAD_PREFIX))
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in skip_ids or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                    continue
+                names = []
+                while frame is not None:
+                    names.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                if label:
+                    names.append(label)
+                self.counts[';'.join(reversed(names))] += 1
+
+    def write(self, fpath):
+        tmp_fpath = fpath + '.tmp'
+        with open(tmp_fpath, 'w') as f:
+            for stack, n in self.counts.most_common():
+                f.write(stack + ' ' + str(n) + '\n')
+        os.rename(tmp_fpath, fpath)
+        return fpath
+
+
+def profiled_call(fn, profile_fpath, *args):
+    """ Runs on an engine: fn(*args) with its thread sampled into profile_fpath """
+    import threading
+    from prealign.profiling import SamplingProfiler
+    profiler = SamplingProfiler(thread_ids={threading.current_thread().ident}).start()
+    try:
+        return fn(*args)
+    finally:
+        profiler.stop().write(profile_fpath)
+
+
+class _ProfiledView:
+    """ Forwards everything to the parallel view, running tasks through profiled_call """
+    def __init__(self, view, step, profiles_dirpath):
+        self._view = view
+        self._step = step
+        self._profiles_dirpath = profiles_dirpath
+
+    def run(self, fn, param_lists):
+        param_lists = [list(p) for p in param_lists]
+        dirpath = safe_mkdir(join(self._profiles_dirpath, TASKS_DIRNAME, self._step))
+        first = len(os.listdir(dirpath))  # the same step may run for several projects
+        return self._view.run(profiled_call, [
+            [fn, join(dirpath, '%05d.folded' % (first + i))] + p for i, p in enumerate(param_lists)])
+
+    def __getattr__(self, name):
+        return getattr(self._view, name)
+
+
+def profiled_view(view, step, profiles_dirpath):
+    return _ProfiledView(view, step, profiles_dirpath)
+
+
+def start_driver_profiler(profiles_dirpath, label_fn=None, interval=DEFAULT_INTERVAL):
+    """ Starts sampling the driver; the task profiles of a previous run in profiles_dirpath are removed,
+        so merge_profiles() combines only this run's tasks
+    """
+    shutil.rmtree(join(profiles_dirpath, TASKS_DIRNAME), ignore_errors=True)
+    return SamplingProfiler(interval=interval, label_fn=label_fn).start()
+
+
+def _read_folded(fpath):
+    with open(fpath) as f:
+        for line in f:
+            stack, _, n = line.rstrip('\n').rpartition(' ')
+            if stack and n.isdigit():
+                yield stack, int(n)
+
+
+def merge_profiles(profiles_dirpath, top_n=TOP_N):
+    """ Combines the driver and task profiles into merged.folded, with the step as the root frame,
+        and writes the top_n self and inclusive hotspots of every step to hotspots.txt
+    """
+    merged = Counter()
+    driver_fpath = join(profiles_dirpath, DRIVER_FNAME)
+    if os.path.isfile(driver_fpath):
+        for stack, n in _read_folded(driver_fpath):
+            merged[stack if stack.startswith('driver') else 'driver;' + stack] += n
+    tasks_dirpath = join(profiles_dirpath, TASKS_DIRNAME)
+    for step in sorted(os.listdir(tasks_dirpath)) if isdir(tasks_dirpath) else []:
+        for fname in sorted(os.listdir(join(tasks_dirpath, step))):
+            if fname.endswith('.folded'):
+                for stack, n in _read_folded(join(tasks_dirpath, step, fname)):
+                    merged['tasks:' + step + ';' + stack] += n
+
+    merged_fpath = join(profiles_dirpath, MERGED_FNAME)
+    with open(merged_fpath, 'w') as f:
+        for stack, n in merged.most_common():
+            f.write(stack + ' ' + str(n) + '\n')
+
+    self_by_step = defaultdict(Counter)
+    incl_by_step = defaultdict(Counter)
+    total_by_step = Counter()
+    for stack, n in merged.items():
+        frames = stack.split(';')
+        step, frames = frames[0], frames[1:]
+        total_by_step[step] += n
+        if frames:
+            self_by_step[step][frames[-1]] += n
+            for name in set(frames):
+                incl_by_step[step][name] += n
+
+    hotspots_fpath = join(profiles_dirpath, HOTSPOTS_FNAME)
+    with open(hotspots_fpath, 'w') as f:
+        for step, total in sorted(total_by_step.items()):
+            f.write(step + ': ' + str(total) + ' samples\n')
+            for title, counts in [('self', self_by_step[step]), ('inclusive', incl_by_step[step])]:
+                f.write('  top ' + str(top_n) + ' by ' + title + ' time:\n')
+                for name, n in counts.most_common(top_n):
+                    f.write('    %6.2f%%  %s\n' % (100.0 * n / total, name))
+            f.write('\n')
+    info('Profiles: ' + merged_fpath + ', hotspots per step: ' + hotspots_fpath)
+    return merged_fpath, hotspots_fpath
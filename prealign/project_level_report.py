@@ -1,4 +1,3 @@
-import json
 import os
 import time
 from inspect import getsourcefile
@@ -10,10 +9,19 @@ from collections import defaultdict
 from ngs_utils.call_process import run
 from ngs_utils.logger import info, step_greetings, warn
 from ngs_utils.file_utils import verify_file, add_suffix, verify_dir, file_transaction
-from ngs_utils.reporting.reporting import Metric, Record, MetricStorage, ReportSection, SampleReport, FullReport, write_static_html_report
+from ngs_utils.reporting.reporting import Metric, Record, MetricStorage, ReportSection
+
+from prealign.fs_cache import fs_cache
+from prealign.targqc_json import load_values_by_sample
+from prealign.paged_report import write_paged_report, fingerprint, file_fingerprint
 
 from pip._vendor.requests.packages.urllib3.packages import six
 
+try:
+    from html import escape
+except ImportError:  # Python 2
+    from cgi import escape
+
 BASECALLS_NAME        = 'BaseCalls'
 FASTQC_NAME           = 'FastQC'
 PRE_FASTQC_NAME       = 'Raw ' + FASTQC_NAME
@@ -86,22 +94,12 @@ def make_project_level_report(cnf, dataset_structure=None, bcbio_structure=None,
     #     dataset_structure = DatasetStructure.create(dataset_dirpath, bcbio_structure.project_name)
 
     general_records = _add_summary_reports(cnf, metric_storage.general_section, bcbio_structure, dataset_structure, dataset_project)
-    sample_reports_records = _add_per_sample_reports(cnf, metric_storage.sections[0], bcbio_structure, dataset_structure, dataset_project)
 
-    sample_reports = []
     samples = []
     if dataset_project:
-        samples = dataset_project.sample_by_name.values()
+        samples = list(dataset_project.sample_by_name.values())
     if bcbio_structure:
         samples = bcbio_structure.samples
-    for sample in samples:
-        sample_reports.append(SampleReport(sample,
-            records=sample_reports_records[sample.name],
-            html_fpath=None,
-            metric_storage=metric_storage))
-
-    full_report = FullReport(cnf.project_name, sample_reports,
-                             metric_storage=metric_storage, general_records=general_records)
 
     project_report_html_fpath = None
     project_name = None
@@ -112,22 +110,24 @@ def make_project_level_report(cnf, dataset_structure=None, bcbio_structure=None,
         project_report_html_fpath = bcbio_structure.project_report_html_fpath
         project_name = bcbio_structure.project_name
 
-    sample_match_on_hover_js = None
-    if bcbio_structure:
-        normal_samples = [s for s in bcbio_structure.samples if s.phenotype == 'normal']
-        if normal_samples:
-            sample_match_on_hover_js = '<script type="text/javascript">\n'
-            for s in bcbio_structure.samples:
-                if s.phenotype != 'normal' and s.normal_match:
-                    sample_match_on_hover_js += ('' +
-                        '\tdocument.getElementById("' + s.name + '_match").onmouseover = function() { document.getElementById("' + s.normal_match.name + '").style.backgroundColor = "#EEE"; };\n' +
-                        '\tdocument.getElementById("' + s.name + '_match").onmouseleave = function() { document.getElementById("' + s.normal_match.name + '").style.backgroundColor = "white"; };\n'
-                     )
-            sample_match_on_hover_js += '</script>\n'
+    def make_rows(sample_names):
+        """ Records only of the samples whose inputs changed since the last report """
+        sample_names = set(sample_names)
+        records_by_sample = _add_per_sample_reports(cnf, metric_storage.sections[0], bcbio_structure,
+            dataset_structure, dataset_project, sample_names=sample_names)
+        return dict((s.name, OrderedDict((r.metric.name, _record_html(r, short=True)) for r in records_by_sample[s.name]))
+                    for s in samples if s.name in sample_names)
+
+    base_dirpath = get_base_dirpath(bcbio_structure, dataset_project)
+    has_normals = any(s.phenotype == 'normal' for s in samples) if bcbio_structure else False  # adds the Phenotype column
+    input_fp_by_sample = OrderedDict(
+        (s.name, fingerprint([base_dirpath, has_normals] + _sample_inputs(s, bcbio_structure))) for s in samples)
+
+    _save_paged_html(cnf, general_records, input_fp_by_sample, make_rows, project_report_html_fpath,
+                     project_name, bcbio_structure, oncoprints_link=oncoprints_link, dataset_project=dataset_project)
 
-    _save_static_html(cnf, full_report, project_report_html_fpath, project_name, bcbio_structure,
-                      additional_data=dict(sample_match_on_hover_js=sample_match_on_hover_js),
-                      oncoprints_link=oncoprints_link, dataset_project=dataset_project)
+    fs_cache.invalidate(project_report_html_fpath)
+    fs_cache.report()
 
     info()
     info('*' * 70)
@@ -147,15 +147,15 @@ def _mutations_records(general_section, bcbio_structure):
         _base_mut_fname = source.mut_fname_template.format(caller_name=caller.name)
         _base_mut_fpath = join(bcbio_structure.date_dirpath, _base_mut_fname)
         mut_fpath = add_suffix(_base_mut_fpath, source.mut_pass_suffix)
-        if verify_file(mut_fpath, silent=True):
+        if fs_cache.verify_file(mut_fpath, silent=True):
             val[caller.name] = mut_fpath
         else:
             single_mut_fpath = add_suffix(add_suffix(_base_mut_fpath, source.mut_single_suffix), source.mut_pass_suffix)
             paired_mut_fpath = add_suffix(add_suffix(_base_mut_fpath, source.mut_paired_suffix), source.mut_pass_suffix)
-            if verify_file(single_mut_fpath, silent=True):
+            if fs_cache.verify_file(single_mut_fpath, silent=True):
                 single_val[caller.name] = single_mut_fpath
                 # _add_rec(single_mut_fpath, caller.name + ' mutations for separate samples')
-            if verify_file(paired_mut_fpath, silent=True):
+            if fs_cache.verify_file(paired_mut_fpath, silent=True):
                 paired_val[caller.name] = paired_mut_fpath
                 # _add_rec(paired_mut_fpath, caller.name + ' mutations for paired samples')
 
@@ -178,10 +178,10 @@ def _mutations_records(general_section, bcbio_structure):
 def _make_url_record(html_fpath_value, metric, base_dirpath):
     # info('Adding paths to the report: ' + str(html_fpath_value))
     if isinstance(html_fpath_value, dict):
-        url = OrderedDict([(k, relpath(html_fpath, base_dirpath)) for k, html_fpath in html_fpath_value.items() if verify_file(html_fpath)])
+        url = OrderedDict([(k, relpath(html_fpath, base_dirpath)) for k, html_fpath in html_fpath_value.items() if fs_cache.verify_file(html_fpath)])
         return Record(metric=metric, value=metric.name, url=url)
     else:
-        url = relpath(html_fpath_value, base_dirpath) if verify_file(html_fpath_value) else None
+        url = relpath(html_fpath_value, base_dirpath) if fs_cache.verify_file(html_fpath_value) else None
         return Record(metric=metric, value=metric.name, url=url)
 
 
@@ -207,7 +207,7 @@ def _add_summary_reports(cnf, general_section, bcbio_structure=None, dataset_str
         recs.append(_make_url_record(dataset_project.downsample_targqc_report_fpath, general_section.find_metric(PRE_SEQQC_NAME),  base_dirpath))
 
     if bcbio_structure:
-        if isfile(bcbio_structure.fastqc_summary_fpath):
+        if fs_cache.isfile(bcbio_structure.fastqc_summary_fpath):
             recs.append(_make_url_record(bcbio_structure.fastqc_summary_fpath, general_section.find_metric(FASTQC_NAME), base_dirpath))
         if not bcbio_structure.is_rnaseq:
             recs = add_dna_summary_records(cnf, recs, general_section, bcbio_structure, base_dirpath)
@@ -230,7 +230,7 @@ def add_rna_summary_records(cnf, recs, general_section, bcbio_structure, base_di
     recs.append(_make_url_record(bcbio_structure.isoform_tpm_report_fpath, general_section.find_metric(ISOFORM_TPM_NAME), base_dirpath))
 
     rnaseq_html_fpath = join(bcbio_structure.date_dirpath, BCBioStructure.rnaseq_qc_report_name + '.html')
-    rnaseq_html_fpath = verify_file(rnaseq_html_fpath, is_critical=True)
+    rnaseq_html_fpath = fs_cache.verify_file(rnaseq_html_fpath, is_critical=True)
     recs.append(_make_url_record(rnaseq_html_fpath, general_section.find_metric(QC_REPORT_NAME), base_dirpath))
 
     return recs
@@ -279,7 +279,8 @@ def create_rnaseq_qc_report(cnf, bcbio_structure):
     render_rmd_r = get_script_cmdline(cnf, 'rscript', join('tools', 'render_rmd.R'), is_critical=True)
     render_rmd_cmdline = render_rmd_r + ' ' + report_rmd_fpath
     call(cnf, render_rmd_cmdline, output_fpath=report_html_fpath, stdout_to_outputfile=False)
-    if verify_file(report_html_fpath):
+    fs_cache.invalidate(report_html_fpath)
+    if fs_cache.verify_file(report_html_fpath):
         info('Saved RNAseq QC report to ' + report_html_fpath)
         return report_html_fpath
     else:
@@ -287,13 +288,17 @@ def create_rnaseq_qc_report(cnf, bcbio_structure):
         return None
 
 
-def _add_per_sample_reports(cnf, individual_reports_section, bcbio_structure=None, dataset_structure=None, dataset_project=None):
+def _add_per_sample_reports(cnf, individual_reports_section, bcbio_structure=None, dataset_structure=None, dataset_project=None,
+                            sample_names=None):
+    """ sample_names: records only for these samples, all if None """
     base_dirpath = get_base_dirpath(bcbio_structure, dataset_project)
 
     sample_reports_records = defaultdict(list)
 
     if dataset_project:
         for s in dataset_project.sample_by_name.values():
+            if sample_names is not None and s.name not in sample_names:
+                continue
             sample_reports_records[s.name].append(_make_url_record(
                     OrderedDict([('left', s.find_fastqc_html(s.l_fastqc_base_name)), ('right', s.find_fastqc_html(s.r_fastqc_base_name))]),
                     individual_reports_section.find_metric(PRE_FASTQC_NAME), base_dirpath))
@@ -304,20 +309,23 @@ def _add_per_sample_reports(cnf, individual_reports_section, bcbio_structure=Non
     if bcbio_structure:
         gender_record_by_sample = dict()
 
-        for s in bcbio_structure.samples:
-            if verify_file(s.targetcov_json_fpath):
-                targqc_json = json.loads(open(s.targetcov_json_fpath).read(), object_pairs_hook=OrderedDict)
-                sample_report = SampleReport.load(targqc_json, s, bcbio_structure)
-                gender_rec = sample_report.find_record(sample_report.records, GENDER)
-                if gender_rec and gender_rec.value:
-                    gender_record_by_sample[s.name] = gender_rec
+        work_dir = getattr(cnf, 'work_dir', None)
+        samples = [s for s in bcbio_structure.samples if sample_names is None or s.name in sample_names]
+        targqc_values_by_sample = load_values_by_sample(
+            OrderedDict((s.name, s.targetcov_json_fpath) for s in samples), [GENDER],
+            cache_fpath=join(work_dir, 'targqc_values_cache.json') if work_dir else None,
+            threads=getattr(cnf, 'threads', None) or 8)
+        for s in samples:
+            gender = targqc_values_by_sample.get(s.name, dict()).get(GENDER)
+            if gender:
+                gender_record_by_sample[s.name] = Record(individual_reports_section.find_metric(GENDER), gender)
 
         # if not gender_record_by_sample:
         #     individual_reports_section.
 
         normal_samples = [s for s in bcbio_structure.samples if s.phenotype == 'normal']
-        for s in bcbio_structure.samples:
-            if s.fastqc_html_fpath and isfile(s.fastqc_html_fpath):
+        for s in samples:
+            if s.fastqc_html_fpath and fs_cache.isfile(s.fastqc_html_fpath):
                 sample_reports_records[s.name].append(_make_url_record(s.fastqc_html_fpath, individual_reports_section.find_metric(FASTQC_NAME), base_dirpath))
 
             if gender_record_by_sample.get(s.name):
@@ -394,7 +402,7 @@ def _add_per_sample_reports(cnf, individual_reports_section, bcbio_structure=Non
 def add_rna_sample_records(s, individual_reports_section, bcbio_structure, base_dirpath):
     recs = []
     recs.append(_make_url_record(s.gene_counts, individual_reports_section.find_metric(GENE_COUNTS_NAME), base_dirpath))
-    if verify_file(s.qualimap_html_fpath):
+    if fs_cache.verify_file(s.qualimap_html_fpath):
         recs.append(_make_url_record(s.qualimap_html_fpath, individual_reports_section.find_metric(QUALIMAP_NAME), base_dirpath))
     return recs
 
@@ -412,9 +420,9 @@ def add_dna_sample_records(s, individual_reports_section, bcbio_structure, base_
             _make_url_record(varqc_after_d,       individual_reports_section.find_metric(VARQC_AFTER_NAME), base_dirpath),
         ])
 
-    if not verify_file(s.clinical_html, is_critical=False):
+    if not fs_cache.verify_file(s.clinical_html, is_critical=False):
         clinical_html = join(dirname(dirname(s.clinical_html)), 'clinicalReport', basename(s.clinical_html))
-        if verify_file(clinical_html):
+        if fs_cache.verify_file(clinical_html):
             s.clinical_html = clinical_html
     rec = _make_url_record(s.clinical_html, individual_reports_section.find_metric(CLINICAL_NAME), base_dirpath)
     if rec and rec.value:
@@ -470,92 +478,64 @@ def _relpath_all(value, base_dirpath):
         return value
 
 
-def _save_static_html(cnf, full_report, html_fpath, project_name, bcbio_structure,
-                      additional_data=None, oncoprints_link=None, dataset_project=None):
-    # metric name in FullReport --> metric name in Static HTML
-    # metric_names = OrderedDict([
-    #     (DatasetStructure.pre_fastqc_repr, DatasetStructure.pre_fastqc_repr),
-    #     (BCBioStructure.fastqc_repr, 'FastQC'),
-    #     # ('BAM', 'BAM'),
-    #     (BCBioStructure.targqc_repr, 'SeqQC'),
-    #     # ('Downsampled ' + BCBioStructure.targqc_repr, 'Downsampled SeqQC'),
-    #     # ('Mutations', 'Mutations'),
-    #     # ('Mutations for separate samples', 'Mutations for separate samples'),
-    #     # ('Mutations for paired samples', 'Mutations for paired samples'),
-    #     (BCBioStructure.varqc_repr, 'VarQC'),
-    #     (BCBioStructure.varqc_after_repr, 'VarQC after filtering')])
-
-    def __process_record(rec, short=False):
-        d = rec.__dict__.copy()
-
-        if isinstance(rec.url, six.string_types):
-            d['contents'] = '<a href="' + rec.url + '">' + rec.value + '</a>'
-
-        elif isinstance(rec.url, dict):
-            d['contents'] = ', '.join('<a href="{v}">{k}</a>'.format(k=k, v=v) for k, v in rec.url.items()) if rec.url else '-'
-            if not short:
-                d['contents'] = rec.metric.name + ': ' + d['contents']
+def _record_html(rec, short=False):
+    """ Escaped html of a record: links for records with urls, the formatted value otherwise """
+    if isinstance(rec.url, six.string_types):
+        contents = '<a href="' + escape(rec.url, quote=True) + '">' + escape(str(rec.value)) + '</a>'
 
-        else:
-            d['contents'] = rec.metric.format_value(rec.value)
+    elif isinstance(rec.url, dict):
+        contents = ', '.join('<a href="{v}">{k}</a>'.format(k=escape(k), v=escape(v, quote=True))
+                             for k, v in rec.url.items() if v) if rec.url else '-'
+        if not short:
+            contents = escape(rec.metric.name) + ': ' + contents
 
-        d['metric'] = rec.metric.__dict__
-        return d
+    else:
+        contents = escape(str(rec.metric.format_value(rec.value)))
+    return contents
+
+
+def _sample_inputs(s, bcbio_structure=None):
+    """ Fingerprints of everything a sample row is built from, cheap to get compared to the row itself """
+    if not bcbio_structure:
+        fpaths = []
+        for base_name in [s.l_fastqc_base_name, s.r_fastqc_base_name]:
+            fpaths.extend([join(s.fastqc_dirpath, base_name + '_fastqc.html'),
+                           join(s.fastqc_dirpath, base_name + '_fastqc', 'fastqc_report.html'),
+                           join(s.fastqc_dirpath, base_name + '_fastqc.zip')])
+        fpaths.extend([getattr(s, 'targetcov_html_fpath', None), getattr(s, 'qualimap_html_fpath', None)])
+        return [file_fingerprint(f) for f in fpaths]
+
+    fpaths = [s.fastqc_html_fpath, s.targetcov_json_fpath, s.targetcov_html_fpath, s.qualimap_html_fpath]
+    if bcbio_structure.is_rnaseq:
+        fpaths.append(s.gene_counts)
+    else:
+        fpaths.extend([s.clinical_html, join(dirname(dirname(s.clinical_html)), 'clinicalReport', basename(s.clinical_html))])
+        for k in bcbio_structure.variant_callers.keys():
+            fpaths.extend([s.get_varqc_fpath_by_callername(k), s.get_varqc_after_fpath_by_callername(k)])
+    return [file_fingerprint(f) for f in fpaths] + [s.phenotype, s.normal_match.name if s.normal_match else None]
 
-    def _get_summary_report_name(rec):
-        return rec.value.lower().replace(' ', '_')
 
-    # common records (summary reports)
-    common_dict = dict()
-    common_dict["project_name"] = project_name
-    common_records = full_report.get_common_records()
-    for rec in common_records:
+def _save_paged_html(cnf, general_records, input_fp_by_sample, make_rows, html_fpath, project_name, bcbio_structure,
+                     oncoprints_link=None, dataset_project=None):
+    """ The summary reports and run info go into the page header, sample rows into the paged data """
+    header = []
+    for rec in general_records:
         if rec.value:
-            common_dict[_get_summary_report_name(rec)] = __process_record(rec)  # rec_d
-    common_dict['run_section'] = get_run_info(cnf, bcbio_structure, dataset_project)
-
+            header.append(_record_html(rec))
+    run_info = get_run_info(cnf, bcbio_structure, dataset_project)
+    if run_info.get('run_date'):
+        header.append('Report generated on ' + escape(run_info['run_date']))
+    if run_info.get('suite_version'):
+        header.append(escape(run_info['suite_version']))
+    if run_info.get('program_versions'):
+        header.append(run_info['program_versions'])
     if oncoprints_link:
-        common_dict['oncoprints'] = {'oncoprints_link': '<a href="{oncoprints_link}" target="_blank">Oncoprints</a> ' \
-                                                       '(loading may take 5-10 seconds)'.format(**locals())}
-
-    main_dict = dict()
-    if full_report.sample_reports:
-        # individual records
-        main_dict = dict()
-        main_dict["sample_reports"] = []
-
-        metrics = metric_storage.get_metrics(skip_general_section=True)
-        metrics_with_values_set = set()
-        for sample_report in full_report.sample_reports:
-            for m in metric_storage.get_metrics(skip_general_section=True):
-                r = next((r for r in sample_report.records if r.metric.name == m.name), None)
-                if r:
-                    metrics_with_values_set.add(m)
-
-        metrics = [m for m in metrics if m in metrics_with_values_set]
-        main_dict['metric_names'] = [m.name for m in metrics]
-
-        for sample_report in full_report.sample_reports:
-            ready_records = []
-            for m in metrics:
-                r = next((r for r in sample_report.records if r.metric.name == m.name), None)
-                if r:
-                    ready_records.append(__process_record(r, short=True))
-                else:
-                    ready_records.append(__process_record(Record(metric=m, value=None), short=True))
-            assert len(ready_records) == len(main_dict["metric_names"])
-
-            sample_report_dict = dict()
-            sample_report_dict["records"] = ready_records
-            sample_report_dict["sample_name"] = sample_report.display_name
-            main_dict["sample_reports"].append(sample_report_dict)
-
-    data = {"common": common_dict, "main": main_dict}
-    if additional_data:
-        for k, v in additional_data.items():
-            data[k] = v
-
-    return write_static_html_report(cnf, data, html_fpath)
+        header.append('<a href="{oncoprints_link}" target="_blank">Oncoprints</a> '
+                      '(loading may take 5-10 seconds)'.format(oncoprints_link=escape(oncoprints_link, quote=True)))
+
+    metric_names = [m.name for m in metric_storage.get_metrics(skip_general_section=True)]
+    return write_paged_report(html_fpath, project_name, metric_names, input_fp_by_sample, make_rows,
+                              header_html=''.join('<div>' + h + '</div>' for h in header))
 
 
 def get_version():
@@ -626,5 +606,5 @@ def get_run_info(cnf, bcbio_structure, dataset_project):
 
 
 def _make_relative_link_record(name, match_name, metric):
-    value = '<a class="dotted-link" href="#{match_name}" id="{name}_match">{match_name}</a>'.format(name=name, match_name=match_name)
-    return Record(metric=metric, value=value)
+    """ The paged report filters by the sample in the url hash """
+    return Record(metric=metric, value=match_name, url='#' + match_name)
@@ -0,0 +1,83 @@
+""" Mergeable read-level summary statistics: quality, GC, N and adapter content. """
+import numpy as np
+
+
+ADAPTER = b'AGATCGGAAGAGC'  # common prefix of the Illumina TruSeq adapters
+PHRED_OFFSET = 33
+
+
+def _pct(a, b):
+    return 100.0 * a / b if b else None
+
+
+class ReadStats:
+    """ Sums over reads, so stats of lanes or chunks merge exactly into the sample stats """
+    FIELDS = ('reads', 'bases', 'qual_sum', 'q30_bases', 'gc_bases', 'n_bases', 'adapter_reads')
+
+    def __init__(self):
+        for name in ReadStats.FIELDS:
+            setattr(self, name, 0)
+
+    def update(self, seqs, quals):
+        """ seqs and quals are lists of byte strings of one batch of reads """
+        if not seqs:
+            return
+        seq = np.frombuffer(b''.join(seqs), dtype=np.uint8)
+        qual = np.frombuffer(b''.join(quals), dtype=np.uint8)
+        self.reads += len(seqs)
+        self.bases += len(seq)
+        self.qual_sum += int(qual.sum(dtype=np.int64)) - PHRED_OFFSET * len(qual)
+        self.q30_bases += int(np.count_nonzero(qual >= PHRED_OFFSET + 30))
+        self.gc_bases += int(np.count_nonzero((seq == ord('G')) | (seq == ord('C'))))
+        self.n_bases += int(np.count_nonzero(seq == ord('N')))
+        self.adapter_reads += sum(1 for s in seqs if ADAPTER in s)
+
+    def merge(self, other):
+        for name in ReadStats.FIELDS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    @property
+    def mean_qual(self):
+        return float(self.qual_sum) / self.bases if self.bases else None
+
+    @property
+    def q30_pct(self):
+        return _pct(self.q30_bases, self.bases)
+
+    @property
+    def gc_pct(self):
+        return _pct(self.gc_bases, self.bases - self.n_bases)
+
+    @property
+    def n_pct(self):
+        return _pct(self.n_bases, self.bases)
+
+    @property
+    def adapter_pct(self):
+        return _pct(self.adapter_reads, self.reads)
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in ReadStats.FIELDS)
+
+    @staticmethod
+    def from_dict(d):
+        rs = ReadStats()
+        for name in ReadStats.FIELDS:
+            setattr(rs, name, d.get(name, 0))
+        return rs
+
+
+def read_fastq_stats(fastq_fpath, max_reads=None, batch_reads=100000):
+    """ ReadStats of the first max_reads reads (all reads if None) of a fastq """
+    from itertools import islice
+    from prealign.gzip_io import open_fastq
+
+    rs = ReadStats()
+    with open_fastq(fastq_fpath) as f:
+        lines = islice(f, 0, max_reads * 4 if max_reads else None)
+        while True:
+            batch = list(islice(lines, batch_reads * 4))
+            if not batch:
+                break
+            rs.update([l.rstrip() for l in batch[1::4]], [l.rstrip() for l in batch[3::4]])
+    return rs
@@ -0,0 +1,286 @@
+""" Live status of a running pipeline: <work_dir>/status.json, and optionally a local HTTP endpoint.
+
+The driver records the current step, per-sample progress in bytes (lane merge) and the
+tasks submitted to parallel views. Views wrapped with tracked_view() run every task
+through run_tracked_task(), which drops small .running/.done marker files with the host
+name into a directory under work_dir; the status writer scans them to count queued,
+running and finished tasks per host, so stalls and slow nodes show up without the log.
+ETAs are extrapolated from the bytes of the input files processed so far.
+
+    watch -n5 cat <work_dir>/status.json
+    curl http://localhost:<port>/        # with --status-port
+"""
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+from collections import OrderedDict
+from os.path import join, isfile, getsize
+
+from ngs_utils.logger import info, debug
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:  # Python 2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+
+STATUS_FNAME = 'status.json'
+TASKS_DIRNAME = 'status_tasks'
+WRITE_INTERVAL = 5
+
+
+def run_tracked_task(fn, marker_fpath, *args):
+    """ Runs on an engine: fn(*args) between a .running and a .done marker with the host and times """
+    import json
+    import socket
+    import time
+    t0 = time.time()
+    with open(marker_fpath + '.running', 'w') as f:
+        json.dump(dict(host=socket.gethostname(), started=t0), f)
+    res = fn(*args)
+    with open(marker_fpath + '.done', 'w') as f:
+        json.dump(dict(host=socket.gethostname(), started=t0, finished=time.time()), f)
+    return res
+
+
+def _input_bytes(params):
+    return sum(getsize(p) for p in params if isinstance(p, str) and isfile(p))
+
+
+def _eta(done, total, started):
+    elapsed = time.time() - started
+    if not done or not total or done >= total or elapsed <= 0:
+        return None
+    return round((total - done) * elapsed / done, 1)
+
+
+class _TrackedRun:
+    def __init__(self, step, project, tasks_dirpath, labels, task_bytes):
+        self.step = step
+        self.project = project
+        self.tasks_dirpath = tasks_dirpath
+        self.labels = labels
+        self.task_bytes = task_bytes
+        self.started = time.time()
+        self.finished = None
+
+    def to_dict(self):
+        markers = dict()
+        for fname in os.listdir(self.tasks_dirpath) if os.path.isdir(self.tasks_dirpath) else []:
+            i, _, kind = fname.partition('.')
+            try:
+                with open(join(self.tasks_dirpath, fname)) as f:
+                    rec = json.load(f)
+            except (IOError, ValueError):  # being written
+                continue
+            if kind == 'done' or i not in markers:
+                markers[i] = rec
+        now = time.time()
+        hosts = OrderedDict()
+        running = []
+        bytes_done = 0
+        for i, label in enumerate(self.labels):
+            rec = markers.get(str(i))
+            if rec is None:
+                continue
+            h = hosts.setdefault(rec['host'], dict(running=0, done=0, seconds=0.0, bytes=0))
+            if 'finished' in rec:
+                h['done'] += 1
+                h['seconds'] += rec['finished'] - rec['started']
+                h['bytes'] += self.task_bytes[i]
+                bytes_done += self.task_bytes[i]
+            else:
+                h['running'] += 1
+                running.append(OrderedDict([('task', label), ('host', rec['host']),
+                                            ('seconds', round(now - rec['started'], 1))]))
+        for h in hosts.values():
+            h['mb_per_sec'] = round(h['bytes'] / 1e6 / h['seconds'], 2) if h['seconds'] else None
+            h['seconds'] = round(h['seconds'], 1)
+        n_done = sum(h['done'] for h in hosts.values())
+        n_running = len(running)
+        bytes_total = sum(self.task_bytes)
+        return OrderedDict([
+            ('step', self.step),
+            ('project', self.project),
+            ('tasks', len(self.labels)),
+            ('queued', len(self.labels) - n_done - n_running),
+            ('running', n_running),
+            ('done', n_done),
+            ('bytes_total', bytes_total),
+            ('bytes_done', bytes_done),
+            ('eta_sec', _eta(bytes_done, bytes_total, self.started) if bytes_total else
+                        _eta(n_done, len(self.labels), self.started)),
+            ('started', self.started),
+            ('finished', self.finished),
+            ('running_tasks', running),
+            ('hosts', hosts),
+        ])
+
+
+class _TrackedView:
+    """ Forwards everything to the parallel view, running tasks through run_tracked_task """
+    def __init__(self, tracker, view, step, project):
+        self._tracker = tracker
+        self._view = view
+        self._step = step
+        self._project = project
+
+    def run(self, fn, param_lists):
+        return self._tracker.run(self._view, fn, param_lists, self._step, self._project)
+
+    def __getattr__(self, name):
+        return getattr(self._view, name)
+
+
+class StatusTracker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.work_dir = None
+        self.status_fpath = None
+        self._started = None
+        self._steps = []
+        self._samples = OrderedDict()
+        self._runs = []
+        self._stop = None
+        self._server = None
+
+    @property
+    def enabled(self):
+        return self.status_fpath is not None
+
+    def start(self, work_dir, port=None):
+        self.work_dir = work_dir
+        self.status_fpath = join(work_dir, STATUS_FNAME)
+        self._started = time.time()
+        shutil.rmtree(join(work_dir, TASKS_DIRNAME), ignore_errors=True)  # markers of a previous run in this work_dir
+        self._stop = threading.Event()
+        writer = threading.Thread(target=self._write_loop, name='prealign-status')
+        writer.daemon = True
+        writer.start()
+        info('Pipeline status is written to ' + self.status_fpath)
+        if port:
+            self._serve(port)
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.step(None)
+        self._stop.set()
+        self.write()
+        if self._server:
+            self._server.shutdown()
+
+    def step(self, name):
+        """ Marks the start of a pipeline step (and the end of the previous one) """
+        with self._lock:
+            now = time.time()
+            if self._steps and self._steps[-1]['finished'] is None:
+                self._steps[-1]['finished'] = now
+            if name:
+                self._steps.append(OrderedDict([('name', name), ('started', now), ('finished', None)]))
+
+    def sample_step(self, project, sample, step, bytes_total=None):
+        with self._lock:
+            self._samples[(project, sample)] = OrderedDict([
+                ('step', step), ('started', time.time()), ('bytes_total', bytes_total), ('bytes_done', 0)])
+
+    def add_bytes(self, project, sample, n):
+        with self._lock:
+            rec = self._samples.get((project, sample))
+            if rec:
+                rec['bytes_done'] += n
+
+    @property
+    def current_step(self):
+        with self._lock:
+            return self._steps[-1]['name'] if self._steps and self._steps[-1]['finished'] is None else None
+
+    def finish_sample_step(self, project, sample):
+        """ Marks the step done, also when it had nothing to copy (symlinked, reused or virtual merge) """
+        with self._lock:
+            rec = self._samples.get((project, sample))
+            if rec:
+                rec['bytes_done'] = rec['bytes_total'] or rec['bytes_done']
+                rec['finished'] = time.time()
+
+    def tracked_view(self, view, step, project=None):
+        if not self.enabled:
+            return view
+        return _TrackedView(self, view, step, project)
+
+    def run(self, view, fn, param_lists, step, project=None):
+        param_lists = [list(p) for p in param_lists]
+        with self._lock:
+            tasks_dirpath = join(self.work_dir, TASKS_DIRNAME, '%03d_%s' % (len(self._runs), step))
+            os.makedirs(tasks_dirpath)
+            tr = _TrackedRun(step, project, tasks_dirpath,
+                             [str(p[0]) if p else str(i) for i, p in enumerate(param_lists)],
+                             [_input_bytes(p) for p in param_lists])
+            self._runs.append(tr)
+        try:
+            return view.run(run_tracked_task, [[fn, join(tasks_dirpath, str(i))] + p for i, p in enumerate(param_lists)])
+        finally:
+            tr.finished = time.time()
+
+    def to_dict(self):
+        with self._lock:
+            projects = OrderedDict()
+            for (project, sample), rec in self._samples.items():
+                d = OrderedDict(rec)
+                d['eta_sec'] = _eta(rec['bytes_done'], rec['bytes_total'], rec['started'])
+                projects.setdefault(project, OrderedDict())[sample] = d
+            steps = [OrderedDict(s) for s in self._steps]
+            runs = list(self._runs)
+        return OrderedDict([
+            ('host', socket.gethostname()),
+            ('pid', os.getpid()),
+            ('started', self._started),
+            ('updated', time.time()),
+            ('step', steps[-1]['name'] if steps and steps[-1]['finished'] is None else None),
+            ('steps', steps),
+            ('projects', projects),
+            ('tasks', [tr.to_dict() for tr in runs]),
+        ])
+
+    def write(self):
+        tmp_fpath = self.status_fpath + '.tmp'
+        with open(tmp_fpath, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.rename(tmp_fpath, self.status_fpath)  # readers never see a partial file
+
+    def _write_loop(self):
+        while not self._stop.wait(WRITE_INTERVAL):
+            try:
+                self.write()
+            except (IOError, OSError) as e:
+                debug('Cannot write ' + self.status_fpath + ': ' + str(e))
+
+    def _serve(self, port):
+        tracker = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(tracker.to_dict(), indent=2).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = HTTPServer(('127.0.0.1', port), Handler)
+        thread = threading.Thread(target=self._server.serve_forever, name='prealign-status-http')
+        thread.daemon = True
+        thread.start()
+        info('Pipeline status is served at http://localhost:' + str(port) + '/')
+
+
+status = StatusTracker()
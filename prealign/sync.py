@@ -0,0 +1,152 @@
+""" Manifest-based delta sync of report directories.
+
+A manifest of what was last published (size, mtime and md5 per file) is kept next to
+the published copy. On each sync only new or changed files are transferred, on a pool
+of worker threads, and files that disappeared from the source are removed from the target.
+Files whose mtime changed but whose content did not are not re-transferred. The manifest
+is trusted for unchanged files; verify=True also checks that they are still on the target.
+
+Only report artifacts are published: the work and log directories, the merged fastqs
+(<output>/fastq, used when the dataset directory is read-only) and bulk read data anywhere
+in the tree (fastqs, BAMs) are skipped, and directory symlinks (e.g. fastq/FastQC -> FastQC)
+are not followed.
+"""
+import hashlib
+import json
+import os
+from fnmatch import fnmatch
+import shutil
+import time
+from multiprocessing.pool import ThreadPool
+from os.path import join, relpath, isfile, dirname, exists
+
+from ngs_utils.logger import info, warn, debug
+from ngs_utils.file_utils import safe_mkdir, file_transaction
+
+
+MANIFEST_FNAME = '.prealign_sync_manifest.json'
+DEFAULT_EXCLUDE_DIRNAMES = ('work', 'log', 'fastq')
+DEFAULT_EXCLUDE_PATTERNS = ('*.fastq', '*.fastq.gz', '*.fq', '*.fq.gz', '*.bam', '*.bai', '*.cram', '*.crai', '*.sam')
+
+
+def md5_file(fpath, block_size=1 << 20):
+    h = hashlib.md5()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class LocalTarget:
+    """ Publishes files into a local (or network-mounted) directory """
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        safe_mkdir(dirpath)
+
+    def __str__(self):
+        return self.dirpath
+
+    def exists(self, rel_fpath):
+        return isfile(join(self.dirpath, rel_fpath))
+
+    def put(self, src_fpath, rel_fpath):
+        dst_fpath = join(self.dirpath, rel_fpath)
+        safe_mkdir(dirname(dst_fpath))
+        tmp_fpath = dst_fpath + '.prealign_sync_tmp'
+        shutil.copy2(src_fpath, tmp_fpath)
+        os.rename(tmp_fpath, dst_fpath)
+
+    def remove(self, rel_fpath):
+        dst_fpath = join(self.dirpath, rel_fpath)
+        if exists(dst_fpath):
+            os.remove(dst_fpath)
+
+    def read_manifest(self):
+        fpath = join(self.dirpath, MANIFEST_FNAME)
+        if isfile(fpath):
+            try:
+                with open(fpath) as f:
+                    return json.load(f)
+            except ValueError:
+                warn('Cannot read sync manifest ' + fpath + ', publishing everything')
+        return dict()
+
+    def write_manifest(self, manifest):
+        fpath = join(self.dirpath, MANIFEST_FNAME)
+        with file_transaction(None, fpath) as tx:
+            with open(tx, 'w') as f:
+                json.dump(manifest, f, separators=(',', ':'), sort_keys=True)
+
+
+def _walk_source(src_dirpath, exclude_dirnames, exclude_patterns):
+    for rootpath, dirnames, fnames in os.walk(src_dirpath):
+        dirnames[:] = [d for d in dirnames if not (rootpath == src_dirpath and d in exclude_dirnames)]
+        for fname in fnames:
+            if fname == MANIFEST_FNAME or any(fnmatch(fname, p) for p in exclude_patterns):
+                continue
+            fpath = join(rootpath, fname)
+            try:
+                st = os.stat(fpath)
+            except OSError:  # broken symlink
+                continue
+            yield relpath(fpath, src_dirpath), fpath, st
+
+
+def sync_dir(src_dirpath, target, threads=8, exclude_dirnames=DEFAULT_EXCLUDE_DIRNAMES,
+             exclude_patterns=DEFAULT_EXCLUDE_PATTERNS, verify=False):
+    """ Brings target up to date with src_dirpath, transferring only what changed since the last sync.
+        target: a LocalTarget or an object with the same interface.
+        verify: re-transfer files recorded in the manifest that are missing on the target (one check per file).
+        Returns a dict with transfer statistics.
+    """
+    t = time.time()
+    old_manifest = target.read_manifest()
+    new_manifest = dict()
+    to_put = []
+    unchanged_num = 0
+
+    def _published(rel_fpath):
+        return not verify or target.exists(rel_fpath)
+
+    for rel_fpath, fpath, st in _walk_source(src_dirpath, exclude_dirnames, exclude_patterns):
+        rec = dict(size=st.st_size, mtime=st.st_mtime)
+        old_rec = old_manifest.get(rel_fpath)
+        if old_rec and old_rec['size'] == rec['size'] and old_rec['mtime'] == rec['mtime'] and _published(rel_fpath):
+            rec['md5'] = old_rec['md5']
+            unchanged_num += 1
+        else:
+            rec['md5'] = md5_file(fpath)
+            if old_rec and old_rec['md5'] == rec['md5'] and _published(rel_fpath):
+                unchanged_num += 1
+            else:
+                to_put.append((rel_fpath, fpath))
+        new_manifest[rel_fpath] = rec
+
+    removed = [rel_fpath for rel_fpath in old_manifest if rel_fpath not in new_manifest]
+    for rel_fpath in removed:
+        target.remove(rel_fpath)
+
+    if to_put:
+        def _put(args):
+            rel_fpath, fpath = args
+            target.put(fpath, rel_fpath)
+        pool = ThreadPool(max(1, min(threads, len(to_put))))
+        try:
+            pool.map(_put, to_put)
+        finally:
+            pool.close()
+            pool.join()
+
+    target.write_manifest(new_manifest)
+
+    stats = dict(
+        transferred=len(to_put),
+        transferred_bytes=sum(new_manifest[rel_fpath]['size'] for rel_fpath, _ in to_put),
+        unchanged=unchanged_num,
+        removed=len(removed),
+        seconds=time.time() - t)
+    info('Synced ' + src_dirpath + ' -> ' + str(target) + ': ' + str(stats['transferred']) + ' files (' +
+         str(stats['transferred_bytes']) + ' bytes) transferred, ' + str(stats['unchanged']) + ' unchanged, ' +
+         str(stats['removed']) + ' removed, in ' + '%.1f' % stats['seconds'] + 's')
+    debug('Transferred: ' + ', '.join(rel_fpath for rel_fpath, _ in to_put))
+    return stats
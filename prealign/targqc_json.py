@@ -0,0 +1,138 @@
+""" Partial loading of per-sample TargQC JSON reports.
+
+The project-level report only needs a couple of record values (e.g. Sex) from each
+sample's TargQC JSON, so instead of building a full SampleReport we scan the "records"
+array one element at a time and stop as soon as all requested metrics are found.
+Extracted values are cached on disk keyed by file mtime and size.
+"""
+import json
+import re
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from os.path import isfile
+
+from ngs_utils.logger import warn, debug
+from ngs_utils.file_utils import file_transaction
+
+from prealign.fs_cache import fs_cache
+
+
+_records_start_re = re.compile(r'"records"\s*:\s*\[')
+_separator_re = re.compile(r'[\s,]*')
+_decoder = json.JSONDecoder(object_pairs_hook=OrderedDict)
+
+
+def _rec_metric_name(rec):
+    metric = rec.get('metric')
+    if isinstance(metric, dict):
+        return metric.get('name')
+    return metric
+
+
+def _iter_records(text):
+    """ Yields records of the top-level "records" array without parsing the rest of the document """
+    m = _records_start_re.search(text)
+    if not m:
+        data = json.loads(text, object_pairs_hook=OrderedDict)
+        for rec in data.get('records', []):
+            yield rec
+        return
+    pos = m.end()
+    while True:
+        pos = _separator_re.match(text, pos).end()
+        if pos >= len(text) or text[pos] == ']':
+            return
+        rec, pos = _decoder.raw_decode(text, pos)
+        yield rec
+
+
+def read_record_values(json_fpath, metric_names):
+    """ Returns {metric_name: value} for the metrics found in a TargQC JSON report """
+    metric_names = set(metric_names)
+    values = dict()
+    with open(json_fpath) as f:
+        text = f.read()
+    for rec in _iter_records(text):
+        if isinstance(rec, dict):
+            name = _rec_metric_name(rec)
+            if name in metric_names and name not in values:
+                values[name] = rec.get('value')
+                if len(values) == len(metric_names):
+                    break
+    return values
+
+
+class TargqcValuesCache:
+    """ Extracted record values by JSON path, invalidated by the file's mtime and size """
+    def __init__(self, cache_fpath=None):
+        self.cache_fpath = cache_fpath
+        self.entries = dict()
+        self.changed = False
+        if cache_fpath and isfile(cache_fpath):
+            try:
+                with open(cache_fpath) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                warn('Cannot read TargQC values cache ' + cache_fpath + ', rebuilding')
+
+    def get(self, json_fpath, stamp, metric_names):
+        e = self.entries.get(json_fpath)
+        if e and e['stamp'] == list(stamp) and all(n in e['searched'] for n in metric_names):
+            return dict((n, v) for n, v in e['values'].items() if n in metric_names)
+        return None
+
+    def put(self, json_fpath, stamp, metric_names, values):
+        self.entries[json_fpath] = dict(stamp=list(stamp), searched=sorted(metric_names), values=values)
+        self.changed = True
+
+    def save(self):
+        if self.cache_fpath and self.changed:
+            with file_transaction(None, self.cache_fpath) as tx:
+                with open(tx, 'w') as f:
+                    json.dump(self.entries, f)
+            fs_cache.invalidate(self.cache_fpath)
+            self.changed = False
+
+
+def load_values_by_sample(json_fpath_by_sample, metric_names, cache_fpath=None, threads=8):
+    """ Reads metric_names from each sample's TargQC JSON on a thread pool.
+        Returns {sample_name: {metric_name: value}}, skipping samples without a JSON.
+    """
+    cache = TargqcValuesCache(cache_fpath)
+    values_by_sample = OrderedDict()
+    to_read = []
+    for sname, json_fpath in json_fpath_by_sample.items():
+        if not json_fpath or not fs_cache.verify_file(json_fpath, silent=True):
+            continue
+        stamp = (fs_cache.getmtime(json_fpath), fs_cache.getsize(json_fpath))
+        values = cache.get(json_fpath, stamp, metric_names)
+        if values is not None:
+            values_by_sample[sname] = values
+        else:
+            to_read.append((sname, json_fpath, stamp))
+
+    from_cache_num = len(values_by_sample)
+    if to_read:
+        def _read(args):
+            sname, json_fpath, stamp = args
+            try:
+                return read_record_values(json_fpath, metric_names)
+            except ValueError as e:
+                warn('Cannot parse TargQC JSON ' + json_fpath + ': ' + str(e))
+                return None
+
+        pool = ThreadPool(max(1, min(threads, len(to_read))))
+        try:
+            results = pool.map(_read, to_read)
+        finally:
+            pool.close()
+            pool.join()
+        for (sname, json_fpath, stamp), values in zip(to_read, results):
+            if values is not None:
+                cache.put(json_fpath, stamp, metric_names, values)
+                values_by_sample[sname] = values
+        cache.save()
+
+    debug('TargQC JSON values: ' + str(from_cache_num) + ' from cache, ' +
+          str(len(to_read)) + ' parsed')
+    return values_by_sample
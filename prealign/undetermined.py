@@ -0,0 +1,355 @@
+""" Census of index sequences in undetermined reads, for demultiplexing triage.
+
+Index sequences are taken from the read headers of Undetermined_*_R1_*.fastq.gz files
+(the "1:N:0:ACGTACGT+TTGGCCAA" part). bcl2fastq writes fastq.gz as many concatenated gzip
+members, so a large file is split into byte ranges of RANGE_BYTES counted on separate
+engines: a range task inflates the members starting in its range, and the reads whose
+header starts in them. Files that are one gzip member are counted by a single task.
+
+Counts go into a bounded-memory Misra-Gries summary: exact counts within a chunk of reads,
+merged into the summary and truncated to a fixed number of barcodes. Summaries of ranges
+and files merge the same way. The top barcodes are matched against the SampleSheet indexes,
+including reverse-complemented and swapped i7/i5.
+"""
+import re
+import zlib
+from os.path import join, getsize
+
+from ngs_utils.logger import info
+from ngs_utils.file_utils import file_transaction
+
+from prealign.fs_cache import fs_cache
+
+
+DEFAULT_CAPACITY = 10000
+CHUNK_READS = 1000000
+TOP_N = 20
+RANGE_BYTES = 1 << 30
+READ_SIZE = 1 << 20
+PROBE_BYTES = 16 << 20  # a multi-member file has a second member within this many bytes
+
+GZIP_MAGIC = b'\x1f\x8b\x08'
+_TEXT_BYTES = bytes(bytearray([9, 10, 13] + list(range(32, 127))))
+
+_undetermined_re = re.compile(r'.*Undetermined.*_R1(_\d+)?\.fastq\.gz$')
+_complement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N'}
+
+
+def revcomp(seq):
+    return ''.join(_complement.get(c, c) for c in reversed(seq))
+
+
+class HeavyHitters:
+    """ Mergeable Misra-Gries summary with at most `capacity` counters. When there are more,
+        the (capacity+1)-th largest count is subtracted from all counters and the ones that drop
+        to zero are removed. `error` is the sum of everything subtracted, so the true count of
+        every barcode is between its count (0 if absent) and its count + error, and
+        error <= (total - sum of counts) / (capacity + 1).
+    """
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.counts = dict()
+        self.error = 0
+        self.total = 0
+
+    def update(self, counts, total=None):
+        for k, c in counts.items():
+            self.counts[k] = self.counts.get(k, 0) + c
+        self.total += sum(counts.values()) if total is None else total
+        if len(self.counts) > self.capacity:
+            threshold = sorted(self.counts.values(), reverse=True)[self.capacity]
+            self.counts = dict((k, c - threshold) for k, c in self.counts.items() if c > threshold)
+            self.error += threshold
+
+    def merge(self, other):
+        self.error += other.error
+        self.update(other.counts, total=other.total)
+
+    def top(self, n=TOP_N):
+        return sorted(self.counts.items(), key=lambda kv: -kv[1])[:n]
+
+    def to_dict(self):
+        return dict(counts=self.counts, error=self.error, total=self.total)
+
+    @staticmethod
+    def from_dict(d, capacity=DEFAULT_CAPACITY):
+        hh = HeavyHitters(capacity)
+        hh.counts, hh.error, hh.total = d['counts'], d['error'], d['total']
+        return hh
+
+
+def find_undetermined_fastqs(dirpaths):
+    """ Undetermined R1 fastqs in dirpaths, also looking into bcl2fastq 1.x "Undetermined_indices/Sample_lane*" """
+    found = []
+    for dirpath in dirpaths:
+        if not dirpath:
+            continue
+        for fname in fs_cache.listdir(dirpath):
+            fpath = join(dirpath, fname)
+            if _undetermined_re.match(fname) and fs_cache.isfile(fpath):
+                found.append(fpath)
+            elif fname == 'Undetermined_indices':
+                found.extend(find_undetermined_fastqs([join(fpath, d) for d in fs_cache.listdir(fpath)]))
+    return sorted(set(found))
+
+
+def count_undetermined_barcodes(fastq_fpath, max_reads=None, capacity=DEFAULT_CAPACITY):
+    """ Runs on an engine: counts index sequences in fastq_fpath read headers.
+        Returns HeavyHitters.to_dict()
+    """
+    from itertools import islice
+    from prealign.gzip_io import open_fastq
+    from prealign.undetermined import HeavyHitters, CHUNK_READS
+
+    hh = HeavyHitters(capacity)
+    with open_fastq(fastq_fpath) as f:
+        headers = islice(f, 0, max_reads * 4 if max_reads else None, 4)
+        while True:
+            chunk = dict()
+            n = 0
+            for header in islice(headers, CHUNK_READS):
+                bc = header.rsplit(b':', 1)[-1].strip()
+                chunk[bc] = chunk.get(bc, 0) + 1
+                n += 1
+            if not n:
+                break
+            hh.update(dict((k.decode(), c) for k, c in chunk.items()), total=n)
+    return hh.to_dict()
+
+
+def _is_member_start(f, offset):
+    """ Whether a gzip member starts at offset: it inflates, and into fastq text """
+    pos = f.tell()
+    try:
+        f.seek(offset)
+        data = f.read(1 << 16)
+        if not data.startswith(GZIP_MAGIC):
+            return False
+        try:
+            out = zlib.decompressobj(31).decompress(data, 4096)
+        except zlib.error:
+            return False
+        return bool(out) and not out.translate(None, _TEXT_BYTES)
+    finally:
+        f.seek(pos)
+
+
+def find_member_start(f, start, end):
+    """ Offset of the first gzip member starting in [start, end), or None """
+    if start == 0:
+        return 0
+    offset = start
+    tail = b''
+    f.seek(offset)
+    while offset < end:
+        block = f.read(READ_SIZE)
+        if not block:
+            return None
+        buf = tail + block
+        base = offset - len(tail)
+        i = buf.find(GZIP_MAGIC)
+        while i != -1:
+            if base + i >= end:
+                return None
+            if _is_member_start(f, base + i):
+                return base + i
+            i = buf.find(GZIP_MAGIC, i + 1)
+        tail = buf[-(len(GZIP_MAGIC) - 1):]
+        offset += len(block)
+    return None
+
+
+def _iter_members(f, offset, end):
+    """ Yields (inflated block, past_end) for the gzip members from offset on,
+        past_end is True for the members starting at or after end
+    """
+    f.seek(offset)
+    data_end = offset
+    member_start = offset
+    d = zlib.decompressobj(31)
+    data = b''
+    while True:
+        if not data:
+            data = f.read(READ_SIZE)
+            if not data:
+                return
+            data_end += len(data)
+        out = d.decompress(data)
+        if out:
+            yield out, member_start >= end
+        if d.eof:
+            data = d.unused_data
+            member_start = data_end - len(data)
+            d = zlib.decompressobj(31)
+            if data and not data.startswith(GZIP_MAGIC[:2]):  # padding after the last member
+                return
+        else:
+            data = b''
+
+
+def _first_record_offset(buf):
+    """ Offset of the first full fastq record in buf, which may start in the middle of a line:
+        a line starting with "@" followed by a sequence and a "+" line. None if buf is too short to tell.
+    """
+    lines = buf.split(b'\n')
+    offset = 0
+    for i in range(len(lines) - 3):
+        if lines[i].startswith(b'@') and lines[i + 2].startswith(b'+'):
+            return offset
+        offset += len(lines[i]) + 1
+    return None
+
+
+def count_range_barcodes(fastq_fpath, start, end, capacity=DEFAULT_CAPACITY):
+    """ Runs on an engine: counts index sequences in the headers of the reads whose header starts in
+        the gzip members starting in [start, end) of fastq_fpath. Returns HeavyHitters.to_dict()
+    """
+    from prealign.undetermined import HeavyHitters, find_member_start, _iter_members, _first_record_offset, \
+        CHUNK_READS
+
+    hh = HeavyHitters(capacity)
+    chunk = dict()
+    n = 0
+    with open(fastq_fpath, 'rb') as f:
+        member_start = find_member_start(f, start, end)
+        if member_start is None:
+            return hh.to_dict()
+        buf = b''
+        own_end = None  # where the text of the members after the range starts in buf
+        phase = 0 if member_start == 0 else None  # line number in the record, None until the first record
+        for block, past_end in _iter_members(f, member_start, end):
+            if past_end and own_end is None:
+                own_end = len(buf)
+            buf += block
+            if phase is None:
+                offset = _first_record_offset(buf)
+                if offset is None:
+                    continue
+                if own_end is not None and offset >= own_end:
+                    break
+                buf = buf[offset:]
+                own_end = own_end - offset if own_end is not None else None
+                phase = 0
+            last_nl = buf.rfind(b'\n')
+            if last_nl == -1:
+                continue
+            if own_end is None:
+                lines = buf[:last_nl].split(b'\n')
+                buf = buf[last_nl + 1:]
+                for header in lines[(4 - phase) % 4::4]:
+                    bc = header.rsplit(b':', 1)[-1].strip()
+                    chunk[bc] = chunk.get(bc, 0) + 1
+                n += len(lines[(4 - phase) % 4::4])
+                phase = (phase + len(lines)) % 4
+                if n >= CHUNK_READS:
+                    hh.update(dict((k.decode(), c) for k, c in chunk.items()), total=n)
+                    chunk, n = dict(), 0
+            else:  # the text after the range only completes the lines started in it
+                pos = 0
+                while pos < own_end:
+                    nl = buf.find(b'\n', pos)
+                    if nl == -1:
+                        break
+                    if phase == 0:
+                        bc = buf[pos:nl].rsplit(b':', 1)[-1].strip()
+                        chunk[bc] = chunk.get(bc, 0) + 1
+                        n += 1
+                    phase = (phase + 1) % 4
+                    pos = nl + 1
+                buf = buf[pos:]
+                own_end -= pos
+                if own_end <= 0:
+                    break
+        if buf and (own_end is None or own_end > 0) and phase == 0:  # the last header without a newline
+            bc = buf.rsplit(b':', 1)[-1].strip()
+            chunk[bc] = chunk.get(bc, 0) + 1
+            n += 1
+    if n:
+        hh.update(dict((k.decode(), c) for k, c in chunk.items()), total=n)
+    return hh.to_dict()
+
+
+def is_multi_member(fastq_fpath):
+    with open(fastq_fpath, 'rb') as f:
+        return find_member_start(f, 1, min(getsize(fastq_fpath), PROBE_BYTES)) is not None
+
+
+def census_tasks(fastq_fpaths, max_reads=None, capacity=DEFAULT_CAPACITY, range_bytes=RANGE_BYTES):
+    """ Parameters of count_census_task: byte ranges of large multi-member files, whole files otherwise """
+    tasks = []
+    for fpath in fastq_fpaths:
+        size = getsize(fpath)
+        if max_reads or size <= range_bytes or not is_multi_member(fpath):
+            tasks.append([fpath, None, None, max_reads, capacity])
+        else:
+            for start in range(0, size, range_bytes):
+                tasks.append([fpath, start, min(size, start + range_bytes), None, capacity])
+    return tasks
+
+
+def count_census_task(fastq_fpath, start, end, max_reads, capacity):
+    """ Runs on an engine: one of census_tasks() """
+    from prealign.undetermined import count_undetermined_barcodes, count_range_barcodes
+    if start is None:
+        return count_undetermined_barcodes(fastq_fpath, max_reads, capacity)
+    return count_range_barcodes(fastq_fpath, start, end, capacity)
+
+
+def _split_index(index):
+    """ "ACGT-TTGG" or "ACGT+TTGG" -> ('ACGT', 'TTGG') """
+    fs = re.split(r'[-+]', index or '')
+    return fs[0], (fs[1] if len(fs) > 1 else '')
+
+
+def match_barcode(barcode, samples):
+    """ Describes how barcode relates to the SampleSheet indexes of samples """
+    i7, i5 = _split_index(barcode)
+    matches = []
+    for s in samples:
+        s_i7, s_i5 = _split_index(s.index)
+        s_i5 = s.index2 or s_i5
+        if not s_i7:
+            continue
+        if i7 == s_i7 and i5 and s_i5 and i5 == revcomp(s_i5):
+            matches.append(s.name + ' (i5 reverse-complemented)')
+        elif i7 == revcomp(s_i7) and (not i5 or i5 == s_i5):
+            matches.append(s.name + ' (i7 reverse-complemented)')
+        elif i5 and s_i5 and i7 == s_i5 and i5 == s_i7:
+            matches.append(s.name + ' (i7 and i5 swapped)')
+        elif i7 == s_i7 and (not s_i5 or i5 == s_i5):
+            matches.append(s.name)
+        elif i7 == s_i7:
+            matches.append(s.name + ' (i7 only)')
+        elif i5 and s_i5 and i5 == s_i5:
+            matches.append(s.name + ' (i5 only)')
+    return matches
+
+
+def run_census(tasks, view, capacity=DEFAULT_CAPACITY):
+    """ Runs the census_tasks() in parallel and merges the summaries """
+    results = view.run(count_census_task, tasks)
+    hh = HeavyHitters(capacity)
+    for res in results:
+        hh.merge(HeavyHitters.from_dict(res, capacity))
+    return hh
+
+
+def write_census_report(hh, samples, output_fpath, top_n=TOP_N):
+    rows = []
+    for bc, count in hh.top(top_n):
+        rows.append((bc, count, 100.0 * count / hh.total if hh.total else 0.0,
+                     '+'.join(revcomp(part) for part in re.split(r'[-+]', bc)),
+                     ', '.join(match_barcode(bc, samples))))
+    with file_transaction(None, output_fpath) as tx:
+        with open(tx, 'w') as f:
+            f.write('# ' + str(hh.total) + ' undetermined reads; counts are lower bounds, each at most ' + str(hh.error) +
+                    ' below the true count; unlisted barcodes have at most ' + str(hh.error + (rows[-1][1] if rows else 0)) + ' reads\n')
+            f.write('barcode\tcount\tpct_of_undetermined\treverse_complement\tsamplesheet_matches\n')
+            for bc, count, pct, rc, matches in rows:
+                f.write('\t'.join([bc, str(count), '%.2f' % pct, rc, matches]) + '\n')
+    fs_cache.invalidate(output_fpath)
+
+    info('Top undetermined barcodes (' + str(hh.total) + ' reads):')
+    for bc, count, pct, rc, matches in rows[:10]:
+        info('  ' + bc + '\t' + str(count) + '\t' + '%.2f' % pct + '%' + ('\t' + matches if matches else ''))
+    return output_fpath
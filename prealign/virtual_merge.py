@@ -0,0 +1,138 @@
+""" Virtual merge of lane fastqs: a small manifest listing the lane files in order instead of a concatenated copy.
+
+A manifest <sample>_R1.fastq.gz.manifest stands for <sample>_R1.fastq.gz. prealign reads it
+as one stream through gzip_io.open_fastq, FastQC gets it through a named pipe fed with
+the raw gzip members (concatenated members are a valid gzip file), and alignment gets a
+downsampled copy. Real merged files are made only on demand:
+
+    python -m prealign.virtual_merge <fastq_dir or manifests>
+"""
+import json
+import os
+import shutil
+import threading
+from os.path import isfile, isdir, join, getsize
+
+from ngs_utils.logger import info, err
+from ngs_utils.file_utils import file_transaction
+
+from prealign.fs_cache import fs_cache
+
+
+MANIFEST_EXT = '.manifest'
+
+
+def is_manifest(fpath):
+    return bool(fpath) and fpath.endswith(MANIFEST_EXT)
+
+
+def manifest_fpath_for(merged_fpath):
+    return merged_fpath + MANIFEST_EXT
+
+
+def merged_fpath_for(manifest_fpath):
+    return manifest_fpath[:-len(MANIFEST_EXT)]
+
+
+def write_manifest(fastq_fpaths, manifest_fpath):
+    parts = [dict(path=fpath, size=getsize(fpath)) for fpath in fastq_fpaths]
+    with file_transaction(None, manifest_fpath) as tx:
+        with open(tx, 'w') as f:
+            json.dump(dict(parts=parts), f, indent=2)
+    fs_cache.invalidate(manifest_fpath)
+    return manifest_fpath
+
+
+def read_manifest(manifest_fpath):
+    """ Returns the ordered lane fastq paths; fails if a lane file is missing or has changed """
+    with open(manifest_fpath) as f:
+        parts = json.load(f)['parts']
+    for p in parts:
+        if not isfile(p['path']) or getsize(p['path']) != p['size']:
+            raise IOError('Lane file ' + p['path'] + ' listed in ' + manifest_fpath + ' is missing or has changed')
+    return [p['path'] for p in parts]
+
+
+def copy_raw(manifest_fpath, out, buffer_size=4 << 20):
+    """ Writes the lane files byte by byte into the binary file object out """
+    for fpath in read_manifest(manifest_fpath):
+        with open(fpath, 'rb') as inp:
+            shutil.copyfileobj(inp, out, buffer_size)
+
+
+def feed_fifo(manifest_fpath, fifo_fpath):
+    """ Creates a named pipe and starts a thread writing the raw lane files into it.
+        Call release_fifo() after the reader has finished.
+    """
+    if os.path.exists(fifo_fpath):
+        os.remove(fifo_fpath)
+    os.mkfifo(fifo_fpath)
+
+    def _feed():
+        try:
+            with open(fifo_fpath, 'wb') as out:
+                copy_raw(manifest_fpath, out)
+        except (IOError, OSError):  # the reader went away
+            pass
+
+    thread = threading.Thread(target=_feed)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def release_fifo(fifo_fpath, thread, timeout=10):
+    """ Unblocks the writer if the reader never opened the pipe, and removes the pipe """
+    if thread.is_alive():
+        try:
+            fd = os.open(fifo_fpath, os.O_RDONLY | os.O_NONBLOCK)
+            os.close(fd)
+        except OSError:
+            pass
+        thread.join(timeout)
+    try:
+        os.remove(fifo_fpath)
+    except OSError:
+        pass
+
+
+def materialize(manifest_fpath, merged_fpath=None, remove_manifest=True):
+    """ Concatenates the lane files into a real merged fastq """
+    merged_fpath = merged_fpath or merged_fpath_for(manifest_fpath)
+    info('Materializing ' + manifest_fpath + ' -> ' + merged_fpath)
+    with file_transaction(None, merged_fpath) as tx:
+        with open(tx, 'wb') as out:
+            copy_raw(manifest_fpath, out)
+    fs_cache.invalidate(merged_fpath)
+    if remove_manifest:
+        os.remove(manifest_fpath)
+        fs_cache.invalidate(manifest_fpath)
+    return merged_fpath
+
+
+def main():
+    import sys
+    from optparse import OptionParser
+    parser = OptionParser(usage='python -m prealign.virtual_merge [--keep-manifest] <fastq_dir or .manifest files>',
+                          description='Make real merged fastq files from prealign --virtual-merge manifests')
+    parser.add_option('--keep-manifest', action='store_true', default=False)
+    opts, args = parser.parse_args()
+    if not args:
+        parser.error('provide fastq directories or manifest files')
+    manifest_fpaths = []
+    for path in args:
+        if isdir(path):
+            manifest_fpaths.extend(join(path, fn) for fn in sorted(os.listdir(path)) if is_manifest(fn))
+        elif is_manifest(path):
+            manifest_fpaths.append(path)
+        else:
+            err('Skipping ' + path + ': not a directory or a ' + MANIFEST_EXT + ' file')
+    if not manifest_fpaths:
+        err('No manifests found')
+        sys.exit(1)
+    for fpath in manifest_fpaths:
+        materialize(fpath, remove_manifest=not opts.keep_manifest)
+
+
+if __name__ == '__main__':
+    main()